@@ -26,11 +26,16 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import codecs
+import collections
 import datetime
+import hashlib
+import io
 import json
 import os
 import re
 import subprocess
+import threading
 from abc import ABCMeta, abstractmethod, abstractproperty
 from functools import wraps
 from .hashdict import HashDict
@@ -70,6 +75,18 @@ def parse_isodate(datestr):
     dt = dt.replace(tzinfo=UTCOffset(offset))
   return dt
 
+def stat_key(path):
+  """Get a key which changes whenever a file is modified or replaced
+
+  Returns None if the file does not exist.
+
+  """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime, st.st_size, st.st_ino)
+
 class ABCMetaDocStringInheritor(ABCMeta):
   '''A variation on
   http://groups.google.com/group/comp.lang.python/msg/26f7b4fcb4d66c95
@@ -105,6 +122,10 @@ class PathDoesNotExist(RevisionPathException):
 class BadFileType(RevisionPathException):
   pass
 
+class RevisionDoesNotExist(Exception):
+  def __init__(self, rev):
+    super(RevisionDoesNotExist, self).__init__(rev)
+
 class attrdict(dict):
   def __getattr__(self, name):
     return self.__getitem__(name)
@@ -169,12 +190,236 @@ class CommitLogCache(HashDict):
     value = value.to_json()
     HashDict.__setitem__(self, key, value)
 
+class HashedKeyDict(HashDict):
+  """A HashDict for arbitrary string keys
+
+  Keys are hashed to form file names, so iterating yields the hashes rather
+  than the keys.
+
+  """
+
+  def _hash(self, key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+  def __contains__(self, key):
+    return HashDict.__contains__(self, self._hash(key))
+
+  def __getitem__(self, key):
+    try:
+      return HashDict.__getitem__(self, self._hash(key))
+    except KeyError:
+      raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    HashDict.__setitem__(self, self._hash(key), value)
+
+  def __delitem__(self, key):
+    try:
+      HashDict.__delitem__(self, self._hash(key))
+    except KeyError:
+      raise KeyError(key)
+
+class BlameCache(HashedKeyDict):
+  """An on-disk cache of blame results, as lists of BlameHunk tuples
+
+  Keys are arbitrary strings, which are hashed to form file names.  Each
+  result is stored as a table of revisions followed by (revision index,
+  line count) pairs.  When the cache grows beyond max_size bytes, the least
+  recently used entries are evicted.
+
+  """
+
+  def __init__(self, path, max_size=64*1024*1024, mode=0o666):
+    HashedKeyDict.__init__(self, path, mode)
+    self.max_size = max_size
+    self._written = None
+
+  def __getitem__(self, key):
+    value = HashedKeyDict.__getitem__(self, key)
+    h = self._hash(key)
+    try:
+      # mark as recently used
+      os.utime(os.path.join(self.path, h[:2], h[2:]), None)
+    except OSError:
+      pass
+    try:
+      o = json.loads(value)
+    except ValueError:
+      raise KeyError(key)
+    if o.get('v') != 1:
+      raise KeyError(key)
+    revs = [(rev, author, parse_isodate(date)) for rev, author, date in o['r']]
+    results = []
+    line = 1
+    h = o['h']
+    for i in range(0, len(h), 2):
+      rev, author, date = revs[h[i]]
+      results.append(BlameHunk(rev, author, date, line, h[i+1]))
+      line += h[i+1]
+    return results
+
+  def __setitem__(self, key, hunks):
+    revs = []
+    index = {}
+    h = []
+    for hunk in hunks:
+      try:
+        i = index[hunk.rev]
+      except KeyError:
+        i = index[hunk.rev] = len(revs)
+        revs.append((hunk.rev, hunk.author, hunk.date.isoformat()))
+      h.extend((i, hunk.line_count))
+    value = json.dumps({'v': 1, 'r': revs, 'h': h}, separators=(',', ':'))
+    HashedKeyDict.__setitem__(self, key, value)
+    if self._written is None or self._written > self.max_size // 8:
+      self._written = 0
+      self.evict()
+    self._written += len(value)
+
+  def evict(self):
+    """Remove the least recently used entries if the cache is too large"""
+    entries = []
+    total = 0
+    for h in HashDict.__iter__(self):
+      p = os.path.join(self.path, h[:2], h[2:])
+      try:
+        st = os.stat(p)
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, p))
+      total += st.st_size
+    if total <= self.max_size:
+      return
+    entries.sort()
+    for mtime, size, p in entries:
+      try:
+        os.unlink(p)
+      except OSError:
+        pass
+      total -= size
+      if total <= self.max_size * 3 // 4:
+        break
+
+class DiffStatCache(HashedKeyDict):
+  """An on-disk cache of diffstat results, as lists of DiffStat tuples
+
+  Keys are arbitrary strings, which are hashed to form file names.
+
+  """
+
+  def __getitem__(self, key):
+    value = HashedKeyDict.__getitem__(self, key)
+    try:
+      o = json.loads(value)
+    except ValueError:
+      raise KeyError(key)
+    if o.get('v') != 1:
+      raise KeyError(key)
+    return [DiffStat(*x) for x in o['s']]
+
+  def __setitem__(self, key, stats):
+    value = json.dumps({'v': 1, 's': [list(x) for x in stats]},
+                       separators=(',', ':'))
+    HashedKeyDict.__setitem__(self, key, value)
+
 class FileChangeInfo(object):
   def __init__(self, path, status, copy=None):
     self.path = path
     self.status = status
     self.copy = copy
 
+class CommandStream(io.RawIOBase):
+  """A readable stream of a command's output
+
+  length is the number of bytes the command will write, if it is known in
+  advance, and None otherwise.  Closing the stream before the end of the
+  output kills the command.  If the command fails, CalledProcessError is
+  raised when the end of the output is reached.
+
+  """
+
+  def __init__(self, cmd, length=None, **kwargs):
+    self.cmd = cmd
+    self.length = length
+    self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs)
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    n = self._proc.stdout.readinto(b)
+    if not n and len(b):
+      if self._proc.wait() != 0:
+        raise subprocess.CalledProcessError(self._proc.returncode, self.cmd)
+    return n
+
+  def close(self):
+    if not self.closed:
+      p = self._proc
+      if p.poll() is None:
+        p.kill()
+      p.wait()
+      p.stdout.close()
+    io.RawIOBase.close(self)
+
+class RangeStream(io.RawIOBase):
+  """A byte range of another stream
+
+  The first offset bytes of stream are skipped, by seeking if the stream
+  allows it and by reading otherwise, and at most length bytes are returned
+  after that.  The underlying stream is closed as soon as the range has been
+  read, which stops any command that is still writing it.
+
+  """
+
+  def __init__(self, stream, offset=0, length=None):
+    if offset < 0 or (length is not None and length < 0):
+      raise ValueError('negative offset or length')
+    self._stream = stream
+    size = getattr(stream, 'length', None)
+    if size is not None:
+      size = max(0, size - offset)
+      if length is None or length > size:
+        length = size
+      self.length = length
+    else:
+      # unknown until the source is exhausted
+      self.length = None
+    self._remaining = length
+    if offset and stream.seekable():
+      stream.seek(offset, os.SEEK_CUR)
+    else:
+      while offset:
+        data = stream.read(min(offset, 65536))
+        if not data:
+          break
+        offset -= len(data)
+    if length == 0:
+      stream.close()
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    n = len(b)
+    if self._remaining is not None:
+      if self._remaining <= 0:
+        return 0
+      n = min(n, self._remaining)
+    data = self._stream.read(n)
+    n = len(data)
+    b[:n] = data
+    if self._remaining is not None:
+      self._remaining -= n
+      if self._remaining <= 0:
+        self._stream.close()
+    return n
+
+  def close(self):
+    if not self.closed:
+      self._stream.close()
+    io.RawIOBase.close(self)
+
 class BlameInfo(object):
   def __init__(self, rev, author, date, line):
     self.rev = rev
@@ -182,6 +427,205 @@ class BlameInfo(object):
     self.date = date
     self.line = line
 
+BlameHunk = collections.namedtuple('BlameHunk',
+                                   'rev author date start_line line_count')
+
+def blame_runs(lines):
+  """Group per-line (rev, author, date) tuples into BlameHunk runs
+
+  Consecutive lines from the same revision form one hunk.  Line numbers
+  start at 1.
+
+  """
+  last = None
+  start = count = 0
+  for n, info in enumerate(lines, 1):
+    if last is not None:
+      if info[0] == last[0]:
+        count += 1
+        continue
+      yield BlameHunk(last[0], last[1], last[2], start, count)
+    last = info
+    start = n
+    count = 1
+  if last is not None:
+    yield BlameHunk(last[0], last[1], last[2], start, count)
+
+def blame_lines(hunks, lines):
+  """Expand BlameHunk tuples into a list of BlameInfo objects, one per line"""
+  results = []
+  for hunk in hunks:
+    start = hunk.start_line - 1
+    for line in lines[start:start+hunk.line_count]:
+      results.append(BlameInfo(hunk.rev, hunk.author, hunk.date, line))
+  return results
+
+class FileDiff(object):
+  """The part of a diff that changes a single file
+
+  old_path is None if the file was added and new_path is None if it was
+  deleted.  status is 'A' (added), 'D' (deleted), 'M' (modified), 'R'
+  (renamed) or 'C' (copied).  header is the text before the first hunk, and
+  hunks is a list with the text of each hunk, starting at its @@ line.
+
+  """
+  def __init__(self, old_path, new_path, status, header, hunks):
+    self.old_path = old_path
+    self.new_path = new_path
+    self.status = status
+    self.header = header
+    self.hunks = hunks
+
+  def __repr__(self):
+    return '<FileDiff %s %s>' % (self.status, self.path)
+
+  @property
+  def path(self):
+    if self.new_path is None:
+      return self.old_path
+    return self.new_path
+
+  @property
+  def text(self):
+    """The diff of the file as it appears in the full diff"""
+    return self.header + b''.join(self.hunks)
+
+def split_diff(lines, is_header):
+  """Group the lines of a diff by file
+
+  lines is an iterable of lines including their line endings.
+  is_header(line, next_line) tells whether line starts the diff of another
+  file; next_line is None at the end of the diff.  Lines before the first
+  file are skipped.
+
+  Yields a (header, hunks) tuple for each file, where header is a list of
+  lines and hunks is a list of lists of lines.
+
+  """
+  lines = iter(lines)
+  header = hunks = None
+  line = next(lines, None)
+  while line is not None:
+    next_line = next(lines, None)
+    if is_header(line, next_line):
+      if header is not None:
+        yield header, hunks
+      header = [line]
+      hunks = []
+    elif header is None:
+      pass
+    elif line.startswith(b'@@'):
+      hunks.append([line])
+    elif hunks:
+      hunks[-1].append(line)
+    else:
+      header.append(line)
+    line = next_line
+  if header is not None:
+    yield header, hunks
+
+DiffStat = collections.namedtuple('DiffStat', 'path added removed binary')
+
+def diffstat_lines(diffs):
+  """Count the added and removed lines of FileDiff objects
+
+  Returns a list of DiffStat tuples.  Binary files count as 0 lines.
+
+  """
+  results = []
+  for diff in diffs:
+    added = removed = 0
+    binary = b'Binary file' in diff.header
+    for hunk in diff.hunks:
+      for line in hunk.split(b'\n')[1:]:
+        if line.startswith(b'+'):
+          added += 1
+        elif line.startswith(b'-'):
+          removed += 1
+        elif line.startswith(b'Property changes on: '):
+          # svnlook puts property changes after the last hunk
+          break
+    results.append(DiffStat(diff.path, added, removed, binary))
+  return results
+
+def _diff_path(text, prefix=True):
+  text = text.rstrip(b'\r\n')
+  if text.startswith(b'"'):
+    text = codecs.escape_decode(text[1:text.rindex(b'"')])[0]
+  else:
+    text = text.split(b'\t', 1)[0]
+  if text == b'/dev/null':
+    return None
+  if prefix and text[:2] in (b'a/', b'b/'):
+    text = text[2:]
+  return text
+
+def _diff_git_paths(line):
+  rest = line[len(b'diff --git '):].rstrip(b'\r\n')
+  if rest.startswith(b'"'):
+    i = rest.index(b'"', 1)
+    while rest[i-1:i] == b'\\':
+      i = rest.index(b'"', i + 1)
+    return _diff_path(rest[:i+1]), _diff_path(rest[i+2:])
+  if rest.endswith(b'"'):
+    i = rest.rindex(b' "')
+    return _diff_path(rest[:i]), _diff_path(rest[i+1:])
+  # unquoted names are ambiguous if they contain spaces, but both halves
+  # are the same unless the file was renamed or copied
+  n = (len(rest) - 1) // 2
+  return _diff_path(rest[:n]), _diff_path(rest[n+1:])
+
+def file_diff(header, hunks, encoding, paths=None):
+  """Make a FileDiff from the header and hunk lines of a unified diff
+
+  The paths are read from the ---/+++ lines or git extended headers, with a
+  leading a/ or b/ removed.  paths is an (old_path, new_path) tuple of bytes
+  to use if the header has neither, such as for a binary file.
+
+  """
+  old = new = None
+  status = None
+  found = False
+  for line in header:
+    if line.startswith(b'--- '):
+      old = _diff_path(line[4:])
+      found = True
+    elif line.startswith(b'+++ '):
+      new = _diff_path(line[4:])
+      found = True
+    elif line.startswith(b'new file mode '):
+      status = 'A'
+    elif line.startswith(b'deleted file mode '):
+      status = 'D'
+    elif line.startswith(b'rename from ') or line.startswith(b'copy from '):
+      status = 'R' if line.startswith(b'rename') else 'C'
+      old = _diff_path(line.split(b' ', 2)[2], False)
+    elif line.startswith(b'rename to ') or line.startswith(b'copy to '):
+      new = _diff_path(line.split(b' ', 2)[2], False)
+      found = True
+  if not found:
+    if header[0].startswith(b'diff --git '):
+      paths = _diff_git_paths(header[0])
+    if paths is not None:
+      old, new = paths
+  if status == 'A':
+    old = None
+  elif status == 'D':
+    new = None
+  elif status is None:
+    if old is None:
+      status = 'A'
+    elif new is None:
+      status = 'D'
+    else:
+      status = 'M'
+  if old is not None:
+    old = old.decode(encoding, 'replace')
+  if new is not None:
+    new = new.decode(encoding, 'replace')
+  return FileDiff(old, new, status, b''.join(header),
+                  [b''.join(hunk) for hunk in hunks])
+
 class UTCOffset(datetime.tzinfo):
   ZERO = datetime.timedelta()
 
@@ -217,11 +661,30 @@ class UTCOffset(datetime.tzinfo):
 class VCSRepo(object):
   __metaclass__ = ABCMetaDocStringInheritor
 
+  #: Size limit in bytes of the blame cache in private_path
+  blame_cache_size = 64 * 1024 * 1024
+
   def __init__(self, path, encoding='utf-8'):
     """Open an existing repository"""
     self.path = path
     self.encoding = encoding
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """Release any resources held by the repository object
+
+    This includes helper processes that are kept running between calls.
+    The repository object remains usable; resources are acquired again as
+    needed.
+
+    """
+    pass
+
   @abstractproperty
   def private_path(self):
     """Get the path to a directory which can be used to store arbitrary data
@@ -254,6 +717,63 @@ class VCSRepo(object):
         raise subprocess.CalledProcessError(p.returncode, cmd)
       return stdout
 
+  def _command_iter(self, cmd, sep=b'\n', input=None, keepends=False,
+                    **kwargs):
+    """Run a command and yield its output split on sep as it arrives
+
+    The separators are dropped unless keepends is true.  If input is given it
+    is written to the command's stdin from a separate thread.  If the
+    generator is closed before the output is exhausted, the command is
+    killed.
+
+    """
+    kwargs.setdefault('cwd', self.path)
+    if input is not None:
+      kwargs['stdin'] = subprocess.PIPE
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs)
+    try:
+      if input is not None:
+        def feed():
+          try:
+            p.stdin.write(input)
+            p.stdin.close()
+          except (IOError, OSError):
+            pass
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+      fd = p.stdout.fileno()
+      buf = bytearray()
+      pos = 0
+      scan = 0
+      while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+          break
+        buf.extend(chunk)
+        while True:
+          i = buf.find(sep, scan)
+          if i < 0:
+            scan = max(pos, len(buf) - len(sep) + 1)
+            break
+          end = i + len(sep)
+          yield bytes(buf[pos:end if keepends else i])
+          pos = scan = end
+        if pos:
+          del buf[:pos]
+          scan -= pos
+          pos = 0
+      if buf:
+        yield bytes(buf)
+      p.wait()
+      if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    finally:
+      if p.poll() is None:
+        p.kill()
+        p.wait()
+      p.stdout.close()
+
   @classmethod
   def cleanPath(cls, path):
     path = path.lstrip('/')
@@ -265,6 +785,22 @@ class VCSRepo(object):
     """Get the canonical revision identifier"""
     raise NotImplementedError
 
+  def canonical_rev_many(self, revs):
+    """Get the canonical revision identifiers of several revisions
+
+    Returns a list in the order of revs.  A revision that cannot be resolved
+    does not fail the others; its place in the list holds a
+    RevisionDoesNotExist instance instead.
+
+    """
+    results = []
+    for rev in revs:
+      try:
+        results.append(self.canonical_rev(rev))
+      except (subprocess.CalledProcessError, AssertionError):
+        results.append(RevisionDoesNotExist(rev))
+    return results
+
   @abstractmethod
   def ls(self, rev, path, recursive=False, recursive_dirs=False,
          directory=False, report=()):
@@ -304,11 +840,13 @@ class VCSRepo(object):
     raise NotImplementedError
 
   @abstractmethod
-  def cat(self, rev, path):
+  def cat(self, rev, path, offset=0, length=None):
     """Get file contents
 
     :param rev: The revision to use.
     :param path: The path to the file. Must be a file.
+    :param offset: The number of bytes to skip at the start of the file.
+    :param length: The maximum number of bytes to return, or None for all.
 
     Returns the file contents as a string.
 
@@ -318,6 +856,40 @@ class VCSRepo(object):
     """
     raise NotImplementedError
 
+  def _cat_range(self, rev, path, offset, length):
+    stream = self.cat_stream(rev, path, offset, length)
+    try:
+      return stream.read()
+    finally:
+      stream.close()
+
+  def cat_stream(self, rev, path, offset=0, length=None):
+    """Open file contents for reading as a stream
+
+    :param rev: The revision to use.
+    :param path: The path to the file. Must be a file.
+    :param offset: The number of bytes to skip at the start of the file.
+    :param length: The maximum number of bytes to read, or None for all.
+
+    Returns a readable file-like object.  Its length attribute is the number
+    of bytes it will return, or None if the backend cannot tell without
+    reading it all.  Close the stream when done with it, to release any
+    command that is still writing the contents.
+
+    Raises PathDoesNotExist if the path does not exist.
+    Raises BadFileType if the path is not a file.
+
+    """
+    data = self.cat(rev, path)
+    stream = io.BytesIO(data)
+    stream.length = len(data)
+    return self._stream_range(stream, offset, length)
+
+  def _stream_range(self, stream, offset, length):
+    if offset or length is not None:
+      return RangeStream(stream, offset, length)
+    return stream
+
   @abstractmethod
   def readlink(self, rev, path):
     """Get symbolic link target
@@ -365,6 +937,76 @@ class VCSRepo(object):
     """
     return NotImplementedError
 
+  @property
+  def _blame_cache(self):
+    try:
+      return self._blame_cache_v
+    except AttributeError:
+      blame_cache_path = os.path.join(self.private_path, 'blame-cache')
+      self._blame_cache_v = BlameCache(blame_cache_path, self.blame_cache_size)
+      return self._blame_cache_v
+
+  def _cached_blame_hunks(self, rev_key, identity, compute):
+    """Look up blame results in the blame cache, computing them if missing
+
+    rev_key identifies the revision and path being blamed.  identity is a
+    function returning a key for the file's content and history, such that
+    files with the same identity have the same blame; it is only called if
+    rev_key is not cached, and may return None.  compute returns an iterator
+    of BlameHunk tuples, which are cached once it is exhausted.
+
+    Returns an iterator of BlameHunk tuples.
+
+    """
+    cache = self._blame_cache
+    try:
+      return iter(cache[rev_key])
+    except KeyError:
+      pass
+    keys = [rev_key]
+    ident_key = identity()
+    if ident_key is not None:
+      try:
+        hunks = cache[ident_key]
+      except KeyError:
+        keys.append(ident_key)
+      else:
+        cache[rev_key] = hunks
+        return iter(hunks)
+    return self._fill_blame_cache(keys, compute())
+
+  def _fill_blame_cache(self, keys, hunks):
+    results = []
+    for hunk in hunks:
+      results.append(hunk)
+      yield hunk
+    cache = self._blame_cache
+    for key in keys:
+      cache[key] = results
+
+  def _load_len_cache(self):
+    """Get the (key, count, state) last saved by _save_len_cache, or None"""
+    path = os.path.join(self.private_path, 'len-cache')
+    try:
+      with open(path) as f:
+        d = json.load(f)
+      return d['key'], d['count'], d.get('state')
+    except (IOError, ValueError, KeyError, TypeError):
+      return None
+
+  def _save_len_cache(self, key, count, state=None):
+    """Save a commit count along with the key it is valid for
+
+    state is any extra JSON-serializable data needed to update the count
+    incrementally.
+
+    """
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=self.private_path, prefix='len-cache.')
+    with os.fdopen(fd, 'w') as f:
+      json.dump({'key': key, 'count': count, 'state': state}, f)
+    os.rename(tmp, os.path.join(self.private_path, 'len-cache'))
+
   @abstractmethod
   def __len__(self):
     """Returns the number of commits in the repository
@@ -401,6 +1043,22 @@ class VCSRepo(object):
     """
     raise NotImplementedError
 
+  @abstractmethod
+  def iter_log(self, revrange=None, limit=None, firstparent=False,
+               merges=None, path=None, follow=False):
+    """Iterate over commit logs
+
+    Takes the same arguments as log(), but returns a generator which yields
+    log entries as they are read from the underlying VCS rather than
+    building a list of all of them first.  If revrange is a single revision,
+    the generator yields a single log entry.
+
+    Closing the generator before it is exhausted terminates any command that
+    is still running.
+
+    """
+    raise NotImplementedError
+
   @abstractmethod
   def changed(self, rev):
     """Files that changed from the rev's parent(s)
@@ -410,6 +1068,20 @@ class VCSRepo(object):
     """
     raise NotImplementedError
 
+  def changed_many(self, revs):
+    """Files that changed in each of several revisions
+
+    Returns a generator of (rev, changes) pairs in the order of revs, where
+    changes is the list that changed(rev) would return.  Backends answer all
+    of the revisions with as few commands as they can.
+
+    Closing the generator before it is exhausted terminates any command that
+    is still running.
+
+    """
+    for rev in revs:
+      yield rev, self.changed(rev)
+
   @abstractmethod
   def pdiff(self, rev):
     """Diff from the rev's parent(s)
@@ -431,6 +1103,72 @@ class VCSRepo(object):
     """
     raise NotImplementedError
 
+  @abstractmethod
+  def iter_pdiff(self, rev):
+    """Iterate over the diff from the rev's parent(s) one file at a time
+
+    Returns a generator of FileDiff objects making up the diff that
+    pdiff(rev) returns.  They are parsed as the underlying VCS writes the
+    diff, so closing the generator early terminates any command that is
+    still running.
+
+    """
+    raise NotImplementedError
+
+  @abstractmethod
+  def iter_diff(self, rev_a, rev_b, path=None):
+    """Iterate over the diff of two revisions one file at a time
+
+    Returns a generator of FileDiff objects making up the diff that
+    diff(rev_a, rev_b, path) returns.  Closing the generator early
+    terminates any command that is still running.
+
+    """
+    raise NotImplementedError
+
+  @abstractmethod
+  def diffstat(self, rev_a, rev_b=None):
+    """Count the lines added and removed in each file
+
+    With one revision, count the changes that pdiff(rev_a) shows.  With two,
+    count the changes that diff(rev_a, rev_b) shows.
+
+    Returns a list of DiffStat tuples (path, added, removed, binary) in diff
+    order.  Binary files have added and removed counts of 0.  Results are
+    cached in private_path by revision pair.
+
+    """
+    raise NotImplementedError
+
+  @property
+  def _diffstat_cache(self):
+    try:
+      return self._diffstat_cache_v
+    except AttributeError:
+      diffstat_cache_path = os.path.join(self.private_path, 'diffstat-cache')
+      self._diffstat_cache_v = DiffStatCache(diffstat_cache_path)
+      return self._diffstat_cache_v
+
+  def _cached_diffstat(self, key, compute):
+    cache = self._diffstat_cache
+    try:
+      return cache[key]
+    except KeyError:
+      pass
+    results = compute()
+    cache[key] = results
+    return results
+
+  def _iter_file_diffs(self, cmd, is_header, paths=None):
+    output = self._command_iter(cmd)
+    try:
+      lines = (line + b'\n' for line in output)
+      for header, hunks in split_diff(lines, is_header):
+        p = paths(header) if paths is not None else None
+        yield file_diff(header, hunks, self.encoding, p)
+    finally:
+      output.close()
+
   @abstractmethod
   def ancestor(self, rev1, rev2):
     """Find most recent common ancestor of two revisions
@@ -448,3 +1186,18 @@ class VCSRepo(object):
 
     """
     raise NotImplementedError
+
+  @abstractmethod
+  def blame_hunks(self, rev, path):
+    """Blame a file, grouping lines by revision
+
+    Returns an iterator of BlameHunk tuples (rev, author, date, start_line,
+    line_count) in file order, each covering a run of consecutive lines last
+    changed in the same revision.  Line numbers start at 1.  Hunks from the
+    same revision share their author and date objects.
+
+    Raises PathDoesNotExist if the path does not exist.
+    Raises BadFileType if the path is not a file.
+
+    """
+    raise NotImplementedError
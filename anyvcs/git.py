@@ -26,25 +26,130 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import datetime
+import heapq
 import os
 import re
 import stat
 import subprocess
+import threading
 from .common import *
+from .gitgraph import CommitGraph
+from .gitstore import ObjectStore, RefStore, decode_tree_entries, \
+  encode_tree_entries, parse_header, tree_entries_size
 from .hashdict import HashDict
+from .lrucache import LRUCache
 
 GIT = 'git'
 
 rev_rx = re.compile(r'^[0-9a-f]{40}$', re.IGNORECASE)
 branch_rx = re.compile(r'^[*]?\s+(?P<name>.+)$')
 
+class CatFileBatch(object):
+  """A long-lived ``git cat-file --batch`` co-process
+
+  Requests are serialized with a lock, so one instance may be shared by
+  multiple threads.  The process is started on first use and restarted if it
+  dies.
+
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._proc = None
+
+  def _start(self):
+    cmd = [GIT, 'cat-file', '--batch']
+    self._proc = subprocess.Popen(cmd, cwd=self.path, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+
+  def _stop(self, kill=False):
+    p = self._proc
+    if p is None:
+      return
+    self._proc = None
+    try:
+      if kill and p.poll() is None:
+        p.kill()
+      p.stdin.close()
+    except (IOError, OSError):
+      pass
+    p.wait()
+    p.stdout.close()
+
+  def _request(self, spec):
+    p = self._proc
+    p.stdin.write(spec + b'\n')
+    p.stdin.flush()
+    header = p.stdout.readline()
+    if not header.endswith(b'\n'):
+      raise IOError('git cat-file exited unexpectedly')
+    # the spec is echoed back as-is, and may contain spaces
+    if header.endswith((b' missing\n', b' ambiguous\n')):
+      return None
+    objid, objtype, size = header.split()
+    size = int(size)
+    data = p.stdout.read(size + 1)
+    if len(data) != size + 1:
+      raise IOError('git cat-file exited unexpectedly')
+    return (objid.decode(), objtype.decode(), size, data[:-1])
+
+  def get(self, spec):
+    """Look up an object
+
+    :param spec: An object name as understood by ``git cat-file``, such as an
+                 object id or ``rev:path``, encoded as bytes.
+
+    Returns a tuple (objid, type, size, data), or None if the object does not
+    exist.
+
+    """
+    if b'\n' in spec:
+      raise ValueError('object name may not contain a newline')
+    with self._lock:
+      for attempt in range(2):
+        if self._proc is None or self._proc.poll() is not None:
+          self._stop()
+          self._start()
+        try:
+          return self._request(spec)
+        except (IOError, OSError):
+          self._stop(kill=True)
+          if attempt:
+            raise
+
+  def close(self):
+    """Terminate the co-process"""
+    with self._lock:
+      self._stop()
+
 class GitRepo(VCSRepo):
   """A git repository
 
   Valid revisions are anything that git considers as a revision.
 
+  Refs are read directly from the repository's ``packed-refs`` and loose ref
+  files.  Objects are read directly from its pack files and loose objects,
+  unless use_object_store is set to False.
+  Everything else is read through a long-lived ``git cat-file --batch``
+  process, which is shut down by close().
+
+  Parsed tree objects are kept in an LRU cache of up to tree_cache_size
+  bytes.  If tree_cache_on_disk is True, they are also stored under
+  private_path, where other processes can find them.
+
   """
 
+  tree_cache_size = 8 * 1024 * 1024
+  tree_cache_on_disk = False
+
+  _cat_file_lock = threading.Lock()
+  _objects_lock = threading.Lock()
+  _trees_lock = threading.Lock()
+  _refs_lock = threading.Lock()
+  _graph_lock = threading.Lock()
+
   @classmethod
   def create(cls, path, encoding='utf-8'):
     """Create a new bare repository"""
@@ -52,6 +157,10 @@ class GitRepo(VCSRepo):
     subprocess.check_call(cmd)
     return cls(path, encoding)
 
+  def __init__(self, path, encoding='utf-8'):
+    super(GitRepo, self).__init__(path, encoding)
+    self.use_object_store = True
+
   @property
   def private_path(self):
     """Get the path to a directory which can be used to store arbitrary data
@@ -78,67 +187,433 @@ class GitRepo(VCSRepo):
       self._object_cache_v = HashDict(object_cache_path)
       return self._object_cache_v
 
+  @property
+  def _cat_file(self):
+    try:
+      return self._cat_file_v
+    except AttributeError:
+      with self._cat_file_lock:
+        try:
+          return self._cat_file_v
+        except AttributeError:
+          self._cat_file_v = CatFileBatch(self.path)
+          return self._cat_file_v
+
+  @property
+  def _git_dir(self):
+    try:
+      return self._git_dir_v
+    except AttributeError:
+      dotgit = os.path.join(self.path, '.git')
+      if os.path.isdir(dotgit):
+        self._git_dir_v = dotgit
+      elif os.path.isfile(dotgit):
+        cmd = [GIT, 'rev-parse', '--git-dir']
+        output = self._command(cmd).decode().rstrip('\n')
+        self._git_dir_v = os.path.join(self.path, output)
+      else:
+        self._git_dir_v = self.path
+      return self._git_dir_v
+
+  @property
+  def _objects(self):
+    if not self.use_object_store:
+      return None
+    try:
+      return self._objects_v
+    except AttributeError:
+      with self._objects_lock:
+        try:
+          return self._objects_v
+        except AttributeError:
+          path = os.path.join(self._git_dir, 'objects')
+          self._objects_v = ObjectStore(path)
+          return self._objects_v
+
+  @property
+  def _trees(self):
+    try:
+      return self._trees_v
+    except AttributeError:
+      with self._trees_lock:
+        try:
+          return self._trees_v
+        except AttributeError:
+          self._trees_v = LRUCache(self.tree_cache_size, tree_entries_size)
+          return self._trees_v
+
+  @property
+  def _tree_disk_cache(self):
+    try:
+      return self._tree_disk_cache_v
+    except AttributeError:
+      tree_cache_path = os.path.join(self.private_path, 'tree-cache')
+      self._tree_disk_cache_v = HashDict(tree_cache_path)
+      return self._tree_disk_cache_v
+
+  def _tree(self, objid):
+    """Get the (mode, name, objid) entries of a tree from the object store
+
+    Raises KeyError if the object store is disabled or the tree is missing.
+
+    """
+    objects = self._objects
+    if objects is None:
+      raise KeyError(objid)
+    trees = self._trees
+    entries = trees.get(objid)
+    if entries is not None:
+      return entries
+    if self.tree_cache_on_disk:
+      try:
+        entries = decode_tree_entries(self._tree_disk_cache[objid])
+      except KeyError:
+        entries = objects.tree(objid)
+        self._tree_disk_cache[objid] = encode_tree_entries(entries)
+    else:
+      entries = objects.tree(objid)
+    trees[objid] = entries
+    return entries
+
+  @property
+  def _refs(self):
+    try:
+      return self._refs_v
+    except AttributeError:
+      with self._refs_lock:
+        try:
+          return self._refs_v
+        except AttributeError:
+          self._refs_v = RefStore(self._git_dir)
+          return self._refs_v
+
+  def _acquire_graph(self):
+    """Get the commit graph, acquired for the caller to release
+
+    A graph superseded by a rewrite of the repository's commit-graph files
+    is closed once its last user has released it.
+
+    """
+    info = os.path.join(self._git_dir, 'objects', 'info')
+    stamp = (stat_key(os.path.join(info, 'commit-graph')),
+             stat_key(os.path.join(info, 'commit-graphs', 'commit-graph-chain')))
+    with self._graph_lock:
+      graph = getattr(self, '_graph_v', None)
+      if graph is None or self._graph_stamp != stamp:
+        if graph is not None:
+          graph.retire()
+        index_path = os.path.join(self.private_path, 'commit-index')
+        graph = CommitGraph(os.path.dirname(info), index_path)
+        self._graph_v = graph
+        self._graph_stamp = stamp
+      graph.acquire()
+      return graph
+
+  @property
+  def _graph(self):
+    graph = self._acquire_graph()
+    graph.release()
+    return graph
+
+  def _commit_id(self, rev):
+    """Resolve a revision to a commit id without running git
+
+    Raises KeyError if that is not possible.
+
+    """
+    objects = self._objects
+    if objects is None:
+      raise KeyError(rev)
+    rev = str(rev)
+    if rev_rx.match(rev):
+      objid = rev.lower()
+    else:
+      objid = self._refs.resolve(rev)
+    try:
+      return self._peeled[objid]
+    except AttributeError:
+      self._peeled = {}
+    except KeyError:
+      pass
+    tag = None
+    while True:
+      objtype = objects.info(objid)[0]
+      if objtype == 'commit':
+        if tag is not None:
+          self._peeled[tag] = objid
+        return objid
+      if objtype != 'tag':
+        raise KeyError(rev)
+      tag = tag or objid
+      objid = parse_header(objects.read(objid)[1])['object'].decode()
+
+  def _tips(self):
+    """Get the commit ids of all refs and HEAD"""
+    if self._objects is None:
+      raise KeyError('use_object_store')
+    refs = self._refs
+    tips = set(refs.refs().values())
+    head = refs.head()
+    if head is not None:
+      tips.add(head)
+    results = set()
+    for objid in tips:
+      try:
+        results.add(self._commit_id(objid))
+      except KeyError:
+        pass
+    return results
+
+  def _graph_positions(self, revs):
+    """Map revisions to positions in the commit graph
+
+    Commits missing from the graph are added to its index, along with any
+    of their ancestors which are missing too.  Raises KeyError if a revision
+    cannot be resolved without running git.  The graph is returned acquired,
+    and the caller must release it.
+
+    """
+    commits = [self._commit_id(rev) for rev in revs]
+    graph = self._acquire_graph()
+    done = False
+    try:
+      missing = [c for c in commits if graph.lookup(c) is None]
+      if missing:
+        known = [c for c in self._tips() if graph.lookup(c) is not None]
+        input = ''.join(c + '\n' for c in missing)
+        input += ''.join('^' + c + '\n' for c in known)
+        cmd = [GIT, 'rev-list', '--parents', '--topo-order', '--reverse',
+               '--stdin']
+        lines = self._command_iter(cmd, input=input.encode('ascii'))
+        try:
+          graph.add((x[0], x[1:]) for x in (l.decode().split() for l in lines))
+        finally:
+          lines.close()
+      positions = [graph.lookup(c) for c in commits]
+      if None in positions:
+        raise KeyError(revs)
+      done = True
+      return graph, positions
+    finally:
+      if not done:
+        graph.release()
+
+  def close(self):
+    try:
+      cat_file = self._cat_file_v
+    except AttributeError:
+      pass
+    else:
+      cat_file.close()
+    try:
+      objects = self._objects_v
+    except AttributeError:
+      pass
+    else:
+      objects.close()
+    with self._graph_lock:
+      graph = getattr(self, '_graph_v', None)
+      if graph is not None:
+        del self._graph_v
+    if graph is not None:
+      graph.retire()
+
   def canonical_rev(self, rev):
     rev = str(rev)
     if rev_rx.match(rev):
       return rev
-    else:
+    try:
+      return self._refs.resolve(rev)
+    except KeyError:
       cmd = [GIT, 'rev-parse', rev]
       return self._command(cmd).decode().rstrip()
 
-  def ls(self, rev, path, recursive=False, recursive_dirs=False,
-         directory=False, report=()):
-    path = type(self).cleanPath(path)
-    forcedir = False
-    if path.endswith('/'):
-      forcedir = True
-      path = path.rstrip('/')
-    ltrim = len(path)
+  def canonical_rev_many(self, revs):
+    revs = [str(rev) for rev in revs]
+    results = []
+    missing = []
+    for i, rev in enumerate(revs):
+      if rev_rx.match(rev):
+        results.append(rev)
+        continue
+      try:
+        results.append(self._refs.resolve(rev))
+      except KeyError:
+        missing.append(i)
+        results.append(None)
+    for i in missing:
+      if '\n' in revs[i] or not revs[i]:
+        results[i] = RevisionDoesNotExist(revs[i])
+    missing = [i for i in missing if results[i] is None]
+    if missing:
+      # the remaining expressions are resolved by one cat-file process,
+      # which reports unknown names on their own line instead of failing
+      cmd = [GIT, 'cat-file', '--batch-check']
+      input = ''.join(revs[i] + '\n' for i in missing).encode(self.encoding)
+      lines = self._command_iter(cmd, b'\n', input)
+      try:
+        for i, line in zip(missing, lines):
+          fields = line.decode(self.encoding, 'replace').split()
+          if len(fields) == 3 and rev_rx.match(fields[0]):
+            results[i] = fields[0]
+          else:
+            results[i] = RevisionDoesNotExist(revs[i])
+      finally:
+        lines.close()
+    return results
 
-    # make sure the path exists
-    if path == '':
-      if directory:
-        entry = attrdict(path='/', type='d')
-        if 'commit' in report:
-          entry.commit = self.canonical_rev(rev)
-        return [entry]
+  def _store_lookup(self, rev, path):
+    """Find a path in the object store
+
+    path is given as bytes.  Returns a tuple (mode, objid), or raises KeyError
+    if the object store is disabled or cannot answer, in which case the git
+    command line tools should be used instead.
+
+    """
+    objects = self._objects
+    if objects is None:
+      raise KeyError(rev)
+    rev = str(rev)
+    if rev_rx.match(rev):
+      objid = rev
     else:
-      epath = path.rstrip('/').encode(self.encoding)
-      cmd = [GIT, 'ls-tree', '-z', rev, '--', epath]
-      output = self._command(cmd)
-      if not output:
-        raise PathDoesNotExist(rev, path)
-      meta, ename = output.split(b'\t', 1)
+      objid = self._refs.resolve(rev)
+    mode, objid = stat.S_IFDIR, objects.peel_tree(objid)
+    if path:
+      for name in path.split(b'/'):
+        if not stat.S_ISDIR(mode):
+          raise PathDoesNotExist(rev, path.decode(self.encoding, 'replace'))
+        for mode, ename, objid in self._tree(objid):
+          if ename == name:
+            break
+        else:
+          raise PathDoesNotExist(rev, path.decode(self.encoding, 'replace'))
+    return mode, objid
+
+  def _walk_tree(self, objid, prefix, recursive, recursive_dirs, size):
+    objects = self._objects
+    for mode, ename, objid in self._tree(objid):
+      name = prefix + ename
+      if stat.S_ISDIR(mode):
+        if not recursive or recursive_dirs:
+          yield (mode, objid, name, None)
+        if recursive:
+          for x in self._walk_tree(objid, name + b'/', recursive,
+                                   recursive_dirs, size):
+            yield x
+      elif size and stat.S_ISREG(mode):
+        yield (mode, objid, name, objects.info(objid)[1])
+      else:
+        yield (mode, objid, name, None)
+
+  def _ls_store(self, rev, path, forcedir, recursive, recursive_dirs,
+                directory, size):
+    epath = path.encode(self.encoding)
+    mode, objid = self._store_lookup(rev, epath)
+    if stat.S_ISDIR(mode):
+      if not directory:
+        prefix = epath + b'/' if epath else b''
+        return list(self._walk_tree(objid, prefix, recursive, recursive_dirs,
+                                    size))
+    elif forcedir:
+      raise PathDoesNotExist(rev, path)
+    elif size and stat.S_ISREG(mode):
+      return [(mode, objid, epath, self._objects.info(objid)[1])]
+    return [(mode, objid, epath, None)]
+
+  def _parse_ls_tree(self, output, size):
+    results = []
+    for line in output.rstrip(b'\0').split(b'\0'):
+      if not line:
+        continue
+      meta, ename = line.split(b'\t', 1)
       meta = meta.decode().split()
-      if meta[1] == 'tree':
-        if not (directory or path.endswith('/')):
-          path = path + '/'
-      elif forcedir:
+      mode = int(meta[0], 8)
+      if size and meta[3] != '-':
+        results.append((mode, meta[2], ename, int(meta[3])))
+      else:
+        results.append((mode, meta[2], ename, None))
+    return results
+
+  def _ls_tree_entry(self, rev, path, size=False):
+    """Look up a single path with git ls-tree
+
+    path is given as bytes.  Returns a tuple (mode, objid, path, size).
+
+    """
+    cmd = [GIT, 'ls-tree', '-z']
+    if size:
+      cmd.append('-l')
+    cmd.extend([rev, '--', path])
+    output = self._parse_ls_tree(self._command(cmd), size)
+    if not output:
+      raise PathDoesNotExist(rev, path.decode(self.encoding, 'replace'))
+    return output[0]
+
+  def _ls_command(self, rev, path, forcedir, recursive, recursive_dirs,
+                  directory, size):
+    epath = path.encode(self.encoding)
+    if directory:
+      entry = self._ls_tree_entry(rev, epath, size)
+      if forcedir and not stat.S_ISDIR(entry[0]):
         raise PathDoesNotExist(rev, path)
+      return [entry]
 
     cmd = [GIT, 'ls-tree', '-z']
     if recursive:
       cmd.append('-r')
       if recursive_dirs:
         cmd.append('-t')
-    if 'size' in report:
+    if size:
       cmd.append('-l')
-    epath = path.encode(self.encoding)
-    cmd.extend([rev, '--', epath])
-    output = self._command(cmd).rstrip(b'\0')
-    if not output:
-      return []
+    cmd.append(rev)
+    if not path:
+      return self._parse_ls_tree(self._command(cmd), size)
 
+    # asking for both the path and its contents tells files and directories
+    # apart without a separate lookup
+    cmd.extend(['--', epath, epath + b'/'])
+    prefix = epath + b'/'
     results = []
-    for line in output.split(b'\0'):
-      meta, ename = line.split(b'\t', 1)
-      meta = meta.decode().split()
-      mode = int(meta[0], 8)
-      objid = meta[2]
+    for entry in self._parse_ls_tree(self._command(cmd), size):
+      ename = entry[2]
+      if ename == epath and not stat.S_ISDIR(entry[0]):
+        if forcedir:
+          raise PathDoesNotExist(rev, path)
+        return [entry]
+      if ename.startswith(prefix):
+        results.append(entry)
+    if not results:
+      raise PathDoesNotExist(rev, path)
+    return results
+
+  def ls(self, rev, path, recursive=False, recursive_dirs=False,
+         directory=False, report=()):
+    path = type(self).cleanPath(path)
+    forcedir = False
+    if path.endswith('/'):
+      forcedir = True
+      path = path.rstrip('/')
+    ltrim = len(path)
+
+    if path == '' and directory:
+      entry = attrdict(path='/', type='d')
+      if 'commit' in report:
+        entry.commit = self.canonical_rev(rev)
+      return [entry]
+
+    args = (rev, path, forcedir, recursive, recursive_dirs, directory,
+            'size' in report)
+    try:
+      listing = self._ls_store(*args)
+    except KeyError:
+      listing = self._ls_command(*args)
+
+    results = []
+    lookup_commit = {}
+    for mode, objid, ename, size in listing:
       name = ename.decode(self.encoding, 'replace')
-      if recursive_dirs and path == name + '/':
-        continue
-      assert name.startswith(path), 'unexpected output: ' + str(line)
+      assert name.startswith(path), 'unexpected output: ' + name
       entry = attrdict(path=name)
       entry_name = name[ltrim:].lstrip('/')
       if entry_name:
@@ -150,50 +625,160 @@ class GitRepo(VCSRepo):
         if 'executable' in report:
           entry.executable = bool(mode & stat.S_IXUSR)
         if 'size' in report:
-          entry.size = int(meta[3])
+          entry.size = size
       elif stat.S_ISLNK(mode):
         entry.type = 'l'
         if 'target' in report:
-          entry.target = self._cat(rev, ename).decode(self.encoding, 'replace')
+          entry.target = self._blob(objid).decode(self.encoding, 'replace')
       else:
-        assert False, 'unexpected output: ' + str(line)
+        assert False, 'unexpected output: ' + name
       if 'commit' in report:
         try:
           entry.commit = self._object_cache[objid]
           entry._commit_cached = True
         except KeyError:
-          ename = name.encode(self.encoding)
-          cmd = [GIT, 'log', '--pretty=format:%H', '-1', rev, '--', ename]
-          commit = self._command(cmd).decode()
-          entry.commit = self._object_cache[objid] = commit
+          lookup_commit.setdefault(ename, []).append((entry, objid))
       results.append(entry)
 
+    if lookup_commit:
+      for ename, commit in self._last_commits(rev, list(lookup_commit)):
+        for entry, objid in lookup_commit.pop(ename):
+          entry.commit = self._object_cache[objid] = commit
+      # anything left over was not found by the combined history walk
+      for ename, entries in lookup_commit.items():
+        cmd = [GIT, 'log', '--pretty=format:%H', '-1', rev, '--', ename]
+        commit = self._command(cmd).decode()
+        for entry, objid in entries:
+          entry.commit = self._object_cache[objid] = commit
+
     return results
 
-  def _cat(self, rev, path):
-    rp = rev.encode('ascii') + b':' + path
-    cmd = [GIT, 'cat-file', 'blob', rp]
-    return self._command(cmd)
+  def _last_commits(self, rev, paths):
+    """Find the most recent commit touching each path
 
-  def cat(self, rev, path):
-    path = type(self).cleanPath(path)
-    ls = self.ls(rev, path, directory=True)
-    assert len(ls) == 1
-    if ls[0].get('type') != 'f':
+    A single history walk is done for all paths, which stops as soon as every
+    path has been resolved.  Yields (path, commit) tuples, where path is one
+    of the given paths (as bytes).
+
+    """
+    unresolved = set(paths)
+    cmd = [GIT, 'log', '-z', '--pretty=tformat:%x01%H', '--name-only', '-c',
+           '--stdin']
+    input = rev.encode('ascii') + b'\n--\n' + b'\n'.join(paths) + b'\n'
+    records = self._command_iter(cmd, b'\0', input)
+    try:
+      commit = None
+      for record in records:
+        if record.startswith(b'\x01'):
+          commit = record[1:].decode()
+          continue
+        name = record.lstrip(b'\n')
+        while name:
+          if name in unresolved:
+            unresolved.remove(name)
+            yield (name, commit)
+          name = name.rpartition(b'/')[0]
+        if not unresolved:
+          break
+    finally:
+      records.close()
+
+  def _blob(self, spec, rev=None, path=None):
+    objects = self._objects
+    if objects is not None and rev_rx.match(str(spec)):
+      try:
+        objtype, data = objects.read(spec)
+      except KeyError:
+        pass
+      else:
+        if objtype != 'blob':
+          raise BadFileType(rev, path)
+        return data
+    if isinstance(spec, str):
+      spec = spec.encode('ascii')
+    try:
+      obj = self._cat_file.get(spec)
+    except ValueError:
+      cmd = [GIT, 'cat-file', 'blob', spec]
+      return self._command(cmd)
+    if obj is None:
+      raise PathDoesNotExist(rev, path)
+    objid, objtype, size, data = obj
+    if objtype != 'blob':
       raise BadFileType(rev, path)
-    epath = path.encode(self.encoding, 'strict')
-    return self._cat(rev, epath)
+    return data
 
-  def readlink(self, rev, path):
+  def _resolve(self, rev, path):
+    """Find a path in a revision
+
+    path is given as bytes.  Returns a tuple (mode, objid), using the object
+    store if possible and a single git ls-tree otherwise.
+
+    """
+    try:
+      return self._store_lookup(rev, path)
+    except KeyError:
+      pass
+    if not path:
+      cmd = [GIT, 'rev-parse', rev + '^{tree}']
+      return stat.S_IFDIR, self._command(cmd).decode().rstrip()
+    return self._ls_tree_entry(rev, path)[:2]
+
+  def _resolve_blob(self, rev, path, test):
+    """Find a path that must pass test(mode); returns (path, objid)"""
     path = type(self).cleanPath(path)
-    ls = self.ls(rev, path, directory=True)
-    assert len(ls) == 1
-    if ls[0].get('type') != 'l':
+    if path.endswith('/'):
+      raise PathDoesNotExist(rev, path)
+    mode, objid = self._resolve(str(rev), path.encode(self.encoding, 'strict'))
+    if not test(mode):
       raise BadFileType(rev, path)
-    epath = path.encode(self.encoding, 'strict')
-    return self._cat(rev, epath).decode(self.encoding, 'replace')
+    return path, objid
+
+  def _cat(self, rev, path):
+    try:
+      mode, objid = self._store_lookup(rev, path)
+    except KeyError:
+      pass
+    else:
+      return self._blob(objid, rev, path.decode(self.encoding, 'replace'))
+    rp = rev.encode('ascii') + b':' + path
+    return self._blob(rp, rev, path.decode(self.encoding, 'replace'))
+
+  def cat(self, rev, path, offset=0, length=None):
+    if offset or length is not None:
+      return self._cat_range(rev, path, offset, length)
+    path, objid = self._resolve_blob(rev, path, stat.S_ISREG)
+    return self._blob(objid, rev, path)
+
+  def cat_stream(self, rev, path, offset=0, length=None):
+    path, objid = self._resolve_blob(rev, path, stat.S_ISREG)
+    objects = self._objects
+    if objects is not None:
+      try:
+        objtype, size, stream = objects.open(objid)
+      except KeyError:
+        pass
+      else:
+        return self._stream_range(stream, offset, length)
+    cmd = [GIT, 'cat-file', 'blob', objid]
+    return self._stream_range(CommandStream(cmd, cwd=self.path), offset, length)
+
+  def readlink(self, rev, path):
+    path, objid = self._resolve_blob(rev, path, stat.S_ISLNK)
+    return self._blob(objid, rev, path).decode(self.encoding, 'replace')
+
+  def _ref_names(self, prefix):
+    try:
+      refs = self._refs.refs()
+    except KeyError:
+      return None
+    return sorted(name[len(prefix):] for name in refs
+                  if name.startswith(prefix))
 
   def branches(self):
+    results = self._ref_names('refs/heads/')
+    if results is not None:
+      return results
     cmd = [GIT, 'branch']
     output = self._command(cmd).decode(self.encoding, 'replace')
     results = []
@@ -204,6 +789,9 @@ class GitRepo(VCSRepo):
     return results
 
   def tags(self):
+    results = self._ref_names('refs/tags/')
+    if results is not None:
+      return results
     cmd = [GIT, 'tag']
     output = self._command(cmd).decode(self.encoding, 'replace')
     return output.splitlines()
@@ -212,6 +800,10 @@ class GitRepo(VCSRepo):
     return self.branches() + self.tags()
 
   def empty(self):
+    try:
+      return self._refs.head() is None
+    except KeyError:
+      pass
     cmd = [GIT, 'rev-parse', 'HEAD']
     p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
@@ -219,6 +811,11 @@ class GitRepo(VCSRepo):
     return not rev_rx.match(stdout.decode())
 
   def __contains__(self, rev):
+    try:
+      self._commit_id(rev)
+      return True
+    except KeyError:
+      pass
     cmd = [GIT, 'rev-list', '-n', '1', rev]
     p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
@@ -226,14 +823,65 @@ class GitRepo(VCSRepo):
     return p.returncode == 0
 
   def __len__(self):
-    cmd = [GIT, 'rev-list', '--all']
+    try:
+      refs = self._refs
+      key = sorted(set(refs.refs().values()))
+      key.append(str(refs.head()))
+      key = ' '.join(key)
+      cached = self._load_len_cache()
+      if cached and cached[0] == key:
+        return cached[1]
+      tips = sorted(self._tips())
+    except KeyError:
+      return self._len()
+    count = None
+    if cached and cached[2]:
+      count = self._len_update(cached[1], cached[2], tips)
+    if count is None:
+      count = self._len(tips)
+    self._save_len_cache(key, count, tips)
+    return count
+
+  def _len_update(self, count, old_tips, new_tips):
+    """Update a commit count after refs changed
+
+    This is only possible if no commits became unreachable, as when refs were
+    only added or fast-forwarded; otherwise None is returned.
+
+    """
+    cmd = [GIT, 'rev-list', '--count', '--stdin']
+    input = ''.join(c + '\n' for c in old_tips)
+    input += ''.join('^' + c + '\n' for c in new_tips)
+    try:
+      removed = b''.join(self._command_iter(cmd, input=input.encode('ascii')))
+    except subprocess.CalledProcessError:
+      # old tips may have been pruned
+      return None
+    if int(removed) != 0 or not new_tips:
+      return None
+    input = ''.join(c + '\n' for c in new_tips)
+    input += ''.join('^' + c + '\n' for c in old_tips)
+    added = b''.join(self._command_iter(cmd, input=input.encode('ascii')))
+    return count + int(added)
+
+  def _len(self, tips=None):
+    if tips is not None:
+      try:
+        graph, positions = self._graph_positions(tips)
+      except KeyError:
+        pass
+      else:
+        try:
+          return graph.count(positions)
+        finally:
+          graph.release()
+    cmd = [GIT, 'rev-list', '--count', '--all']
     p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
     stdout, stderr = p.communicate()
-    return len(stdout.splitlines())
+    return int(stdout or 0)
 
-  def log(self, revrange=None, limit=None, firstparent=False, merges=None,
-          path=None, follow=False):
+  def _log_cmd(self, revargs, limit, firstparent, merges, path, follow):
     cmd = [GIT, 'log', '-z', '--pretty=format:%H%n%P%n%ai%n%an <%ae>%n%B', '--encoding=none']
     if limit is not None:
       cmd.append('-' + str(limit))
@@ -244,67 +892,149 @@ class GitRepo(VCSRepo):
         cmd.append('--merges')
       else:
         cmd.append('--no-merges')
-    single = False
+    cmd.extend(revargs)
+    if path:
+      if follow:
+        cmd.append('--follow')
+      cmd.extend(['--', type(self).cleanPath(path)])
+    return cmd
+
+  def _logentry(self, record):
+    log = record.decode(self.encoding, 'replace')
+    rev, parents, date, author, message = log.split('\n', 4)
+    parents = parents.split()
+    date = parse_isodate(date)
+    entry = CommitLogEntry(rev, parents, date, author, message)
+    if rev not in self._commit_cache:
+      self._commit_cache[rev] = entry
+    return entry
+
+  def log(self, revrange=None, limit=None, firstparent=False, merges=None,
+          path=None, follow=False):
+    if revrange is None or isinstance(revrange, (tuple, list)):
+      return list(self.iter_log(revrange, limit, firstparent, merges, path,
+                                follow))
+    entry = self._commit_cache.get(self.canonical_rev(revrange))
+    if entry:
+      entry._cached = True
+      return entry
+    cmd = self._log_cmd(['-1', revrange], limit, firstparent, merges, path,
+                        follow)
+    return self._logentry(self._command(cmd))
+
+  def iter_log(self, revrange=None, limit=None, firstparent=False,
+               merges=None, path=None, follow=False):
     if revrange is None:
       if self.empty():
-        return []
-      cmd.append('--all')
+        return
+      revargs = ['--all']
     elif isinstance(revrange, (tuple, list)):
       if revrange[0] is None:
         if revrange[1] is None:
           if self.empty():
-            return []
-          cmd.append('--all')
+            return
+          revargs = ['--all']
         else:
-          cmd.append(revrange[1])
+          revargs = [revrange[1]]
       else:
         if revrange[1] is None:
-          cmd.append(revrange[0] + '..')
+          revargs = [revrange[0] + '..']
         else:
-          cmd.append(revrange[0] + '..' + revrange[1])
+          revargs = [revrange[0] + '..' + revrange[1]]
     else:
-      entry = self._commit_cache.get(self.canonical_rev(revrange))
-      if entry:
-        entry._cached = True
-        return entry
-      cmd.extend(['-1', revrange])
-      single = True
-    if path:
-      if follow:
-        cmd.append('--follow')
-      cmd.extend(['--', type(self).cleanPath(path)])
-    output = self._command(cmd).decode(self.encoding, 'replace')
+      yield self.log(revrange, limit, firstparent, merges, path, follow)
+      return
+    cmd = self._log_cmd(revargs, limit, firstparent, merges, path, follow)
+    records = self._command_iter(cmd, b'\0')
+    try:
+      for record in records:
+        yield self._logentry(record)
+    finally:
+      records.close()
 
-    results = []
-    for log in output.split('\0'):
-      rev, parents, date, author, message = log.split('\n', 4)
-      parents = parents.split()
-      date = parse_isodate(date)
-      entry = CommitLogEntry(rev, parents, date, author, message)
-      if rev not in self._commit_cache:
-        self._commit_cache[rev] = entry
-      if single:
-        return entry
-      results.append(entry)
-    return results
+  def _change_info(self, meta, paths):
+    status = meta.split()[4].decode()[0]
+    src_path = paths[0].decode(self.encoding, 'replace')
+    if len(paths) == 2:
+      dst_path = paths[1].decode(self.encoding, 'replace')
+      return FileChangeInfo(dst_path, str(status), src_path)
+    else:
+      return FileChangeInfo(src_path, str(status))
+
+  def _iter_changes(self, records):
+    """Group diff-tree -z output records by commit
+
+    Yields (commit, changes) pairs.  diff-tree repeats a merge's id before
+    the changes against each parent; those are folded into one pair.
+
+    """
+    commit = None
+    results = None
+    for record in records:
+      if record.startswith(b':'):
+        meta = record[1:]
+        paths = [next(records)]
+        if meta.split()[4][:1] in (b'C', b'R'):
+          paths.append(next(records))
+        results.append(self._change_info(meta, paths))
+      elif record and record.decode() != commit:
+        if results is not None:
+          yield commit, results
+        commit = record.decode()
+        results = []
+    if results is not None:
+      yield commit, results
 
   def changed(self, rev):
     cmd = [GIT, 'diff-tree', '-z', '-C', '-r', '-m', '--first-parent', '--root', rev]
     output = self._command(cmd)
     results = []
-    for line in output.rstrip(b'\0').split(b'\0:')[1:]:
-      path = line.split(b'\0')
-      meta = path.pop(0).split()
-      status = meta[3].decode()[0]
-      src_path = path[0].decode(self.encoding, 'replace')
-      if len(path) == 2:
-        dst_path = path[1].decode(self.encoding, 'replace')
-        entry = FileChangeInfo(dst_path, str(status), src_path)
-      else:
-        entry = FileChangeInfo(src_path, str(status))
-      results.append(entry)
+    for commit, changes in self._iter_changes(iter(output.split(b'\0'))):
+      results.extend(changes)
     return results
 
+  def _peel_commits(self, revs):
+    commits = []
+    missing = []
+    for rev in revs:
+      try:
+        commits.append(self._commit_id(rev))
+      except KeyError:
+        missing.append(len(commits))
+        commits.append(None)
+    if missing:
+      cmd = [GIT, 'rev-parse']
+      cmd.extend('%s^{commit}' % revs[i] for i in missing)
+      output = self._command(cmd).decode().split()
+      for i, objid in zip(missing, output):
+        commits[i] = objid
+    return commits
+
+  def changed_many(self, revs):
+    revs = list(revs)
+    if not revs:
+      return
+    # repeated revisions are only asked for once, since diff-tree's output
+    # could not tell them apart from a merge
+    groups = []
+    for rev, commit in zip(revs, self._peel_commits(revs)):
+      if groups and groups[-1][0] == commit:
+        groups[-1][1].append(rev)
+      else:
+        groups.append((commit, [rev]))
+    cmd = [GIT, 'diff-tree', '--stdin', '--always', '-z', '-C', '-r', '-m',
+           '--first-parent', '--root']
+    input = ''.join(commit + '\n' for commit, group in groups).encode()
+    records = self._command_iter(cmd, b'\0', input)
+    try:
+      changes = self._iter_changes(records)
+      for (commit, group), (c, results) in zip(groups, changes):
+        assert c == commit, 'unexpected output: ' + c
+        for rev in group:
+          yield rev, results
+    finally:
+      records.close()
+
   def pdiff(self, rev):
     cmd = [GIT, 'diff-tree', '-p', '-r', '-m', '--first-parent', '--root', rev]
     return self._command(cmd)
@@ -315,7 +1045,61 @@ class GitRepo(VCSRepo):
       cmd.extend(['--', type(self).cleanPath(path)])
     return self._command(cmd)
 
+  def _is_diff_header(self, line, next_line):
+    return line.startswith(b'diff --git ')
+
+  def iter_pdiff(self, rev):
+    cmd = [GIT, 'diff-tree', '-p', '-r', '-m', '--first-parent', '--root', rev]
+    return self._iter_file_diffs(cmd, self._is_diff_header)
+
+  def iter_diff(self, rev_a, rev_b, path=None):
+    cmd = [GIT, 'diff', rev_a, rev_b]
+    if path is not None:
+      cmd.extend(['--', type(self).cleanPath(path)])
+    return self._iter_file_diffs(cmd, self._is_diff_header)
+
+  def diffstat(self, rev_a, rev_b=None):
+    if rev_b is None:
+      key = 'git:%s' % self.canonical_rev(rev_a)
+      cmd = [GIT, 'diff-tree', '--numstat', '-z', '--no-commit-id', '-r',
+             '-m', '--first-parent', '--root', rev_a]
+    else:
+      key = 'git:%s:%s' % (self.canonical_rev(rev_a),
+                           self.canonical_rev(rev_b))
+      cmd = [GIT, 'diff', '--numstat', '-z', rev_a, rev_b]
+    return self._cached_diffstat(key, lambda: self._numstat(cmd))
+
+  def _numstat(self, cmd):
+    results = []
+    records = self._command_iter(cmd, b'\0')
+    try:
+      for record in records:
+        if not record:
+          continue
+        added, removed, path = record.split(b'\t', 2)
+        if not path:
+          # renames and copies are followed by the old and new paths
+          next(records)
+          path = next(records)
+        binary = added == b'-'
+        results.append(DiffStat(path.decode(self.encoding, 'replace'),
+                                0 if binary else int(added),
+                                0 if binary else int(removed), binary))
+    finally:
+      records.close()
+    return results
+
   def ancestor(self, rev1, rev2):
+    try:
+      graph, (a, b) = self._graph_positions([rev1, rev2])
+    except KeyError:
+      pass
+    else:
+      try:
+        bases = graph.merge_bases(a, b)
+        return graph.oid(bases[0]) if bases else None
+      finally:
+        graph.release()
     cmd = [GIT, 'merge-base', rev1, rev2]
     p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
@@ -327,30 +1111,101 @@ class GitRepo(VCSRepo):
     else:
       raise subprocess.CalledProcessError(p.returncode, cmd, stderr)
 
+  def is_ancestor(self, rev1, rev2):
+    """Check whether rev1 is an ancestor of rev2
+
+    A commit is considered to be an ancestor of itself.
+
+    """
+    try:
+      graph, (a, b) = self._graph_positions([rev1, rev2])
+    except KeyError:
+      pass
+    else:
+      try:
+        return graph.is_ancestor(a, b)
+      finally:
+        graph.release()
+    cmd = [GIT, 'merge-base', '--is-ancestor', rev1, rev2]
+    p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode == 0:
+      return True
+    elif p.returncode == 1:
+      return False
+    else:
+      raise subprocess.CalledProcessError(p.returncode, cmd, stderr)
+
+  def _blame_check(self, rev, path):
+    return self._resolve_blob(rev, path, stat.S_ISREG)[0]
+
+  def _blame_meta(self, info):
+    author = info['author'] + ' ' + info['author-mail']
+    ts = int(info['author-time'])
+    tz = UTCOffset(str(info['author-tz']))
+    return author, datetime.datetime.fromtimestamp(ts, tz)
+
   def blame(self, rev, path):
-    path = type(self).cleanPath(path)
-    ls = self.ls(rev, path, directory=True)
-    assert len(ls) == 1
-    if ls[0].get('type') != 'f':
-      raise BadFileType(rev, path)
-    cmd = [GIT, 'blame', '--root', '--encoding=none', '-p', rev, '--', path]
-    output = self._command(cmd)
-    rev = None
+    path = self._blame_check(rev, path)
+    hunks = self._cached_blame_hunks_for(rev, path)
+    data = self._cat(rev, path.encode(self.encoding))
+    return blame_lines(hunks, data.splitlines())
+
+  def blame_hunks(self, rev, path):
+    path = self._blame_check(rev, path)
+    return self._cached_blame_hunks_for(rev, path)
+
+  def _cached_blame_hunks_for(self, rev, path):
+    rev = self.canonical_rev(rev)
+    def identity():
+      # the blame of a file is the same as at the last commit that touched it
+      epath = path.encode(self.encoding)
+      for name, commit in self._last_commits(rev, [epath]):
+        return 'git:%s:%s' % (commit, path)
+    return self._cached_blame_hunks('git:%s:%s' % (rev, path), identity,
+                                    lambda: self._blame_hunks(rev, path))
+
+  def _blame_hunks(self, rev, path):
+    # --incremental reports hunks as soon as they are resolved, in no
+    # particular order, so they are held back until the ones before them
+    # have arrived
+    cmd = [GIT, 'blame', '--root', '--encoding=none', '--incremental', rev,
+           '--', path]
+    lines = self._command_iter(cmd)
     revinfo = {}
-    results = []
-    for line in output.splitlines():
-      if line.startswith(b'\t'):
-        ri = revinfo[rev]
-        author = ri['author'] + ' ' + ri['author-mail']
-        ts = int(ri['author-time'])
-        tz = UTCOffset(str(ri['author-tz']))
-        date = datetime.datetime.fromtimestamp(ts, tz)
-        entry = BlameInfo(rev, author, date, line[1:])
-        results.append(entry)
-      else:
-        k, v = line.decode(self.encoding, 'replace').split(None, 1)
-        if rev_rx.match(k):
-          rev = k
-        else:
-          revinfo.setdefault(rev, {})[k] = v
-    return results
+    revmeta = {}
+    pending = []
+    next_line = 1
+    last = None
+    hunk = None
+    try:
+      for line in lines:
+        if hunk is None:
+          fields = line.decode().split()
+          hunk = (int(fields[2]), int(fields[3]), fields[0])
+          info = revinfo.setdefault(fields[0], {})
+          continue
+        k, _, v = line.partition(b' ')
+        if k != b'filename':
+          info[k.decode()] = v.decode(self.encoding, 'replace')
+          continue
+        heapq.heappush(pending, hunk)
+        hunk = None
+        while pending and pending[0][0] == next_line:
+          start, count, commit = heapq.heappop(pending)
+          next_line += count
+          if last is not None and last.rev == commit:
+            last = last._replace(line_count=last.line_count + count)
+            continue
+          if last is not None:
+            yield last
+          try:
+            author, date = revmeta[commit]
+          except KeyError:
+            author, date = revmeta[commit] = self._blame_meta(revinfo[commit])
+          last = BlameHunk(commit, author, date, start, count)
+    finally:
+      lines.close()
+    if last is not None:
+      yield last
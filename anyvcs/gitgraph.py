@@ -0,0 +1,381 @@
+# Copyright (c) 2013, Clemson University
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the {organization} nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""An in-memory commit ancestry index for git repositories
+
+Commits are looked up in the repository's commit-graph files when present.
+Commits they do not cover are kept in an append-only index file, which holds
+each commit's id followed by the ids of its parents.  Commits are identified
+by their position in the graph; ids are only used at the edges.
+
+"""
+
+import binascii
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+GRAPH_LAST_EDGE = 0x80000000
+
+# merge-base paint flags
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+
+class GraphFile(object):
+  """A single commit-graph file
+
+  :param path: The path of the file.
+  :param base: The position of the file's first commit in the whole graph,
+               for files which are layers of a split commit-graph.
+
+  """
+
+  def __init__(self, path, base=0):
+    with open(path, 'rb') as f:
+      self._map = m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if m[:4] != b'CGPH':
+      raise ValueError('%s: not a commit-graph file' % path)
+    version, hash_version, nchunks = struct.unpack('>BBB', m[4:7])
+    if version != 1 or hash_version != 1:
+      raise ValueError('%s: unsupported commit-graph version' % path)
+    chunks = {}
+    for i in range(nchunks):
+      pos = 8 + 12 * i
+      chunk_id = m[pos:pos+4]
+      offset, = struct.unpack('>Q', m[pos+4:pos+12])
+      chunks[chunk_id] = offset
+    fanout = chunks[b'OIDF']
+    self._fanout = struct.unpack('>256I', m[fanout:fanout+1024])
+    self.count = self._fanout[255]
+    self._oids = chunks[b'OIDL']
+    self._data = chunks[b'CDAT']
+    self._edges = chunks.get(b'EDGE')
+    self.base = base
+    if self.count and self.commit(base)[1] == 0:
+      # written without generation numbers
+      raise ValueError('%s: no generation numbers' % path)
+
+  def oid(self, i):
+    pos = self._oids + 20 * i
+    return self._map[pos:pos+20]
+
+  def find(self, binsha):
+    """Get the position of a commit, or None if it is not in this file"""
+    first = bytearray(binsha[:1])[0]
+    lo = self._fanout[first-1] if first else 0
+    hi = self._fanout[first]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      oid = self.oid(mid)
+      if oid < binsha:
+        lo = mid + 1
+      elif oid > binsha:
+        hi = mid
+      else:
+        return self.base + mid
+    return None
+
+  def commit(self, pos):
+    """Get the (parents, generation) of the commit at a graph position"""
+    offset = self._data + 36 * (pos - self.base) + 20
+    p1, p2, gen = struct.unpack('>III', self._map[offset:offset+12])
+    parents = []
+    if p1 != GRAPH_PARENT_NONE:
+      parents.append(p1)
+    if p2 & GRAPH_EXTRA_EDGES:
+      edge = self._edges + 4 * (p2 & ~GRAPH_EXTRA_EDGES)
+      while True:
+        p, = struct.unpack('>I', self._map[edge:edge+4])
+        parents.append(p & ~GRAPH_LAST_EDGE)
+        if p & GRAPH_LAST_EDGE:
+          break
+        edge += 4
+    elif p2 != GRAPH_PARENT_NONE:
+      parents.append(p2)
+    return tuple(parents), gen >> 2
+
+  def close(self):
+    self._map.close()
+
+def load_graph_files(objects_path):
+  """Open the commit-graph files of a repository, base layer first"""
+  info = os.path.join(objects_path, 'info')
+  chain = os.path.join(info, 'commit-graphs', 'commit-graph-chain')
+  if os.path.exists(chain):
+    with open(chain) as f:
+      paths = [os.path.join(info, 'commit-graphs', 'graph-%s.graph' % h)
+               for h in f.read().split()]
+  else:
+    paths = [os.path.join(info, 'commit-graph')]
+  layers = []
+  base = 0
+  try:
+    for path in paths:
+      if not os.path.exists(path):
+        break
+      layer = GraphFile(path, base)
+      layers.append(layer)
+      base += layer.count
+  except (IOError, KeyError, ValueError, struct.error):
+    for layer in layers:
+      layer.close()
+    return []
+  return layers
+
+class CommitGraph(object):
+  """Commit ancestry queries answered in memory
+
+  :param objects_path: The repository's ``objects`` directory.
+  :param index_path: The path of the index file for commits not covered by
+                     the repository's commit-graph files.
+
+  """
+
+  def __init__(self, objects_path, index_path):
+    self.index_path = index_path
+    self._lock = threading.Lock()
+    self._users_lock = threading.Lock()
+    self._users = 0
+    self._retired = False
+    self._layers = load_graph_files(objects_path)
+    self._graph_count = sum(layer.count for layer in self._layers)
+    self._extra = {}
+    self._extra_oids = []
+    self._extra_commits = []
+    self._index_size = 0
+    try:
+      with open(index_path, 'rb') as f:
+        self._read_index(f)
+    except IOError:
+      pass
+
+  def __len__(self):
+    return self._graph_count + len(self._extra_oids)
+
+  def _read_index(self, f):
+    f.seek(self._index_size)
+    data = f.read()
+    pos = 0
+    end = len(data)
+    while pos + 21 <= end:
+      nparents = bytearray(data[pos+20:pos+21])[0]
+      next = pos + 21 + 20 * nparents
+      if next > end:
+        break
+      parents = [data[p:p+20] for p in range(pos + 21, next, 20)]
+      try:
+        self._add(data[pos:pos+20], parents)
+      except KeyError:
+        # written before unknown parents were refused; leave the commit
+        # out so that queries about it go to git
+        pass
+      pos = next
+    self._index_size += pos
+
+  def _add(self, binsha, parents):
+    if self._find(binsha) is not None:
+      return
+    positions = []
+    gen = 0
+    for parent in parents:
+      p = self._find(parent)
+      if p is None:
+        # e.g. the boundary of a shallow or grafted history, which would
+        # give wrong generations and counts
+        raise KeyError(binascii.hexlify(parent).decode())
+      positions.append(p)
+      gen = max(gen, self.commit(p)[1])
+    self._extra[binsha] = len(self)
+    self._extra_oids.append(binsha)
+    self._extra_commits.append((tuple(positions), gen + 1))
+
+  def add(self, commits):
+    """Add commits to the index file
+
+    commits is an iterable of (objid, parent objids) tuples, in which every
+    commit comes after its parents.  Raises KeyError if a parent is neither
+    in the graph nor among the commits before it; the commits before that
+    one are still added.
+
+    """
+    with self._lock:
+      with open(self.index_path, 'a+b') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+          # pick up anything appended by other processes first
+          self._read_index(f)
+          records = []
+          try:
+            for objid, parents in commits:
+              binsha = binascii.unhexlify(objid)
+              if self._find(binsha) is not None:
+                continue
+              parents = [binascii.unhexlify(p) for p in parents]
+              self._add(binsha, parents)
+              records.append(binsha + struct.pack('B', len(parents)) +
+                             b''.join(parents))
+          finally:
+            f.seek(0, os.SEEK_END)
+            data = b''.join(records)
+            f.write(data)
+            f.flush()
+            self._index_size += len(data)
+        finally:
+          fcntl.lockf(f, fcntl.LOCK_UN)
+
+  def _find(self, binsha):
+    for layer in self._layers:
+      pos = layer.find(binsha)
+      if pos is not None:
+        return pos
+    return self._extra.get(binsha)
+
+  def lookup(self, objid):
+    """Get the position of a commit given its hex id, or None"""
+    try:
+      return self._find(binascii.unhexlify(objid))
+    except (TypeError, ValueError):
+      return None
+
+  def oid(self, pos):
+    """Get the hex id of the commit at a position"""
+    if pos >= self._graph_count:
+      binsha = self._extra_oids[pos - self._graph_count]
+    else:
+      for layer in self._layers:
+        if pos < layer.base + layer.count:
+          binsha = layer.oid(pos - layer.base)
+          break
+    return binascii.hexlify(binsha).decode()
+
+  def commit(self, pos):
+    """Get the (parents, generation) of the commit at a position"""
+    if pos >= self._graph_count:
+      return self._extra_commits[pos - self._graph_count]
+    for layer in self._layers:
+      if pos < layer.base + layer.count:
+        return layer.commit(pos)
+
+  def is_ancestor(self, a, b):
+    """Check whether commit a is an ancestor of (or the same as) commit b"""
+    if a == b:
+      return True
+    min_gen = self.commit(a)[1]
+    seen = set([b])
+    stack = [b]
+    while stack:
+      parents, gen = self.commit(stack.pop())
+      for p in parents:
+        if p == a:
+          return True
+        if p not in seen:
+          seen.add(p)
+          if self.commit(p)[1] > min_gen:
+            stack.append(p)
+    return False
+
+  def merge_bases(self, a, b):
+    """Find the best common ancestors of commits a and b
+
+    Commits are visited in order of decreasing generation number, so each
+    commit's flags are complete by the time it is visited.
+
+    """
+    if a == b:
+      return [a]
+    flags = {a: PARENT1, b: PARENT2}
+    queue = [(-self.commit(a)[1], a), (-self.commit(b)[1], b)]
+    heapq.heapify(queue)
+    nonstale = 2
+    results = []
+    while nonstale:
+      negen, pos = heapq.heappop(queue)
+      f = flags[pos]
+      if not f & STALE:
+        nonstale -= 1
+        if f & (PARENT1 | PARENT2) == PARENT1 | PARENT2:
+          results.append(pos)
+          f |= STALE
+      for p in self.commit(pos)[0]:
+        old = flags.get(p)
+        if old is None:
+          flags[p] = f
+          heapq.heappush(queue, (-self.commit(p)[1], p))
+          if not f & STALE:
+            nonstale += 1
+        elif old | f != old:
+          flags[p] = old | f
+          if f & STALE and not old & STALE:
+            nonstale -= 1
+    if len(results) > 1:
+      results = [x for x in results
+                 if not any(y != x and self.is_ancestor(x, y) for y in results)]
+    return results
+
+  def count(self, tips):
+    """Count the commits reachable from any of the given positions"""
+    seen = set(tips)
+    stack = list(seen)
+    while stack:
+      for p in self.commit(stack.pop())[0]:
+        if p not in seen:
+          seen.add(p)
+          stack.append(p)
+    return len(seen)
+
+  def acquire(self):
+    """Mark the graph as in use, so that retire() does not close it"""
+    with self._users_lock:
+      self._users += 1
+
+  def release(self):
+    """Undo acquire(), closing the graph if it was retired meanwhile"""
+    with self._users_lock:
+      self._users -= 1
+      close = self._retired and not self._users
+    if close:
+      self.close()
+
+  def retire(self):
+    """Close the graph as soon as nothing is using it"""
+    with self._users_lock:
+      self._retired = True
+      close = not self._users
+    if close:
+      self.close()
+
+  def close(self):
+    for layer in self._layers:
+      layer.close()
+    self._layers = []
@@ -0,0 +1,766 @@
+# Copyright (c) 2013, Clemson University
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the {organization} nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Read-only access to a git object database and refs without running git
+
+Objects are read from the pack files (through their ``.idx`` indices) and
+loose object files of a repository's ``objects`` directory, and refs from
+``packed-refs`` and the loose ``refs`` tree.  Anything this module does not
+understand is reported as a KeyError, so that callers can fall back to the
+git command line tools.
+
+"""
+
+import binascii
+import errno
+import io
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from .common import stat_key
+from .lrucache import LRUCache
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+# revisions which are not plain ref names, and are left to git rev-parse
+not_refname_rx = re.compile(r'[\x00-\x20~^:?*\[\\\x7f]|\.\.|@\{|^[-/]|/$|\.lock$')
+
+type_names = {
+  OBJ_COMMIT: 'commit',
+  OBJ_TREE: 'tree',
+  OBJ_BLOB: 'blob',
+  OBJ_TAG: 'tag',
+}
+
+def _map(path):
+  with open(path, 'rb') as f:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _delta_size(delta, pos):
+  size = shift = 0
+  while True:
+    c = delta[pos]
+    pos += 1
+    size |= (c & 0x7f) << shift
+    shift += 7
+    if not c & 0x80:
+      return size, pos
+
+def delta_result_size(delta):
+  """Get the size of the object produced by a delta from its header"""
+  delta = bytearray(delta[:20])
+  src_size, pos = _delta_size(delta, 0)
+  dst_size, pos = _delta_size(delta, pos)
+  return dst_size
+
+def apply_delta(base, delta):
+  """Reconstruct an object from its base and a git delta"""
+  delta = bytearray(delta)
+  src_size, pos = _delta_size(delta, 0)
+  dst_size, pos = _delta_size(delta, pos)
+  if src_size != len(base):
+    raise ValueError('delta base size mismatch')
+  out = bytearray()
+  end = len(delta)
+  while pos < end:
+    op = delta[pos]
+    pos += 1
+    if op & 0x80:
+      offset = size = 0
+      for i in range(4):
+        if op & (1 << i):
+          offset |= delta[pos] << (8 * i)
+          pos += 1
+      for i in range(3):
+        if op & (0x10 << i):
+          size |= delta[pos] << (8 * i)
+          pos += 1
+      if size == 0:
+        size = 0x10000
+      out += base[offset:offset+size]
+    elif op:
+      out += delta[pos:pos+op]
+      pos += op
+    else:
+      raise ValueError('invalid delta opcode')
+  if len(out) != dst_size:
+    raise ValueError('delta result size mismatch')
+  return bytes(out)
+
+def parse_tree(data):
+  """Parse a tree object
+
+  Yields (mode, name, objid) tuples, where mode is an int, name is bytes and
+  objid is a hex string.
+
+  """
+  pos = 0
+  end = len(data)
+  while pos < end:
+    sp = data.index(b' ', pos)
+    nul = data.index(b'\0', sp)
+    mode = int(data[pos:sp], 8)
+    objid = binascii.hexlify(data[nul+1:nul+21]).decode()
+    yield (mode, data[sp+1:nul], objid)
+    pos = nul + 21
+
+def tree_entries_size(entries):
+  """Estimate the memory used by a list of parsed tree entries"""
+  return 64 + sum(len(name) + 160 for mode, name, objid in entries)
+
+def encode_tree_entries(entries):
+  """Serialize parsed tree entries as text, one entry per line"""
+  return ''.join('%o %s %s\n' % (mode, objid, binascii.hexlify(name).decode())
+                 for mode, name, objid in entries)
+
+def decode_tree_entries(text):
+  """Parse the output of encode_tree_entries()"""
+  entries = []
+  for line in text.splitlines():
+    mode, objid, name = line.split(' ')
+    entries.append((int(mode, 8), binascii.unhexlify(name), objid))
+  return entries
+
+def parse_header(data):
+  """Parse the header lines of a commit or tag object into a dict
+
+  Only the first occurrence of each key is kept.
+
+  """
+  headers = {}
+  for line in data.split(b'\n\n', 1)[0].split(b'\n'):
+    key, _, value = line.partition(b' ')
+    headers.setdefault(key.decode(), value)
+  return headers
+
+class Pack(object):
+  """A pack file and its index"""
+
+  def __init__(self, path):
+    """Open a pack given the path of its index"""
+    self.path = path
+    self._idx = _map(path)
+    self._pack = _map(path[:-4] + '.pack')
+    if self._pack[:4] != b'PACK':
+      raise ValueError('%s: not a pack file' % self.path)
+    if self._idx[:4] == b'\377tOc':
+      version, = struct.unpack('>I', self._idx[4:8])
+      if version != 2:
+        raise ValueError('%s: unsupported index version' % path)
+      fanout = 8
+    else:
+      version = 1
+      fanout = 0
+    self.version = version
+    self._fanout = struct.unpack('>256I', self._idx[fanout:fanout+1024])
+    self.count = n = self._fanout[255]
+    if version == 2:
+      self._names = fanout + 1024
+      self._offsets = self._names + 24 * n
+      self._offsets64 = self._offsets + 4 * n
+    else:
+      self._names = 1024 + 4
+
+  def _name(self, i):
+    if self.version == 2:
+      pos = self._names + 20 * i
+    else:
+      pos = self._names + 24 * i
+    return self._idx[pos:pos+20]
+
+  def _offset(self, i):
+    if self.version == 2:
+      pos = self._offsets + 4 * i
+      offset, = struct.unpack('>I', self._idx[pos:pos+4])
+      if offset & 0x80000000:
+        pos = self._offsets64 + 8 * (offset & 0x7fffffff)
+        offset, = struct.unpack('>Q', self._idx[pos:pos+8])
+      return offset
+    else:
+      pos = self._names + 24 * i - 4
+      offset, = struct.unpack('>I', self._idx[pos:pos+4])
+      return offset
+
+  def find(self, binsha):
+    """Get the pack offset of an object, or None if it is not in this pack"""
+    first = bytearray(binsha[:1])[0]
+    lo = self._fanout[first-1] if first else 0
+    hi = self._fanout[first]
+    while lo < hi:
+      mid = (lo + hi) // 2
+      name = self._name(mid)
+      if name < binsha:
+        lo = mid + 1
+      elif name > binsha:
+        hi = mid
+      else:
+        return self._offset(mid)
+    return None
+
+  def header(self, offset):
+    """Parse the entry header at offset
+
+    Returns (type, size, base, pos), where base is the absolute offset of the
+    delta base for OBJ_OFS_DELTA, the binary object name of the base for
+    OBJ_REF_DELTA and None otherwise, and pos is the offset of the compressed
+    data.
+
+    """
+    buf = bytearray(self._pack[offset:offset+64])
+    c = buf[0]
+    objtype = (c >> 4) & 7
+    size = c & 0x0f
+    shift = 4
+    i = 1
+    while c & 0x80:
+      c = buf[i]
+      i += 1
+      size |= (c & 0x7f) << shift
+      shift += 7
+    base = None
+    if objtype == OBJ_OFS_DELTA:
+      c = buf[i]
+      i += 1
+      rel = c & 0x7f
+      while c & 0x80:
+        c = buf[i]
+        i += 1
+        rel = ((rel + 1) << 7) | (c & 0x7f)
+      base = offset - rel
+    elif objtype == OBJ_REF_DELTA:
+      base = bytes(buf[i:i+20])
+      i += 20
+    return (objtype, size, base, offset + i)
+
+  def inflate(self, pos, size, limit=None):
+    """Decompress the entry data at pos
+
+    At most limit bytes of the size bytes of data are decompressed.
+
+    """
+    want = size if limit is None else min(size, limit)
+    d = zlib.decompressobj()
+    out = []
+    got = 0
+    buf = b''
+    step = min(65536, want + 1024)
+    while got < want:
+      if not buf:
+        buf = self._pack[pos:pos+step]
+        if not buf:
+          raise ValueError('%s: truncated pack' % self.path)
+        pos += len(buf)
+      data = d.decompress(buf, want - got)
+      buf = d.unconsumed_tail
+      out.append(data)
+      got += len(data)
+    return b''.join(out)
+
+  def reader(self, pos):
+    """Get a function that reads the pack sequentially from pos"""
+    state = [pos]
+    def read(n):
+      pos = state[0]
+      data = self._pack[pos:pos+n]
+      state[0] = pos + len(data)
+      return data
+    return read
+
+  def close(self):
+    self._idx.close()
+    self._pack.close()
+
+class InflateStream(io.RawIOBase):
+  """A readable stream of size bytes of zlib-compressed data
+
+  read(n) returns up to n bytes of compressed input, or nothing at the end.
+  data and tail are output and input left over from decompressor, if it has
+  already been used to read a header.
+
+  """
+
+  def __init__(self, read, size, decompressor=None, data=b'', tail=b'',
+               close=None):
+    self.length = size
+    self._read = read
+    self._remaining = size
+    self._d = decompressor or zlib.decompressobj()
+    self._data = data
+    self._tail = tail
+    self._close = close
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    n = min(len(b), self._remaining)
+    if n <= 0:
+      return 0
+    while not self._data:
+      if not self._tail:
+        self._tail = self._read(65536)
+        if not self._tail:
+          raise IOError('truncated object')
+      self._data = self._d.decompress(self._tail, n)
+      self._tail = self._d.unconsumed_tail
+    data = self._data[:n]
+    self._data = self._data[n:]
+    n = len(data)
+    b[:n] = data
+    self._remaining -= n
+    return n
+
+  def close(self):
+    if not self.closed and self._close is not None:
+      self._close()
+    io.RawIOBase.close(self)
+
+class ObjectStore(object):
+  """Read-only access to the objects of a git repository
+
+  :param path: The repository's ``objects`` directory.
+  :param cache_size: The number of bytes of delta bases to keep in memory.
+
+  Missing or unreadable objects raise KeyError.
+
+  """
+
+  def __init__(self, path, cache_size=16*1024*1024):
+    self.path = path
+    self._lock = threading.Lock()
+    self._packs = []
+    self._packs_stamp = None
+    self._alternates_v = None
+    self._cache = LRUCache(cache_size, lambda v: len(v[1]))
+
+  def _refresh_packs(self):
+    """Rescan the pack directory, returning True if it changed"""
+    packdir = os.path.join(self.path, 'pack')
+    with self._lock:
+      try:
+        st = os.stat(packdir)
+      except OSError:
+        return False
+      stamp = (st.st_mtime, st.st_ino)
+      if stamp == self._packs_stamp:
+        return False
+      self._packs_stamp = stamp
+      old = dict((pack.path, pack) for pack in self._packs)
+      packs = []
+      for name in sorted(os.listdir(packdir)):
+        if not name.endswith('.idx'):
+          continue
+        path = os.path.join(packdir, name)
+        pack = old.pop(path, None)
+        if pack is None:
+          try:
+            pack = Pack(path)
+          except (IOError, OSError, ValueError):
+            continue
+        packs.append(pack)
+      # largest packs first, since they are most likely to hold an object
+      packs.sort(key=lambda p: -p.count)
+      # packs that are gone, e.g. after a repack, are not closed here since
+      # other threads may still be reading them; they are unmapped when the
+      # last reference goes away
+      self._packs = packs
+      return True
+
+  @property
+  def _alternates(self):
+    if self._alternates_v is None:
+      alternates = []
+      try:
+        with open(os.path.join(self.path, 'info', 'alternates')) as f:
+          for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+              path = os.path.join(self.path, line)
+              alternates.append(ObjectStore(path, self._cache.max_size))
+      except IOError:
+        pass
+      self._alternates_v = alternates
+    return self._alternates_v
+
+  def _find_packed(self, binsha):
+    if self._packs_stamp is None:
+      self._refresh_packs()
+    for attempt in range(2):
+      for pack in self._packs:
+        offset = pack.find(binsha)
+        if offset is not None:
+          return pack, offset
+      if not self._refresh_packs():
+        break
+    return None, None
+
+  def _loose_path(self, objid):
+    return os.path.join(self.path, objid[:2], objid[2:])
+
+  def _read_loose(self, objid, header_only=False):
+    try:
+      with open(self._loose_path(objid), 'rb') as f:
+        if header_only:
+          data = zlib.decompressobj().decompress(f.read(512), 64)
+        else:
+          data = zlib.decompress(f.read())
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+    header, _, data = data.partition(b'\0')
+    objtype, size = header.decode().split()
+    return (objtype, int(size), data)
+
+  def _open_loose(self, objid):
+    try:
+      f = open(self._loose_path(objid), 'rb')
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+    try:
+      d = zlib.decompressobj()
+      data = d.decompress(f.read(512), 64)
+      header, _, data = data.partition(b'\0')
+      objtype, size = header.decode().split()
+    except Exception:
+      f.close()
+      raise
+    stream = InflateStream(f.read, int(size), d, data, d.unconsumed_tail,
+                           f.close)
+    return objtype, int(size), stream
+
+  def _read_packed(self, pack, offset):
+    chain = []
+    while True:
+      cached = self._cache.get((pack.path, offset))
+      if cached is not None:
+        objtype, data = cached
+        break
+      objtype, size, base, pos = pack.header(offset)
+      if objtype == OBJ_OFS_DELTA:
+        chain.append((offset, pos, size))
+        offset = base
+      elif objtype == OBJ_REF_DELTA:
+        chain.append((offset, pos, size))
+        base_offset = pack.find(base)
+        if base_offset is None:
+          objtype, data = self.read(binascii.hexlify(base).decode())
+          break
+        offset = base_offset
+      elif objtype in type_names:
+        objtype = type_names[objtype]
+        data = pack.inflate(pos, size)
+        if chain:
+          self._cache[(pack.path, offset)] = (objtype, data)
+        break
+      else:
+        raise ValueError('%s: bad object type at %d' % (pack.path, offset))
+    while chain:
+      offset, pos, size = chain.pop()
+      data = apply_delta(data, pack.inflate(pos, size))
+      if chain:
+        self._cache[(pack.path, offset)] = (objtype, data)
+    return objtype, data
+
+  def _info_packed(self, pack, offset):
+    size = None
+    while True:
+      cached = self._cache.get((pack.path, offset))
+      if cached is not None:
+        objtype, data = cached
+        return objtype, len(data) if size is None else size
+      objtype, objsize, base, pos = pack.header(offset)
+      if objtype in type_names:
+        return type_names[objtype], objsize if size is None else size
+      if objtype not in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+        raise ValueError('%s: bad object type at %d' % (pack.path, offset))
+      if size is None:
+        size = delta_result_size(pack.inflate(pos, objsize, 20))
+      if objtype == OBJ_REF_DELTA:
+        base_offset = pack.find(base)
+        if base_offset is None:
+          return self.info(binascii.hexlify(base).decode())[0], size
+        base = base_offset
+      offset = base
+
+  def read(self, objid):
+    """Read an object given its hex id
+
+    Returns a tuple (type, data), where type is one of 'commit', 'tree',
+    'blob' or 'tag'.
+
+    """
+    objid = str(objid).lower()
+    try:
+      binsha = binascii.unhexlify(objid)
+    except (TypeError, ValueError):
+      raise KeyError(objid)
+    if len(binsha) != 20:
+      raise KeyError(objid)
+    pack, offset = self._find_packed(binsha)
+    if pack is not None:
+      return self._read_packed(pack, offset)
+    loose = self._read_loose(objid)
+    if loose is not None:
+      return loose[0], loose[2]
+    for alternate in self._alternates:
+      try:
+        return alternate.read(objid)
+      except KeyError:
+        pass
+    raise KeyError(objid)
+
+  def open(self, objid):
+    """Open an object for reading as a stream
+
+    Returns a tuple (type, size, stream).  Loose objects and undeltified pack
+    entries are decompressed as the stream is read; deltified entries are
+    reconstructed in memory first.
+
+    """
+    objid = str(objid).lower()
+    try:
+      binsha = binascii.unhexlify(objid)
+    except (TypeError, ValueError):
+      raise KeyError(objid)
+    if len(binsha) != 20:
+      raise KeyError(objid)
+    pack, offset = self._find_packed(binsha)
+    if pack is not None:
+      objtype, size, base, pos = pack.header(offset)
+      if objtype in type_names:
+        return type_names[objtype], size, InflateStream(pack.reader(pos), size)
+      objtype, data = self._read_packed(pack, offset)
+      stream = io.BytesIO(data)
+      stream.length = len(data)
+      return objtype, len(data), stream
+    loose = self._open_loose(objid)
+    if loose is not None:
+      return loose
+    for alternate in self._alternates:
+      try:
+        return alternate.open(objid)
+      except KeyError:
+        pass
+    raise KeyError(objid)
+
+  def info(self, objid):
+    """Get the type and size of an object without reading all of it"""
+    objid = str(objid).lower()
+    try:
+      binsha = binascii.unhexlify(objid)
+    except (TypeError, ValueError):
+      raise KeyError(objid)
+    if len(binsha) != 20:
+      raise KeyError(objid)
+    pack, offset = self._find_packed(binsha)
+    if pack is not None:
+      return self._info_packed(pack, offset)
+    loose = self._read_loose(objid, header_only=True)
+    if loose is not None:
+      return loose[0], loose[1]
+    for alternate in self._alternates:
+      try:
+        return alternate.info(objid)
+      except KeyError:
+        pass
+    raise KeyError(objid)
+
+  def tree(self, objid):
+    """Read a tree object, returning a list of (mode, name, objid) tuples"""
+    objtype, data = self.read(objid)
+    if objtype != 'tree':
+      raise KeyError(objid)
+    return list(parse_tree(data))
+
+  def peel_tree(self, objid):
+    """Get the tree id of a commit, following tags"""
+    while True:
+      objtype, data = self.read(objid)
+      if objtype == 'tree':
+        return objid
+      if objtype not in ('commit', 'tag'):
+        raise KeyError(objid)
+      headers = parse_header(data)
+      objid = (headers.get('tree') or headers['object']).decode()
+
+  def close(self):
+    """Release all pack files
+
+    Each pack is unmapped once no other thread is still reading from it.
+
+    """
+    with self._lock:
+      self._packs = []
+      self._packs_stamp = None
+      self._cache.clear()
+    for alternate in self._alternates_v or ():
+      alternate.close()
+    self._alternates_v = None
+
+class RefStore(object):
+  """Read-only access to the refs of a git repository
+
+  :param path: The repository's git directory.
+
+  Refs are read from ``packed-refs`` and the loose ``refs`` tree.  The result
+  is memoized and revalidated by calling stat() on ``packed-refs``, ``HEAD``
+  and the directories under ``refs``; git replaces a loose ref by renaming a
+  lock file over it, which changes its directory, so the tree is only walked
+  again when one of those changes.  Repositories using the reftable format
+  raise KeyError.
+
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.common_path = path
+    try:
+      with open(os.path.join(path, 'commondir')) as f:
+        self.common_path = os.path.join(path, f.read().strip())
+    except IOError:
+      pass
+    self._lock = threading.Lock()
+    self._stamp = None
+    self._refs = None
+    self._head = None
+
+  def _fresh(self):
+    if self._stamp is None:
+      return False
+    for path, key in self._stamp:
+      if stat_key(path) != key:
+        return False
+    return True
+
+  def _read_ref(self, path):
+    try:
+      with open(path, 'rb') as f:
+        return f.read().decode('utf-8', 'replace').strip()
+    except IOError:
+      return None
+
+  def _load(self):
+    if os.path.isdir(os.path.join(self.common_path, 'reftable')):
+      raise KeyError('reftable')
+    stamp = []
+    raw = {}
+    # stat before reading, so that a concurrent update invalidates the result
+    packed_path = os.path.join(self.common_path, 'packed-refs')
+    stamp.append((packed_path, stat_key(packed_path)))
+    try:
+      with open(packed_path, 'rb') as f:
+        for line in f:
+          line = line.decode('utf-8', 'replace').rstrip('\n')
+          if not line or line[0] in '#^':
+            continue
+          objid, name = line.split(' ', 1)
+          raw[name] = objid
+    except IOError:
+      pass
+    refs_path = os.path.join(self.common_path, 'refs')
+    for dirpath, dirnames, filenames in os.walk(refs_path):
+      stamp.append((dirpath, stat_key(dirpath)))
+      for filename in filenames:
+        if filename.endswith('.lock'):
+          continue
+        path = os.path.join(dirpath, filename)
+        value = self._read_ref(path)
+        if value:
+          name = os.path.relpath(path, self.common_path).replace(os.sep, '/')
+          raw[name] = value
+    head_path = os.path.join(self.path, 'HEAD')
+    stamp.append((head_path, stat_key(head_path)))
+    head = self._read_ref(head_path)
+
+    def resolve(value):
+      for depth in range(5):
+        if value is None or not value.startswith('ref:'):
+          break
+        value = raw.get(value[4:].strip())
+      if value is not None and len(value) == 40:
+        return value.lower()
+      return None
+
+    refs = {}
+    for name, value in raw.items():
+      objid = resolve(value)
+      if objid is not None:
+        refs[name] = objid
+    self._refs = refs
+    self._head = resolve(head)
+    self._stamp = stamp
+
+  def _check(self):
+    with self._lock:
+      if not self._fresh():
+        self._load()
+      return self._refs, self._head
+
+  def refs(self):
+    """Get a dict mapping full ref names to object ids"""
+    return dict(self._check()[0])
+
+  def head(self):
+    """Get the object id HEAD points to, or None if it is unborn"""
+    return self._check()[1]
+
+  def resolve(self, name):
+    """Resolve a ref name the way git rev-parse does
+
+    Raises KeyError if name is not a ref; it may still be a valid revision.
+
+    """
+    if not_refname_rx.search(name):
+      raise KeyError(name)
+    refs, head = self._check()
+    if name == 'HEAD':
+      if head is None:
+        raise KeyError(name)
+      return head
+    if not name.startswith('refs/') and \
+       os.path.exists(os.path.join(self.path, name)):
+      # e.g. FETCH_HEAD or ORIG_HEAD
+      raise KeyError(name)
+    for fmt in ('%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+                'refs/remotes/%s', 'refs/remotes/%s/HEAD'):
+      try:
+        return refs[fmt % name]
+      except KeyError:
+        pass
+    raise KeyError(name)
@@ -31,6 +31,7 @@ import os
 import re
 import subprocess
 from .common import *
+from .lrucache import LRUCache
 
 HG = 'hg'
 
@@ -56,8 +57,14 @@ class HgRepo(VCSRepo):
 
   Valid revisions are anything that Mercurial considers as a revision.
 
+  ls() reads file sizes from filelog metadata with one ``hg files`` per
+  listing.  The sizes of up to size_cache_size file nodes are kept in an LRU
+  cache.
+
   """
 
+  size_cache_size = 65536
+
   @classmethod
   def create(cls, path):
     """Create a new repository"""
@@ -91,6 +98,54 @@ class HgRepo(VCSRepo):
       self._object_cache_v = HashDict(object_cache_path)
       return self._object_cache_v
 
+  @property
+  def _sizes(self):
+    try:
+      return self._sizes_v
+    except AttributeError:
+      self._sizes_v = LRUCache(self.size_cache_size, lambda v: 1)
+      return self._sizes_v
+
+  def _ls_sizes(self, rev, path, files, recursive):
+    """Get the sizes of files given as (path, file node) tuples"""
+    cache = self._sizes
+    results = {}
+    missing = []
+    for name, objid in files:
+      size = cache.get(objid)
+      if size is None:
+        missing.append((name, objid))
+      else:
+        results[name] = size
+    if not missing:
+      return results
+    cmd = [HG, 'files', '-r', rev, '--template={size}\\0{path}\\0']
+    if not recursive and path not in [name for name, objid in missing]:
+      # path: always matches the whole subtree
+      cmd.append('rootfilesin:' + path)
+    elif path:
+      cmd.append('path:' + path)
+    sizes = {}
+    try:
+      records = self._command_iter(cmd, b'\0')
+      try:
+        for size in records:
+          name = next(records).decode(self.encoding, 'replace')
+          sizes[name] = int(size)
+      finally:
+        records.close()
+    except (subprocess.CalledProcessError, ValueError):
+      # hg files was added in Mercurial 3.2, and some versions leave {size}
+      # empty
+      pass
+    for name, objid in missing:
+      try:
+        size = sizes[name]
+      except KeyError:
+        size = len(self._cat(rev, name))
+      cache[objid] = results[name] = size
+    return results
+
   def canonical_rev(self, rev):
     if isinstance(rev, str) and canonical_rev_rx.match(rev):
       return rev
@@ -98,6 +153,31 @@ class HgRepo(VCSRepo):
       cmd = [HG, 'log', '--template={node}', '-r', str(rev)]
       return self._command(cmd).decode()
 
+  def canonical_rev_many(self, revs):
+    revs = [str(rev) for rev in revs]
+    results = []
+    for i in range(0, len(revs), 200):
+      chunk = revs[i:i+200]
+      # present() turns unknown names into empty output instead of an error,
+      # so each revision gets its own (possibly empty) field
+      template = ''.join(
+        '{revset("first(present(%%r))", "%s") %% "{node}"}\\0'
+        % rev.replace('\\', '\\\\').replace('"', '\\"')
+        for rev in chunk)
+      cmd = [HG, 'log', '-r', 'null', '--template=' + template]
+      try:
+        output = self._command(cmd).decode().split('\0')
+      except subprocess.CalledProcessError:
+        # a syntax error in one expression fails the whole command
+        results.extend(VCSRepo.canonical_rev_many(self, chunk))
+        continue
+      for rev, node in zip(chunk, output):
+        if canonical_rev_rx.match(node):
+          results.append(node)
+        else:
+          results.append(RevisionDoesNotExist(rev))
+    return results
+
   def _revnum(self, rev):
     if isinstance(rev, int):
       return rev
@@ -195,7 +275,12 @@ class HgRepo(VCSRepo):
 
     results = []
     lookup_commit = {}
-    for t, fullpath, name, objid in self._ls(revstr, path, recursive, recursive_dirs, directory):
+    listing = list(self._ls(revstr, path, recursive, recursive_dirs, directory))
+    if 'size' in report:
+      files = [(fullpath, objid) for t, fullpath, name, objid in listing
+               if t in ' *']
+      sizes = self._ls_sizes(revstr, path, files, recursive)
+    for t, fullpath, name, objid in listing:
       entry = attrdict(path=fullpath)
       if name:
         entry.name = name
@@ -206,7 +291,7 @@ class HgRepo(VCSRepo):
         if 'executable' in report:
           entry.executable = t == '*'
         if 'size' in report:
-          entry.size = len(self._cat(revstr, name))
+          entry.size = sizes[fullpath]
       elif t == '@':
         entry.type = 'l'
         if 'target' in report:
@@ -262,7 +347,9 @@ class HgRepo(VCSRepo):
     cmd = [HG, 'cat', '-r', rev, path.encode(self.encoding)]
     return self._command(cmd)
 
-  def cat(self, rev, path):
+  def cat(self, rev, path, offset=0, length=None):
+    if offset or length is not None:
+      return self._cat_range(rev, path, offset, length)
     path = type(self).cleanPath(path)
     ls = self.ls(rev, path, directory=True)
     assert len(ls) == 1
@@ -270,6 +357,16 @@ class HgRepo(VCSRepo):
       raise BadFileType(rev, path)
     return self._cat(str(rev), path)
 
+  def cat_stream(self, rev, path, offset=0, length=None):
+    path = type(self).cleanPath(path)
+    ls = self.ls(rev, path, directory=True)
+    assert len(ls) == 1
+    if ls[0].get('type') != 'f':
+      raise BadFileType(rev, path)
+    cmd = [HG, 'cat', '-r', str(rev), path.encode(self.encoding)]
+    stream = CommandStream(cmd, cwd=self.path)
+    return self._stream_range(stream, offset, length)
+
   def readlink(self, rev, path):
     path = type(self).cleanPath(path)
     ls = self.ls(rev, path, directory=True)
@@ -324,12 +421,22 @@ class HgRepo(VCSRepo):
     return p.returncode == 0
 
   def __len__(self):
+    changelog = os.path.join(self.path, '.hg', 'store', '00changelog.i')
+    try:
+      key = str(os.stat(changelog).st_size)
+    except OSError:
+      key = None
+    cached = key and self._load_len_cache()
+    if cached and cached[0] == key:
+      return cached[1]
     cmd = [HG, 'id', '-n', '-r', 'tip']
     output = self._command(cmd)
-    return int(output) + 1
+    count = int(output) + 1
+    if key:
+      self._save_len_cache(key, count)
+    return count
 
-  def log(self, revrange=None, limit=None, firstparent=False, merges=None,
-          path=None, follow=False):
+  def _log_cmd(self, revargs, limit, firstparent, merges, path, follow):
     cmd = [HG, 'log', '--debug', '--template={node}\\0{parents}\\0'
            '{date|hgdate}\\0{author|nonempty}\\0{desc|tabindent|nonempty}\\0\\0']
     if limit is not None:
@@ -341,49 +448,64 @@ class HgRepo(VCSRepo):
         cmd.append('--only-merges')
       else:
         cmd.append('--no-merges')
-    single = False
+    cmd.extend(revargs)
+    if path:
+      if follow:
+        cmd.append('--follow')
+      cmd.extend(['--', type(self).cleanPath(path)])
+    return cmd
+
+  def _logentry(self, record):
+    log = record.decode(self.encoding, 'replace')
+    rev, parents, date, author, message = log.split('\0', 4)
+    parents = [x[1] for x in filter(lambda x: x[0] != '-1',
+      (x.split(':') for x in parents.split()))]
+    date = parse_hgdate(date)
+    message = message.replace('\n\t', '\n')
+    entry = CommitLogEntry(rev, parents, date, author, message)
+    if rev not in self._commit_cache:
+      self._commit_cache[rev] = entry
+    return entry
+
+  def log(self, revrange=None, limit=None, firstparent=False, merges=None,
+          path=None, follow=False):
+    if revrange is None or isinstance(revrange, (tuple, list)):
+      return list(self.iter_log(revrange, limit, firstparent, merges, path,
+                                follow))
+    entry = self._commit_cache.get(self.canonical_rev(revrange))
+    if entry:
+      entry._cached = True
+      return entry
+    cmd = self._log_cmd(['-r', str(revrange)], limit, firstparent, merges,
+                        path, follow)
+    output = self._command(cmd)
+    return self._logentry(output[:output.index(b'\0\0')])
+
+  def iter_log(self, revrange=None, limit=None, firstparent=False,
+               merges=None, path=None, follow=False):
     if revrange is None:
-      pass
+      revargs = []
     elif isinstance(revrange, (tuple, list)):
       if revrange[0] is None:
         if revrange[1] is None:
-          pass
+          revargs = []
         else:
-          cmd.extend(['-r', 'reverse(ancestors(%s))' % revrange[1]])
+          revargs = ['-r', 'reverse(ancestors(%s))' % revrange[1]]
       else:
         if revrange[1] is None:
-          cmd.extend(['-r', 'reverse(descendants(%s))' % revrange[0]])
+          revargs = ['-r', 'reverse(descendants(%s))' % revrange[0]]
         else:
-          cmd.extend(['-r', 'reverse(ancestors(%s))' % revrange[1], '--prune', str(revrange[0])])
+          revargs = ['-r', 'reverse(ancestors(%s))' % revrange[1], '--prune', str(revrange[0])]
     else:
-      entry = self._commit_cache.get(self.canonical_rev(revrange))
-      if entry:
-        entry._cached = True
-        return entry
-      cmd.extend(['-r', str(revrange)])
-      single = True
-    if path:
-      if follow:
-        cmd.append('--follow')
-      cmd.extend(['--', type(self).cleanPath(path)])
-    output = self._command(cmd).decode(self.encoding, 'replace')
-
-    results = []
-    logs = output.split('\0\0')
-    logs.pop()
-    for log in logs:
-      rev, parents, date, author, message = log.split('\0', 4)
-      parents = [x[1] for x in filter(lambda x: x[0] != '-1',
-        (x.split(':') for x in parents.split()))]
-      date = parse_hgdate(date)
-      message = message.replace('\n\t', '\n')
-      entry = CommitLogEntry(rev, parents, date, author, message)
-      if rev not in self._commit_cache:
-        self._commit_cache[rev] = entry
-      if single:
-        return entry
-      results.append(entry)
-    return results
+      yield self.log(revrange, limit, firstparent, merges, path, follow)
+      return
+    cmd = self._log_cmd(revargs, limit, firstparent, merges, path, follow)
+    records = self._command_iter(cmd, b'\0\0')
+    try:
+      for record in records:
+        yield self._logentry(record)
+    finally:
+      records.close()
 
   def changed(self, rev):
     cmd = [HG, 'status', '-C', '--change', str(rev)]
@@ -401,6 +523,52 @@ class HgRepo(VCSRepo):
     results.reverse()
     return results
 
+  def changed_many(self, revs):
+    revs = list(revs)
+    for i in range(0, len(revs), 500):
+      chunk = revs[i:i+500]
+      cmd = [HG, 'log', '--template={rev}\\0{node}\\0{parents}\\0'
+             '{file_mods % "M\\0{file}\\0"}{file_adds % "A\\0{file}\\0"}'
+             '{file_dels % "R\\0{file}\\0"}'
+             '{file_copies % "C\\0{name}\\0{source}\\0"}\\0']
+      for rev in chunk:
+        cmd.extend(['-r', str(rev)])
+      changes = {}
+      records = self._command_iter(cmd, b'\0')
+      try:
+        for r in records:
+          node = next(records).decode()
+          parents = next(records).decode().split()
+          files = {'M': [], 'A': [], 'R': []}
+          copies = {}
+          while True:
+            status = next(records).decode()
+            if not status:
+              break
+            path = next(records).decode(self.encoding, 'replace')
+            if status == 'C':
+              copies[path] = next(records).decode(self.encoding, 'replace')
+            else:
+              files[status].append(path)
+          if len(parents) > 1:
+            # merges only list their own files, unlike status --change
+            continue
+          results = []
+          for status in 'MAR':
+            for path in sorted(files[status]):
+              results.append(FileChangeInfo(path, status, copies.get(path)))
+          changes[r.decode()] = changes[node] = results
+      finally:
+        records.close()
+      for rev in chunk:
+        key = str(rev)
+        if not (key.isdigit() or canonical_rev_rx.match(key)):
+          key = self.canonical_rev(rev)
+        try:
+          yield rev, changes[key]
+        except KeyError:
+          yield rev, self.changed(rev)
+
   def pdiff(self, rev):
     cmd = [HG, 'log', '--template=a', '-p', '-r', str(rev)]
     return self._command(cmd)[1:]
@@ -411,6 +579,40 @@ class HgRepo(VCSRepo):
       cmd.extend(['--', type(self).cleanPath(path)])
     return self._command(cmd)
 
+  def _is_diff_header(self, line, next_line):
+    return line.startswith(b'diff ')
+
+  def _diff_header_paths(self, header):
+    # diff -r REV1 [-r REV2] PATH
+    words = header[0].rstrip(b'\n').split(b' ')
+    i = 1
+    while i < len(words) and words[i].startswith(b'-'):
+      i += 2 if words[i] == b'-r' else 1
+    path = b' '.join(words[i:])
+    return path, path
+
+  def iter_pdiff(self, rev):
+    cmd = [HG, 'diff', '-c', str(rev)]
+    return self._iter_file_diffs(cmd, self._is_diff_header,
+                                 self._diff_header_paths)
+
+  def iter_diff(self, rev_a, rev_b, path=None):
+    cmd = [HG, 'diff', '-r', rev_a, '-r', rev_b]
+    if path is not None:
+      cmd.extend(['--', type(self).cleanPath(path)])
+    return self._iter_file_diffs(cmd, self._is_diff_header,
+                                 self._diff_header_paths)
+
+  def diffstat(self, rev_a, rev_b=None):
+    if rev_b is None:
+      key = 'hg:%s' % self.canonical_rev(rev_a)
+      diffs = lambda: self.iter_pdiff(rev_a)
+    else:
+      key = 'hg:%s:%s' % (self.canonical_rev(rev_a),
+                          self.canonical_rev(rev_b))
+      diffs = lambda: self.iter_diff(rev_a, rev_b)
+    return self._cached_diffstat(key, lambda: diffstat_lines(diffs()))
+
   def ancestor(self, rev1, rev2):
     cmd = [HG, 'log', '--template={node}', '-r', 'ancestor(%s, %s)' % (rev1, rev2)]
     output = self._command(cmd).decode()
@@ -419,31 +621,63 @@ class HgRepo(VCSRepo):
     else:
       return output
 
-  def _blame(self, rev, path):
+  def _annotate(self, rev, path):
+    """Get the (node, author, date) of each line of a file
+
+    Revision metadata is fetched with a single log command, and the tuples
+    are shared between lines from the same revision.
+
+    """
     cmd = [HG, 'annotate', '-unv', '-r', rev, '--', path]
     output = self._command(cmd).decode(self.encoding, 'replace')
-    revs = {}
-    results = []
-    cat = self._cat(rev, path)
-    for line, text in zip(output.splitlines(), cat.splitlines()):
+    lines = []
+    for line in output.splitlines():
       m = annotate_rx.match(line)
       assert m, 'unexpected output: ' + line
-      rev, author = m.group('rev', 'author')
+      lines.append(m.group('rev', 'author'))
+    if not lines:
+      return []
+    cmd = [HG, 'log', '--template={rev}\\0{node}\\0{date|hgdate}\\n']
+    for r in set(r for r, author in lines):
+      cmd.extend(['-r', r])
+    output = self._command(cmd).decode(self.encoding, 'replace')
+    revs = {}
+    for line in output.splitlines():
+      r, node, date = line.split('\0')
+      revs[r] = node, parse_hgdate(date)
+    revinfo = {}
+    results = []
+    for r, author in lines:
       try:
-        rev, date = revs[rev]
+        info = revinfo[r]
       except KeyError:
-        cmd = [HG, 'log', '--template={node}\n{date|hgdate}', '-r', rev]
-        output = self._command(cmd).decode(self.encoding, 'replace')
-        rev, date = output.split('\n', 1)
-        date = parse_hgdate(date)
-        revs[rev] = rev, date
-      results.append(BlameInfo(rev, author, date, text))
+        node, date = revs[r]
+        info = revinfo[r] = (node, author, date)
+      results.append(info)
     return results
 
-  def blame(self, rev, path):
+  def _cached_annotate(self, rev, path):
+    rev = self.canonical_rev(rev)
+    def identity():
+      # filenodes hash both the content and the history of a file
+      for t, name, entry_name, objid in self._ls(rev, path, directory=True):
+        return 'hg:%s:%s' % (objid, path)
+    return self._cached_blame_hunks('hg:%s:%s' % (rev, path), identity,
+      lambda: blame_runs(self._annotate(rev, path)))
+
+  def _blame_check(self, rev, path):
     path = type(self).cleanPath(path)
     ls = self.ls(rev, path, directory=True)
     assert len(ls) == 1
     if ls[0].get('type') != 'f':
       raise BadFileType(rev, path)
-    return self._blame(str(rev), path)
+    return path
+
+  def blame(self, rev, path):
+    path = self._blame_check(rev, path)
+    hunks = self._cached_annotate(str(rev), path)
+    return blame_lines(hunks, self._cat(str(rev), path).splitlines())
+
+  def blame_hunks(self, rev, path):
+    path = self._blame_check(rev, path)
+    return self._cached_annotate(str(rev), path)
@@ -0,0 +1,115 @@
+# Copyright (c) 2013, Clemson University
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the {organization} nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+
+class LRUCache(object):
+  """A bounded in-memory cache which evicts the least recently used items
+
+  The size of each value is measured with sizeof (len by default), and items
+  are evicted once the total exceeds max_size.  Values larger than max_size
+  are never stored.  Instances are thread-safe.
+
+  """
+
+  def __init__(self, max_size, sizeof=len):
+    self.max_size = max_size
+    self.sizeof = sizeof
+    self.size = 0
+    self._lock = threading.Lock()
+    self._data = {}
+    # circular doubly-linked list of [prev, next, key, value, size], with the
+    # most recently used item at the front
+    self._root = root = []
+    root[:] = [root, root, None, None, 0]
+
+  def __len__(self):
+    return len(self._data)
+
+  def __contains__(self, key):
+    return key in self._data
+
+  def _unlink(self, node):
+    node[0][1] = node[1]
+    node[1][0] = node[0]
+
+  def _push(self, node):
+    root = self._root
+    node[0] = root
+    node[1] = root[1]
+    root[1][0] = node
+    root[1] = node
+
+  def get(self, key, default=None):
+    with self._lock:
+      node = self._data.get(key)
+      if node is None:
+        return default
+      self._unlink(node)
+      self._push(node)
+      return node[3]
+
+  def __getitem__(self, key):
+    with self._lock:
+      node = self._data[key]
+      self._unlink(node)
+      self._push(node)
+      return node[3]
+
+  def __setitem__(self, key, value):
+    size = self.sizeof(value)
+    with self._lock:
+      node = self._data.pop(key, None)
+      if node is not None:
+        self._unlink(node)
+        self.size -= node[4]
+      if size > self.max_size:
+        return
+      node = [None, None, key, value, size]
+      self._push(node)
+      self._data[key] = node
+      self.size += size
+      root = self._root
+      while self.size > self.max_size:
+        node = root[0]
+        self._unlink(node)
+        del self._data[node[2]]
+        self.size -= node[4]
+
+  def __delitem__(self, key):
+    with self._lock:
+      node = self._data.pop(key)
+      self._unlink(node)
+      self.size -= node[4]
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      root = self._root
+      root[:] = [root, root, None, None, 0]
+      self.size = 0
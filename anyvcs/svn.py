@@ -28,10 +28,13 @@
 
 import collections
 import fnmatch
+import itertools
 import re
 import subprocess
 import sys
 from .common import *
+from .lrucache import LRUCache
+from .svnhistory import HistoryIndex
 
 DIFF = 'diff'
 SVN = 'svn'
@@ -39,11 +42,82 @@ SVNADMIN = 'svnadmin'
 SVNLOOK = 'svnlook'
 
 head_rev_rx = re.compile(r'^(?=.)(?P<head>\D[^:]*)?:?(?P<rev>\d+)?$')
-mergeinfo_rx = re.compile(r'^(?P<head>.+):(?P<minrev>\d+)(?:-(?P<maxrev>\d+))$')
 changed_copy_info_rx = re.compile(r'^[ ]{4}\(from (?P<src>.+)\)$')
+node_id_rx = re.compile(r'<(?P<id>[^<>]+)>\s*$')
+svnlook_diff_rx = re.compile(br'^(?P<action>Modified|Added|Deleted|Copied|Property changes on): (?P<path>.*?)(?: \(from rev \d+, (?P<src>.*)\))?$')
 
 HistoryEntry = collections.namedtuple('HistoryEntry', 'rev path')
 
+def parse_svn_date(datestr):
+  """Parse a date from svn's XML output the way svnlook info shows it
+
+  svnlook info gives whole seconds in the local time zone, while svn log
+  --xml gives microseconds in UTC.
+
+  """
+  import calendar
+  import datetime
+  import time
+  ts = calendar.timegm(parse_isodate(datestr).utctimetuple())
+  local = time.localtime(ts)
+  offset = calendar.timegm(local) - ts
+  date = datetime.datetime(*local[:6])
+  return date.replace(tzinfo=UTCOffset(offset // 60))
+
+def parse_mergeinfo(text):
+  """Parse an svn:mergeinfo property value
+
+  Returns a dict mapping each merge source path to a sorted list of
+  (minrev, maxrev) tuples, with overlapping and adjacent ranges joined.
+
+  """
+  results = {}
+  for line in text.splitlines():
+    head, sep, revs = line.rpartition(':')
+    if not sep:
+      continue
+    ranges = []
+    for r in revs.split(','):
+      r = r.strip().rstrip('*')
+      if not r:
+        continue
+      minrev, sep, maxrev = r.partition('-')
+      ranges.append((int(minrev), int(maxrev or minrev)))
+    ranges.extend(results.get(head, ()))
+    ranges.sort()
+    merged = []
+    for minrev, maxrev in ranges:
+      if merged and minrev <= merged[-1][1] + 1:
+        if maxrev > merged[-1][1]:
+          merged[-1] = (merged[-1][0], maxrev)
+      else:
+        merged.append((minrev, maxrev))
+    results[head] = merged
+  return results
+
+class MergeinfoCache(HashedKeyDict):
+  """An on-disk cache of parsed svn:mergeinfo values
+
+  Keys are arbitrary strings, which are hashed to form file names.  Values
+  are dicts as returned by parse_mergeinfo().
+
+  """
+
+  def __getitem__(self, key):
+    import json
+    value = HashedKeyDict.__getitem__(self, key)
+    try:
+      o = json.loads(value)
+    except ValueError:
+      raise KeyError(key)
+    return dict((head, [tuple(r) for r in ranges])
+                for head, ranges in o.items())
+
+  def __setitem__(self, key, mergeinfo):
+    import json
+    value = json.dumps(mergeinfo, separators=(',', ':'))
+    HashedKeyDict.__setitem__(self, key, value)
+
 class SvnRepo(VCSRepo):
   """A Subversion repository
 
@@ -78,8 +152,20 @@ class SvnRepo(VCSRepo):
   If a repository does not fit this layout, everything other than branch and
   tag detection will work as expected.
 
+  The property names of up to prop_cache_size paths are kept in an LRU
+  cache.  ls() fetches them for a whole listing with one ``svn proplist``.
+  Likewise, file sizes are fetched with one ``svn list`` and the sizes of up
+  to size_cache_size node-revisions are kept.
+
+  log() reads the author, date and message of log_batch_size revisions at a
+  time with one ``svn log``.
+
   """
 
+  prop_cache_size = 65536
+  size_cache_size = 65536
+  log_batch_size = 100
+
   @classmethod
   def create(cls, path):
     """Create a new repository"""
@@ -122,6 +208,110 @@ class SvnRepo(VCSRepo):
     output = self._command(cmd).decode()
     return [x.strip() for x in output.splitlines()]
 
+  @property
+  def _props(self):
+    try:
+      return self._props_v
+    except AttributeError:
+      self._props_v = LRUCache(self.prop_cache_size, lambda v: 1)
+      return self._props_v
+
+  def _cached_proplist(self, rev, path):
+    key = (int(rev), '/' + path.lstrip('/'))
+    props = self._props.get(key)
+    if props is None:
+      props = self._props[key] = tuple(self._proplist(str(rev), path))
+    return props
+
+  def _bulk_proplist(self, rev, path, depth):
+    """Get the property names of every node under path that has any
+
+    Returns a dict mapping paths (with a leading /) to tuples of names, or
+    None if svn cannot list them or is not installed.
+
+    """
+    import os
+    import xml.etree.ElementTree as ET
+    try:
+      from urllib.parse import unquote
+    except ImportError:
+      from urllib import unquote
+    base = 'file://' + os.path.abspath(self.path)
+    url = base + '/' + path.strip('/')
+    cmd = [SVN, 'proplist', '--xml', '--depth', depth,
+           '%s@%d' % (url, rev)]
+    results = {}
+    try:
+      for target in self._iter_xml(cmd, 'target'):
+        name = unquote(target.get('path'))
+        if name.startswith(base):
+          name = name[len(base):]
+        name = '/' + name.strip('/')
+        results[name] = tuple(p.get('name') for p in target.iter('property'))
+    except (OSError, subprocess.CalledProcessError, ET.ParseError):
+      return None
+    return results
+
+  @property
+  def _sizes(self):
+    try:
+      return self._sizes_v
+    except AttributeError:
+      self._sizes_v = LRUCache(self.size_cache_size, lambda v: 1)
+      return self._sizes_v
+
+  def _bulk_sizes(self, rev, path, depth):
+    """Get the sizes of the files under path
+
+    Returns a dict mapping paths (with a leading /) to sizes, or None if svn
+    cannot list them or is not installed.
+
+    """
+    import os
+    import xml.etree.ElementTree as ET
+    url = 'file://' + os.path.abspath(self.path) + '/' + path.strip('/')
+    cmd = [SVN, 'list', '--xml', '--depth', depth, '%s@%d' % (url, rev)]
+    results = {}
+    try:
+      for entry in self._iter_xml(cmd, 'entry'):
+        if entry.get('kind') != 'file':
+          continue
+        name = entry.findtext('name')
+        if depth == 'empty':
+          name = path
+        else:
+          name = path.rstrip('/') + '/' + name
+        results['/' + name.lstrip('/')] = int(entry.findtext('size'))
+    except (OSError, subprocess.CalledProcessError, ET.ParseError):
+      return None
+    return results
+
+  def _ls_sizes(self, rev, path, files, recursive):
+    """Get the sizes of files given as (path, node-revision id) tuples"""
+    cache = self._sizes
+    results = {}
+    missing = []
+    for name, node_id in files:
+      size = cache.get(node_id)
+      if size is None:
+        missing.append((name, node_id))
+      else:
+        results[name] = size
+    if not missing:
+      return results
+    if len(files) == 1 and files[0][0] == path:
+      depth = 'empty'
+    else:
+      depth = 'infinity' if recursive else 'immediates'
+    bulk = self._bulk_sizes(rev, path, depth) or {}
+    for name, node_id in missing:
+      try:
+        size = bulk[name]
+      except KeyError:
+        size = len(self._cat(str(rev), name))
+      cache[node_id] = results[name] = size
+    return results
+
   def proplist(self, rev, path=None):
     """List Subversion properties of the path"""
     rev, prefix = self._maprev(rev)
@@ -144,19 +334,53 @@ class SvnRepo(VCSRepo):
       path = type(self).cleanPath(prefix + path)
       return self._propget(prop, str(rev), path)
 
-  def _mergeinfo(self, rev, path):
+  @property
+  def _mergeinfo_cache(self):
+    try:
+      return self._mergeinfo_cache_v
+    except AttributeError:
+      import os
+      mergeinfo_cache_path = os.path.join(self.private_path, 'mergeinfo-cache')
+      self._mergeinfo_cache_v = MergeinfoCache(mergeinfo_cache_path)
+      return self._mergeinfo_cache_v
+
+  def _mergeinfo_ranges(self, rev, path):
+    """Get the svn:mergeinfo of a path as returned by parse_mergeinfo()
+
+    Values are cached under the revision that last changed the path's
+    properties, according to the history index, so every revision in
+    between shares one entry.
+
+    """
+    import xml.etree.ElementTree as ET
+    rev = int(rev)
+    path = type(self).cleanPath(path)
+    if path != '/':
+      path = path.rstrip('/')
+    try:
+      rev = self._update_history_index(rev).props_rev(path, rev)
+    except (KeyError, OSError, subprocess.CalledProcessError, ET.ParseError):
+      # let svnlook decide, and report, what is wrong
+      pass
+    key = '%s@%d' % (path, rev)
+    cache = self._mergeinfo_cache
+    try:
+      return cache[key]
+    except KeyError:
+      pass
     revstr = str(rev)
-    if 'svn:mergeinfo' not in self._proplist(revstr, path):
-      return []
+    if 'svn:mergeinfo' in self._cached_proplist(revstr, path):
+      mergeinfo = parse_mergeinfo(self._propget('svn:mergeinfo', revstr, path))
+    else:
+      mergeinfo = {}
+    cache[key] = mergeinfo
+    return mergeinfo
+
+  def _mergeinfo(self, rev, path):
     results = []
-    mergeinfo = self._propget('svn:mergeinfo', revstr, path)
-    for line in mergeinfo.splitlines():
-      m = mergeinfo_rx.match(line)
-      assert m
-      head, minrev, maxrev = m.group('head', 'minrev', 'maxrev')
-      minrev = int(minrev)
-      maxrev = int(maxrev or minrev)
-      results.append((head, minrev, maxrev))
+    for head, ranges in sorted(self._mergeinfo_ranges(rev, path).items()):
+      for minrev, maxrev in ranges:
+        results.append((head, minrev, maxrev))
     return results
 
   def _maprev(self, rev):
@@ -189,6 +413,24 @@ class SvnRepo(VCSRepo):
       rev, prefix = self._maprev(rev)
       return rev
 
+  def canonical_rev_many(self, revs):
+    results = []
+    youngest = None
+    for rev in revs:
+      if isinstance(rev, int):
+        results.append(rev)
+        continue
+      m = head_rev_rx.match(str(rev))
+      if not m:
+        results.append(RevisionDoesNotExist(rev))
+      elif m.group('rev'):
+        results.append(int(m.group('rev')))
+      else:
+        if youngest is None:
+          youngest = self.youngest()
+        results.append(youngest)
+    return results
+
   def ls(self, rev, path, recursive=False, recursive_dirs=False,
          directory=False, report=()):
     rev, prefix = self._maprev(rev)
@@ -214,6 +456,8 @@ class SvnRepo(VCSRepo):
     cmd = [SVNLOOK, 'tree', '-r', revstr, '--full-paths']
     if not recursive:
       cmd.append('--non-recursive')
+    if 'size' in report:
+      cmd.append('--show-ids')
     cmd.extend(['.', path])
     p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
@@ -226,6 +470,12 @@ class SvnRepo(VCSRepo):
 
     results = []
     lines = output.decode(self.encoding, 'replace').splitlines()
+    node_ids = {}
+    if 'size' in report:
+      for i, line in enumerate(lines):
+        m = node_id_rx.search(line)
+        lines[i] = line[:m.start()].rstrip(' ')
+        node_ids[lines[i]] = m.group('id')
     if forcedir and not lines[0].endswith('/'):
       raise PathDoesNotExist(rev, path)
     if lines[0].endswith('/'):
@@ -233,6 +483,11 @@ class SvnRepo(VCSRepo):
         lines = lines[:1]
       else:
         lines = lines[1:]
+    proplists = self._ls_proplists(rev, path, lines, recursive and not directory)
+    if 'size' in report:
+      files = [('/' + name.lstrip('/'), node_ids[name]) for name in lines
+               if not name.endswith('/')]
+      sizes = self._ls_sizes(rev, path, files, recursive and not directory)
     for name in lines:
       entry_name = name[ltrim:]
       entry = attrdict(path=name.strip('/'))
@@ -242,7 +497,7 @@ class SvnRepo(VCSRepo):
         entry.type = 'd'
         entry_name = entry_name.rstrip('/')
       else:
-        proplist = self._proplist(revstr, name)
+        proplist = proplists['/' + name.lstrip('/')]
         if 'svn:special' in proplist:
           link = self._cat(revstr, name).decode(self.encoding, 'replace')
           link = link.split(None, 1)
@@ -255,7 +510,7 @@ class SvnRepo(VCSRepo):
           if 'executable' in report:
             entry.executable = 'svn:executable' in proplist
           if 'size' in report:
-            entry.size = len(self._cat(revstr, name))
+            entry.size = sizes['/' + name.lstrip('/')]
       if entry_name:
         entry.name = entry_name
       if 'commit' in report:
@@ -263,11 +518,44 @@ class SvnRepo(VCSRepo):
       results.append(entry)
     return results
 
+  def _ls_proplists(self, rev, path, lines, recursive):
+    """Get the property names of the files among svnlook tree output lines
+
+    Cached names are used if every file has them.  Otherwise the names for
+    the whole listing are fetched at once and cached.
+
+    """
+    cache = self._props
+    files = ['/' + name.lstrip('/') for name in lines if not name.endswith('/')]
+    results = {}
+    for name in files:
+      props = cache.get((rev, name))
+      if props is None:
+        break
+      results[name] = props
+    else:
+      return results
+    if len(files) == 1 and files[0] == path:
+      bulk = None
+    else:
+      bulk = self._bulk_proplist(rev, path,
+                                 'infinity' if recursive else 'immediates')
+    results = {}
+    for name in files:
+      if bulk is None:
+        props = tuple(self._proplist(str(rev), name))
+      else:
+        props = bulk.get(name, ())
+      cache[(rev, name)] = results[name] = props
+    return results
+
   def _cat(self, rev, path):
     cmd = [SVNLOOK, 'cat', '-r', rev, '.', path.encode(self.encoding)]
     return self._command(cmd)
 
-  def cat(self, rev, path):
+  def cat(self, rev, path, offset=0, length=None):
+    if offset or length is not None:
+      return self._cat_range(rev, path, offset, length)
     rev, prefix = self._maprev(rev)
     path = type(self).cleanPath(prefix + path)
     ls = self.ls(rev, path, directory=True)
@@ -276,6 +564,26 @@ class SvnRepo(VCSRepo):
       raise BadFileType(rev, path)
     return self._cat(str(rev), path)
 
+  def cat_stream(self, rev, path, offset=0, length=None):
+    rev, prefix = self._maprev(rev)
+    path = type(self).cleanPath(prefix + path)
+    ls = self.ls(rev, path, directory=True)
+    assert len(ls) == 1
+    if ls[0].get('type') != 'f':
+      raise BadFileType(rev, path)
+    import os
+    epath = path.encode(self.encoding)
+    cmd = [SVNLOOK, 'filesize', '-r', str(rev), '.', epath]
+    try:
+      with open(os.devnull, 'wb') as devnull:
+        size = int(self._command(cmd, stderr=devnull))
+    except subprocess.CalledProcessError:
+      # svnlook filesize was added in Subversion 1.9
+      size = None
+    cmd = [SVNLOOK, 'cat', '-r', str(rev), '.', epath]
+    stream = CommandStream(cmd, size, cwd=self.path)
+    return self._stream_range(stream, offset, length)
+
   def _readlink(self, rev, path):
     output = self._cat(rev, path)
     link = output.decode(self.encoding, 'replace').split(None, 1)
@@ -292,6 +600,22 @@ class SvnRepo(VCSRepo):
     return self._readlink(str(rev), path)
 
   def youngest(self):
+    import os
+    # FSFS repositories record the youngest revision first in db/current;
+    # it is replaced on every commit, so its stat() tells when to re-read it
+    key = stat_key(os.path.join(self.path, 'db', 'current'))
+    if key is not None:
+      cached = getattr(self, '_youngest_v', None)
+      if cached is not None and cached[0] == key:
+        return cached[1]
+      current = self._db_current()
+      try:
+        rev = int(current.split()[0])
+      except (AttributeError, IndexError, ValueError):
+        pass
+      else:
+        self._youngest_v = (key, rev)
+        return rev
     cmd = [SVNLOOK, 'youngest', '.']
     return int(self._command(cmd))
 
@@ -341,10 +665,40 @@ class SvnRepo(VCSRepo):
     stdout, stderr = p.communicate()
     return p.returncode == 0
 
+  def _db_current(self):
+    """Read the repository's db/current file, or None if it is unreadable"""
+    import os
+    try:
+      with open(os.path.join(self.path, 'db', 'current')) as f:
+        return f.read()
+    except IOError:
+      return None
+
   def __len__(self):
-    cmd = [SVNLOOK, 'history', '.']
-    output = self._command(cmd)
-    return len(output.splitlines()) - 3
+    key = self._db_current()
+    cached = key and self._load_len_cache()
+    if cached and cached[0] == key:
+      return cached[1]
+    youngest = int(key.split()[0]) if key else self.youngest()
+    if cached and cached[2] is not None and cached[2] <= youngest:
+      # count only the revisions committed since
+      count = cached[1]
+      oldest = cached[2]
+    else:
+      # revision 0 is not counted
+      count = -1
+      oldest = -1
+    history = self._iter_history(youngest, '/')
+    try:
+      for entry in history:
+        if entry.rev <= oldest:
+          break
+        count += 1
+    finally:
+      history.close()
+    if key:
+      self._save_len_cache(key, count, youngest)
+    return count
 
   def log(self, revrange=None, limit=None, firstparent=False, merges=None,
           path=None, follow=False):
@@ -354,9 +708,17 @@ class SvnRepo(VCSRepo):
       h = self._history(rev, prefix, 1)
       rev = h[0].rev
       return self._logentry(rev, prefix)
+    return list(self.iter_log(revrange, limit, firstparent, merges, path,
+                              follow))
+
+  def iter_log(self, revrange=None, limit=None, firstparent=False,
+               merges=None, path=None, follow=False):
+    if not (revrange is None or isinstance(revrange, (tuple, list))):
+      yield self.log(revrange, limit, firstparent, merges, path, follow)
+      return
 
     if revrange is None:
-      results = self._history(self.youngest(), path or '/', limit)
+      results = self._iter_history(self.youngest(), path or '/', limit)
     else:
       if revrange[1] is None:
         include = set()
@@ -389,26 +751,79 @@ class SvnRepo(VCSRepo):
 
       results = sorted(results, key=lambda x: x.rev, reverse=True)
 
-    results = map(lambda x: self._logentry(x.rev, x.path), results)
-    if merges is not None:
-      if merges:
-        results = filter(lambda x: len(x.parents) > 1, results)
-      else:
-        results = filter(lambda x: len(x.parents) <= 1, results)
-    return list(results)
+    try:
+      it = iter(results)
+      while True:
+        batch = list(itertools.islice(it, self.log_batch_size))
+        if not batch:
+          break
+        cache = self._commit_cache
+        infos = self._log_infos([x.rev for x in batch
+                                 if self._commit_key(x.rev) not in cache])
+        for x in batch:
+          entry = self._logentry(x.rev, x.path, info=infos.get(x.rev))
+          if merges is not None and merges != (len(entry.parents) > 1):
+            continue
+          yield entry
+    finally:
+      if hasattr(results, 'close'):
+        results.close()
 
-  def _logentry(self, rev, path, history=None):
+  def _commit_key(self, rev):
     import hashlib
+    return hashlib.sha1(str(rev).encode()).hexdigest()
+
+  def _log_infos(self, revs):
+    """Get the (author, date, message) of several revisions at once
+
+    Returns a dict keyed by revision.  Revisions which svn log cannot read
+    are left out.
+
+    """
+    import os
+    import xml.etree.ElementTree as ET
+    revs = sorted(set(r for r in revs if r > 0), reverse=True)
+    if not revs:
+      return {}
+    ranges = []
+    for r in revs:
+      if ranges and ranges[-1][1] == r + 1:
+        ranges[-1][1] = r
+      else:
+        ranges.append([r, r])
+    url = 'file://' + os.path.abspath(self.path)
+    results = {}
+    try:
+      for i in range(0, len(ranges), 500):
+        cmd = [SVN, 'log', '--xml']
+        for first, last in ranges[i:i+500]:
+          cmd.extend(['-r', '%d:%d' % (first, last)])
+        cmd.append(url)
+        for elem in self._iter_xml(cmd, 'logentry'):
+          # match the output of svnlook info; svn writes carriage returns
+          # in messages as &#13;, so XML line end handling keeps them
+          author = elem.findtext('author') or ''
+          date = parse_svn_date(elem.findtext('date'))
+          message = (elem.findtext('msg') or '') + '\n'
+          results[int(elem.get('revision'))] = (author, date, message)
+    except (OSError, subprocess.CalledProcessError, ET.ParseError):
+      pass
+    return results
+
+  def _logentry(self, rev, path, history=None, info=None):
     revstr = str(rev)
     cmd = [SVNLOOK, 'info', '.', '-r', revstr]
-    cachekey = hashlib.sha1(revstr.encode()).hexdigest()
+    cachekey = self._commit_key(rev)
     entry = self._commit_cache.get(cachekey)
     if entry:
       entry._cached = True
       return entry
-    output = self._command(cmd).decode(self.encoding, 'replace')
-    author, date, logsize, message = output.split('\n', 3)
-    date = parse_isodate(date)
+    if info is not None:
+      author, date, message = info
+    else:
+      output = self._command(cmd).decode(self.encoding, 'replace')
+      author, date, logsize, message = output.split('\n', 3)
+      date = parse_isodate(date)
     if history is None:
       history = self._history(rev, path, 2)
     parents = []
@@ -418,7 +833,8 @@ class SvnRepo(VCSRepo):
         parents.append(prev)
       else:
         parents.append('%s:%d' % (path, prev))
-      for head, minrev, maxrev in self._mergeinfo(rev, path):
+      for head, ranges in sorted(self._mergeinfo_ranges(rev, path).items()):
+        maxrev = ranges[-1][1]
         if prev < maxrev:
           h = self._history(maxrev, head, 1)
           if head == '/':
@@ -430,36 +846,208 @@ class SvnRepo(VCSRepo):
       self._commit_cache[cachekey] = entry
     return entry
 
-  def pdiff(self, rev):
+  def _iter_pdiff_lines(self, rev):
+    """Yield the lines of pdiff(rev) as svnlook writes them
+
+    The old and new file names get a/ and b/ prefixes, so that the diff
+    applies with patch -p1.
+
+    """
     rev, prefix = self._maprev(rev)
     if rev == 0:
-      return ''
+      return
     cmd = [SVNLOOK, 'diff', '.', '-r', str(rev)]
-    output = self._command(cmd)
-    _output = b''
-    for line in output.splitlines(True):
-      if line.startswith(b'--- '):
-        line = b'--- a/' + line[4:]
-      if line.startswith(b'+++ '):
-        line = b'+++ b/' + line[4:]
-      _output += line
-    output = _output
-    return output
+    output = self._command_iter(cmd, keepends=True)
+    try:
+      for line in output:
+        if line.startswith(b'--- '):
+          line = b'--- a/' + line[4:]
+        elif line.startswith(b'+++ '):
+          line = b'+++ b/' + line[4:]
+        yield line
+    finally:
+      output.close()
 
-  def diff(self, rev_a, rev_b, path=None):
+  def pdiff(self, rev):
+    import io
+    buf = io.BytesIO()
+    for line in self._iter_pdiff_lines(rev):
+      buf.write(line)
+    return buf.getvalue()
+
+  def iter_pdiff(self, rev):
+    lines = self._iter_pdiff_lines(rev)
+    current = [None]
+
+    def is_header(line, next_line):
+      m = svnlook_diff_rx.match(line.rstrip(b'\n'))
+      if m is None or next_line is None:
+        return False
+      if m.group('action') == b'Property changes on':
+        # property changes of a file whose text also changed belong to it
+        if not next_line.startswith(b'___') or m.group('path') == current[0]:
+          return False
+      elif not next_line.startswith(b'==='):
+        return False
+      current[0] = m.group('path')
+      return True
+
+    try:
+      for header, hunks in split_diff(lines, is_header):
+        m = svnlook_diff_rx.match(header[0].rstrip(b'\n'))
+        path = m.group('path').decode(self.encoding, 'replace')
+        action = m.group('action')
+        old_path = new_path = path
+        if action == b'Added':
+          status = 'A'
+          old_path = None
+        elif action == b'Deleted':
+          status = 'D'
+          new_path = None
+        elif action == b'Copied':
+          status = 'C'
+          old_path = m.group('src').decode(self.encoding, 'replace')
+        else:
+          status = 'M'
+        yield FileDiff(old_path, new_path, status, b''.join(header),
+                       [b''.join(hunk) for hunk in hunks])
+    finally:
+      lines.close()
+
+  def _url(self, prefix, rev):
+    import os
+    return 'file://%s%s@%d' % (os.path.abspath(self.path), prefix, rev)
+
+  def _tree_files(self, rev, path):
+    """List the files under a directory, relative to it"""
+    cmd = [SVNLOOK, 'tree', '-r', str(rev), '--full-paths', '.',
+           path.encode(self.encoding)]
+    output = self._command(cmd).decode(self.encoding, 'replace')
+    ltrim = len(path.strip('/')) + 1
+    return [name[ltrim:] for name in output.splitlines()[1:]
+            if not name.endswith('/')]
+
+  def _diff_changes(self, rev_a, prefix_a, rev_b, prefix_b, path=None):
+    """List the files whose contents differ between two revisions
+
+    Returns a list of (path, in_a, in_b) tuples sorted like diff -r would,
+    where path is relative to the prefixes and in_a and in_b tell whether
+    the file exists on each side.  Returns None if svn cannot compare the
+    two trees.
+
+    """
+    import xml.etree.ElementTree as ET
+    try:
+      from urllib.parse import unquote
+    except ImportError:
+      from urllib import unquote
+    url_a = self._url(prefix_a, rev_a)
+    url_b = self._url(prefix_b, rev_b)
+    cmd = [SVN, 'diff', '--summarize', '--xml', url_a, url_b]
+    base = url_a.rsplit('@', 1)[0].rstrip('/')
+    if path is not None:
+      path = type(self).cleanPath(path).strip('/')
+    changes = {}
+    try:
+      for elem in self._iter_xml(cmd, 'path'):
+        name = unquote(elem.text or '')
+        if name.startswith(base):
+          name = name[len(base):]
+        name = name.strip('/')
+        if path and not (name == path or name.startswith(path + '/')):
+          continue
+        item = elem.get('item')
+        if item in ('none', 'normal'):
+          # only properties changed
+          continue
+        if elem.get('kind') != 'dir':
+          changes[name] = (item != 'added', item != 'deleted')
+        elif item != 'modified':
+          # the files of added, deleted or replaced directories
+          for in_a, in_b, rev, prefix in ((True, False, rev_a, prefix_a),
+                                          (False, True, rev_b, prefix_b)):
+            try:
+              files = self._tree_files(rev, prefix + '/' + name)
+            except subprocess.CalledProcessError:
+              continue
+            for f in files:
+              f = name + '/' + f
+              old = changes.get(f, (False, False))
+              changes[f] = (old[0] or in_a, old[1] or in_b)
+    except (subprocess.CalledProcessError, ET.ParseError):
+      return None
+    names = sorted(changes, key=lambda x: x.split('/'))
+    return [(name,) + changes[name] for name in names]
+
+  def _iter_diff_files(self, rev_a, prefix_a, rev_b, prefix_b, changes):
+    """Diff each changed file and yield (path, in_a, in_b, diff) tuples
+
+    Only the two versions of one file are on disk at a time.  They are laid
+    out as in _diff_export(), so that the output is the same as its part of
+    diff -urN.  Files whose contents turn out to be the same are skipped.
+
+    """
+    import os, shutil, tempfile
+    tmpdir = tempfile.mkdtemp(prefix='anyvcs-svn-diff.')
+    try:
+      for name, in_a, in_b in changes:
+        label_a = 'a/' + name
+        label_b = 'b/' + name
+        files = []
+        try:
+          for exists, rev, prefix, label in ((in_a, rev_a, prefix_a, label_a),
+                                             (in_b, rev_b, prefix_b, label_b)):
+            if not exists:
+              continue
+            f = os.path.join(tmpdir, label)
+            if os.path.isdir(f):
+              # left over from the files of a directory this file replaced
+              shutil.rmtree(f)
+            elif not os.path.isdir(os.path.dirname(f)):
+              os.makedirs(os.path.dirname(f))
+            epath = type(self).cleanPath(prefix + '/' + name)
+            cmd = [SVNLOOK, 'cat', '-r', str(rev), '.',
+                   epath.encode(self.encoding)]
+            files.append(f)
+            with open(f, 'wb') as out:
+              subprocess.check_call(cmd, cwd=self.path, stdout=out)
+          cmd = [DIFF, '-uN', label_a, label_b]
+          p = subprocess.Popen(cmd, cwd=tmpdir, stdout=subprocess.PIPE)
+          stdout, stderr = p.communicate()
+          if p.returncode not in (0, 1):
+            raise subprocess.CalledProcessError(p.returncode, cmd, stdout)
+        finally:
+          for f in files:
+            os.unlink(f)
+        if stdout:
+          header = 'diff -urN %s %s\n' % (label_a, label_b)
+          yield name, in_a, in_b, header.encode(self.encoding) + stdout
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def _diff_export(self, rev_a, prefix_a, rev_b, prefix_b, path=None):
     import os, shutil, tempfile
-    rev_a, prefix_a = self._maprev(rev_a)
-    rev_b, prefix_b = self._maprev(rev_b)
     tmpdir = tempfile.mkdtemp(prefix='anyvcs-svn-diff.')
     try:
       path_a = os.path.join(tmpdir, 'a')
       path_b = os.path.join(tmpdir, 'b')
-      url_a = 'file://%s/%s@%d' % (self.path, prefix_a, rev_a)
-      url_b = 'file://%s/%s@%d' % (self.path, prefix_b, rev_b)
-      cmd = [SVN, 'export', '-q', url_a, path_a]
+      cmd = [SVN, 'export', '-q', self._url(prefix_a, rev_a), path_a]
       subprocess.check_call(cmd)
-      cmd = [SVN, 'export', '-q', url_b, path_b]
+      cmd = [SVN, 'export', '-q', self._url(prefix_b, rev_b), path_b]
       subprocess.check_call(cmd)
+      # diff would follow symlinks; compare them the way svn stores them, as
+      # files holding "link TARGET", which is also what svnlook cat gives
+      for root in (path_a, path_b):
+        if not isinstance(root, bytes):
+          root = root.encode(sys.getfilesystemencoding())
+        for dirpath, dirnames, filenames in os.walk(root):
+          for name in dirnames + filenames:
+            link = os.path.join(dirpath, name)
+            if os.path.islink(link):
+              target = os.readlink(link)
+              os.unlink(link)
+              with open(link, 'wb') as f:
+                f.write(b'link ' + target)
       if path is None:
         cmd = [DIFF, '-urN', 'a', 'b']
       else:
@@ -473,6 +1061,65 @@ class SvnRepo(VCSRepo):
     finally:
       shutil.rmtree(tmpdir)
 
+  def diff(self, rev_a, rev_b, path=None):
+    rev_a, prefix_a = self._maprev(rev_a)
+    rev_b, prefix_b = self._maprev(rev_b)
+    changes = self._diff_changes(rev_a, prefix_a, rev_b, prefix_b, path)
+    if changes is None:
+      return self._diff_export(rev_a, prefix_a, rev_b, prefix_b, path)
+    files = self._iter_diff_files(rev_a, prefix_a, rev_b, prefix_b, changes)
+    return b''.join(x[3] for x in files)
+
+  def iter_diff(self, rev_a, rev_b, path=None):
+    rev_a, prefix_a = self._maprev(rev_a)
+    rev_b, prefix_b = self._maprev(rev_b)
+    is_header = lambda line, next_line: line.startswith(b'diff ')
+    changes = self._diff_changes(rev_a, prefix_a, rev_b, prefix_b, path)
+    if changes is None:
+      output = self._diff_export(rev_a, prefix_a, rev_b, prefix_b, path)
+      for header, hunks in split_diff(output.splitlines(True), is_header):
+        # diff -urN a/PATH b/PATH
+        names = header[0][len(b'diff -urN '):].rstrip(b'\n')
+        n = (len(names) - 1) // 2
+        fd = file_diff(header, hunks, self.encoding,
+                       (names[2:n], names[n+3:]))
+        # diff -N compares missing files as empty ones
+        if fd.status == 'M' and len(hunks) == 1:
+          if hunks[0][0].startswith(b'@@ -0,0 '):
+            fd.status = 'A'
+            fd.old_path = None
+          elif hunks[0][0].rstrip().endswith(b' +0,0 @@'):
+            fd.status = 'D'
+            fd.new_path = None
+        yield fd
+      return
+    files = self._iter_diff_files(rev_a, prefix_a, rev_b, prefix_b, changes)
+    try:
+      for name, in_a, in_b, text in files:
+        epath = name.encode(self.encoding)
+        for header, hunks in split_diff(text.splitlines(True), is_header):
+          fd = file_diff(header, hunks, self.encoding, (epath, epath))
+          if not in_a:
+            fd.status = 'A'
+            fd.old_path = None
+          elif not in_b:
+            fd.status = 'D'
+            fd.new_path = None
+          yield fd
+    finally:
+      files.close()
+
+  def diffstat(self, rev_a, rev_b=None):
+    num_a, prefix_a = self._maprev(rev_a)
+    if rev_b is None:
+      key = 'svn:%d' % num_a
+      diffs = lambda: self.iter_pdiff(num_a)
+    else:
+      num_b, prefix_b = self._maprev(rev_b)
+      key = 'svn:%s@%d:%s@%d' % (prefix_a, num_a, prefix_b, num_b)
+      diffs = lambda: self.iter_diff(rev_a, rev_b)
+    return self._cached_diffstat(key, lambda: diffstat_lines(diffs()))
+
   def changed(self, rev):
     rev, prefix = self._maprev(rev)
     if rev == 0:
@@ -496,28 +1143,191 @@ class SvnRepo(VCSRepo):
       results.append(entry)
     return results
 
-  def _history(self, rev, path, limit=None):
+  def _log_changes(self, logentry):
+    results = []
+    for elem in logentry.iter('path'):
+      path = elem.text.lstrip('/')
+      if elem.get('kind') == 'dir':
+        path += '/'
+      action = elem.get('action')
+      if action == 'M':
+        action = 'U' if elem.get('text-mods') != 'false' else '_'
+      status = action + ('U' if elem.get('prop-mods') == 'true' else ' ')
+      copy = None
+      if elem.get('copyfrom-path') is not None:
+        status += '+'
+        copy = elem.get('copyfrom-path').lstrip('/')
+        if path.endswith('/'):
+          copy += '/'
+        copy += ':r' + elem.get('copyfrom-rev')
+      else:
+        status += ' '
+      results.append(FileChangeInfo(path, str(status), copy))
+    # svnlook lists changes in path order
+    results.sort(key=lambda x: x.path.rstrip('/').split('/'))
+    return results
+
+  def changed_many(self, revs):
+    import os
+    revs = list(revs)
+    nums = [self._maprev(rev)[0] for rev in revs]
+    # runs of consecutive revisions become one range each, so the log
+    # entries arrive in the same order as revs
+    ranges = []
+    for num in nums:
+      if num == 0:
+        continue
+      if ranges:
+        first, last = ranges[-1]
+        if first <= last and num == last + 1 or first >= last and num == last - 1:
+          ranges[-1] = (first, num)
+          continue
+      ranges.append((num, num))
+    url = 'file://' + os.path.abspath(self.path)
+    logentries = iter(())
+    try:
+      i = 0
+      for rev, num in zip(revs, nums):
+        if num == 0:
+          yield rev, []
+          continue
+        if logentries is not None:
+          elem = next(logentries, None)
+          if elem is None:
+            cmd = [SVN, 'log', '-v', '--xml']
+            for first, last in ranges[i:i+500]:
+              cmd.extend(['-r', '%d:%d' % (first, last)])
+            cmd.append(url)
+            i += 500
+            logentries = self._iter_xml(cmd, 'logentry')
+            try:
+              elem = next(logentries)
+            except OSError:
+              # no svn client, so ask svnlook one revision at a time
+              logentries = None
+        if logentries is None:
+          yield rev, self.changed(rev)
+          continue
+        assert int(elem.get('revision')) == num, 'unexpected output'
+        yield rev, self._log_changes(elem)
+    finally:
+      if hasattr(logentries, 'close'):
+        logentries.close()
+
+  @property
+  def _history_index(self):
+    try:
+      return self._history_index_v
+    except AttributeError:
+      import os
+      index_path = os.path.join(self.private_path, 'history-index')
+      self._history_index_v = HistoryIndex(index_path)
+      return self._history_index_v
+
+  def _update_history_index(self, rev):
+    """Index the changed paths of every revision up to rev
+
+    Only the revisions after the last indexed one are read, with a single
+    svn log command.
+
+    """
+    import os
+    index = self._history_index
+    if index.rev >= rev:
+      return index
+    url = 'file://' + os.path.abspath(self.path)
+    cmd = [SVN, 'log', '-v', '--xml', '-r', '%d:%d' % (index.rev + 1, rev),
+           url]
+    def revisions():
+      expected = index.rev + 1
+      logentries = self._iter_xml(cmd, 'logentry')
+      try:
+        for elem in logentries:
+          r = int(elem.get('revision'))
+          while expected < r:
+            yield expected, []
+            expected += 1
+          changes = []
+          for p in elem.iter('path'):
+            copyfrom_rev = p.get('copyfrom-rev')
+            if copyfrom_rev is not None:
+              copyfrom_rev = int(copyfrom_rev)
+            prop_mods = p.get('prop-mods')
+            if prop_mods is not None:
+              prop_mods = prop_mods == 'true'
+            changes.append((p.get('action'), p.text, p.get('copyfrom-path'),
+                            copyfrom_rev, prop_mods))
+          yield r, changes
+          expected = r + 1
+        while expected <= rev:
+          yield expected, []
+          expected += 1
+      finally:
+        logentries.close()
+    index.add(revisions())
+    return index
+
+  def _iter_history(self, rev, path, limit=None):
+    import xml.etree.ElementTree as ET
+    rev = int(rev)
+    path = type(self).cleanPath(path)
+    if path != '/':
+      path = path.rstrip('/')
+    try:
+      index = self._update_history_index(rev)
+    except (OSError, subprocess.CalledProcessError, ET.ParseError):
+      index = None
+    if index is not None and index.rev >= rev and index.exists(path, rev):
+      for r, p in index.history(rev, path, limit):
+        yield HistoryEntry(r, p)
+      return
+    # unknown revisions and missing paths fail the same way as before
+    for entry in self._svnlook_history(rev, path, limit):
+      yield entry
+
+  def _svnlook_history(self, rev, path, limit=None):
     cmd = [SVNLOOK, 'history', '.', '-r', str(rev), path]
     if limit is not None:
       cmd.extend(['-l', str(limit)])
-    output = self._command(cmd).decode(self.encoding, 'replace')
-    results = []
-    for line in output.splitlines()[2:]:
-      r, p = line.split(None, 1)
-      results.append(HistoryEntry(int(r), p))
-    return results
+    lines = self._command_iter(cmd)
+    try:
+      # skip the two header lines
+      next(lines, None)
+      next(lines, None)
+      for line in lines:
+        r, p = line.decode(self.encoding, 'replace').split(None, 1)
+        yield HistoryEntry(int(r), p)
+    finally:
+      lines.close()
+
+  def _history(self, rev, path, limit=None):
+    return list(self._iter_history(rev, path, limit))
 
   def _mergehistory(self, rev, path, limit=None):
+    import bisect
     results = set(self._history(rev, path, limit))
-    for head, minrev, maxrev in self._mergeinfo(rev, path):
-      l = maxrev - minrev + 1
-      if limit is not None:
-        l = min(l, limit)
-      h = self._history(maxrev, head, l)
-      for r, p in h:
-        if r < minrev:
-          break
-        results.add(HistoryEntry(r, p))
+    for head, ranges in self._mergeinfo_ranges(rev, path).items():
+      # one walk down the history of each merge source, keeping the
+      # revisions that fall in its ranges, at most limit per range
+      starts = [minrev for minrev, maxrev in ranges]
+      counts = [0] * len(ranges)
+      left = len(ranges)
+      history = self._iter_history(ranges[-1][1], head)
+      try:
+        for entry in history:
+          i = bisect.bisect_right(starts, entry.rev) - 1
+          if i < 0:
+            break
+          if entry.rev > ranges[i][1] or counts[i] == limit:
+            continue
+          results.add(entry)
+          counts[i] += 1
+          if counts[i] == limit:
+            left -= 1
+            if not left:
+              break
+      finally:
+        history.close()
     return results
 
   def ancestor(self, rev1, rev2):
@@ -577,37 +1387,86 @@ class SvnRepo(VCSRepo):
 
     return None
 
-  def _blame(self, rev, path):
-    import os
+  def _iter_xml(self, cmd, tag):
+    """Yield the elements with the given tag from a command's XML output
+
+    The output is parsed as it arrives.  Elements are cleared after the
+    consumer has seen them.
+
+    """
     import xml.etree.ElementTree as ET
+    p = subprocess.Popen(cmd, cwd=self.path, stdout=subprocess.PIPE)
+    try:
+      for event, elem in ET.iterparse(p.stdout):
+        if elem.tag == tag:
+          yield elem
+          elem.clear()
+      if p.wait() != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    finally:
+      if p.poll() is None:
+        p.kill()
+        p.wait()
+      p.stdout.close()
+
+  def _iter_blame(self, rev, path):
+    """Yield the (rev, author, date) of each line of a file
+
+    The XML output is parsed as it arrives, and the tuples are shared
+    between lines from the same revision.
+
+    """
+    import os
     url = 'file://' + os.path.abspath(self.path) + path
     cmd = [SVN, 'blame', '--xml', '-r', rev, url]
-    output = self._command(cmd)
-    tree = ET.fromstring(output)
-    results = []
-    cat = self._cat(rev, path)
-    target = tree.find('target')
+    revinfo = {}
+    entries = self._iter_xml(cmd, 'entry')
     try:
-      iter = target.iter('entry')
-    except AttributeError: # added in python 2.7
-      iter = target.getiterator('entry')
-    for entry, text in zip(iter, cat.splitlines()):
-      commit = entry.find('commit')
-      rev = int(commit.attrib.get('revision'))
-      author = commit.find('author').text
-      date = commit.find('date').text
-      date = parse_isodate(date)
-      results.append(BlameInfo(rev, author, date, text))
-    return results
+      for elem in entries:
+        commit = elem.find('commit')
+        rev = int(commit.attrib.get('revision'))
+        try:
+          info = revinfo[rev]
+        except KeyError:
+          author = commit.findtext('author')
+          date = parse_isodate(commit.findtext('date'))
+          info = revinfo[rev] = (rev, author, date)
+        yield info
+    finally:
+      entries.close()
 
-  def blame(self, rev, path):
+  def _node_id(self, rev, path):
+    """Get the node-revision id of a path, or None"""
+    cmd = [SVNLOOK, 'tree', '--show-ids', '-N', '-r', rev, '.', path]
+    output = self._command(cmd).decode(self.encoding, 'replace')
+    m = node_id_rx.search(output.splitlines()[0]) if output else None
+    return m and m.group('id')
+
+  def _cached_blame(self, rev, path):
+    def identity():
+      # a node-revision is only shared by revisions that did not change it
+      node_id = self._node_id(rev, path)
+      return node_id and 'svn:%s:%s' % (node_id, path)
+    return self._cached_blame_hunks('svn:%s:%s' % (rev, path), identity,
+      lambda: blame_runs(self._iter_blame(rev, path)))
+
+  def _blame_check(self, rev, path):
     rev, prefix = self._maprev(rev)
     path = type(self).cleanPath(prefix + path)
     ls = self.ls(rev, path, directory=True)
     assert len(ls) == 1
     if ls[0].get('type') != 'f':
       raise BadFileType(rev, path)
-    return self._blame(str(rev), path)
+    return str(rev), path
+
+  def blame(self, rev, path):
+    rev, path = self._blame_check(rev, path)
+    hunks = self._cached_blame(rev, path)
+    return blame_lines(hunks, self._cat(rev, path).splitlines())
+
+  def blame_hunks(self, rev, path):
+    rev, path = self._blame_check(rev, path)
+    return self._cached_blame(rev, path)
 
   def dump(self, stream, progress=None, lower=None, upper=None,
            incremental=False, deltas=False):
@@ -0,0 +1,244 @@
+# Copyright (c) 2013, Clemson University
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the {organization} nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""An in-memory index of the changed paths of Subversion revisions
+
+Each revision's changed paths, with their actions and copy sources, are kept
+in an append-only index file with one JSON record per line.  The records are
+loaded into maps from each path to the revisions that touched it, so that
+the history of a path can be followed without running svnlook.
+
+"""
+
+import bisect
+import fcntl
+import json
+import os
+import threading
+
+def parent_paths(path):
+  """Yield the parent directories of an absolute path, nearest first"""
+  while True:
+    path = path.rsplit('/', 1)[0]
+    if not path:
+      return
+    yield path
+
+class HistoryIndex(object):
+  """Path history queries answered in memory
+
+  :param index_path: The path of the index file.
+
+  Paths start with a / and have no trailing /.
+
+  """
+
+  def __init__(self, index_path):
+    self.index_path = index_path
+    self.rev = 0
+    self._lock = threading.Lock()
+    # path -> ascending revisions that changed the path or anything below it
+    self._touched = {}
+    # path -> (ascending revisions, (action, copyfrom_path, copyfrom_rev)
+    # tuples) for each time the path was added, replaced or deleted
+    self._nodes = {}
+    # path -> ascending revisions that may have changed the path's properties
+    self._props = {}
+    self._index_size = 0
+    try:
+      with open(index_path, 'rb') as f:
+        self._read_index(f)
+    except IOError:
+      pass
+
+  def _read_index(self, f):
+    f.seek(self._index_size)
+    data = f.read()
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+      rev, changes = json.loads(line.decode('utf-8'))
+      self._add(rev, changes)
+    self._index_size += end
+
+  def _add(self, rev, changes):
+    if rev != self.rev + 1:
+      return
+    self.rev = rev
+    for change in changes:
+      action, path, copyfrom_path, copyfrom_rev = change[:4]
+      # records written before property changes were noted may have changed
+      # them
+      if action in 'AR' or len(change) < 5 or change[4] is not False:
+        self._props.setdefault(path, []).append(rev)
+      for p in [path] + list(parent_paths(path)):
+        revs = self._touched.setdefault(p, [])
+        if revs and revs[-1] == rev:
+          # parents already seen for this revision
+          break
+        revs.append(rev)
+      if action in 'ARD':
+        revs, nodes = self._nodes.setdefault(path, ([], []))
+        revs.append(rev)
+        nodes.append((rev, action, copyfrom_path, copyfrom_rev))
+
+  def add(self, revisions):
+    """Add revisions to the index file
+
+    revisions is an iterable of (rev, changes) tuples in ascending order,
+    starting right after the last indexed revision, where changes is a list
+    of (action, path, copyfrom_path, copyfrom_rev, prop_mods) tuples.
+    prop_mods tells whether the properties of the path changed, or is None
+    if that is not known.  Revisions which changed nothing must be included
+    too, with no changes.
+
+    """
+    with self._lock:
+      with open(self.index_path, 'a+b') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+          # pick up anything appended by other processes first
+          self._read_index(f)
+          records = []
+          try:
+            for rev, changes in revisions:
+              if rev != self.rev + 1:
+                continue
+              changes = [list(x) for x in changes]
+              self._add(rev, changes)
+              records.append(json.dumps([rev, changes], separators=(',', ':')))
+          finally:
+            # keep whatever was indexed before an error
+            f.seek(self._index_size)
+            f.truncate()
+            data = ''.join(r + '\n' for r in records).encode('utf-8')
+            f.write(data)
+            f.flush()
+            self._index_size += len(data)
+        finally:
+          fcntl.lockf(f, fcntl.LOCK_UN)
+
+  def _latest(self, items, rev):
+    """Get the last item of an ascending list which is at most rev"""
+    i = bisect.bisect_right(items, rev)
+    return items[i-1] if i else None
+
+  def _node(self, path, rev):
+    """Get the last add, replace or delete of path or its parents up to rev
+
+    Returns a (node, path) tuple, where path is the one the node belongs to,
+    or (None, None).
+
+    """
+    best = best_path = None
+    for p in [path] + list(parent_paths(path)):
+      try:
+        revs, nodes = self._nodes[p]
+      except KeyError:
+        continue
+      i = bisect.bisect_right(revs, rev)
+      if i and (best is None or revs[i-1] > best[0]):
+        best = nodes[i-1]
+        best_path = p
+    return best, best_path
+
+  def exists(self, path, rev):
+    """Test whether path is known to exist in revision rev
+
+    A path exists if it was added itself, or if a parent directory was
+    copied from somewhere it existed.  Anything else, including revisions
+    that are not indexed, is reported as not existing.
+
+    """
+    if rev > self.rev:
+      return False
+    while path != '/':
+      node, node_path = self._node(path, rev)
+      if node is None or node[1] == 'D':
+        return False
+      if node_path == path:
+        return True
+      if node[2] is None:
+        # the parent was added empty, and path never was
+        return False
+      path = node[2].rstrip('/') + path[len(node_path):]
+      rev = node[3]
+    return True
+
+  def props_rev(self, path, rev):
+    """Get the revision that last set the properties of a path
+
+    Returns the last revision up to rev that may have changed them, so that
+    they are the same in every revision from that one to rev.  Raises
+    KeyError if rev is not indexed or path does not exist in it.
+
+    """
+    if rev > self.rev or not self.exists(path, rev):
+      raise KeyError((rev, path))
+    if path == '/':
+      return self._latest(self._props.get(path, ()), rev) or 0
+    node, node_path = self._node(path, rev)
+    result = self._latest(self._props.get(path, ()), rev)
+    if result is None or node[0] > result:
+      # copied along with a parent
+      result = node[0]
+    return result
+
+  def history(self, rev, path, limit=None):
+    """Yield the (rev, path) of each revision that changed path
+
+    Like ``svnlook history``, copies are followed and the history starts at
+    rev.  Raises KeyError if rev is not indexed or path does not exist in it.
+
+    """
+    if rev > self.rev or not self.exists(path, rev):
+      raise KeyError((rev, path))
+    count = 0
+    if path == '/':
+      for r in range(rev, -1, -1):
+        if count == limit:
+          return
+        yield r, path
+        count += 1
+      return
+    while rev > 0 and count != limit:
+      touched = self._latest(self._touched.get(path, ()), rev)
+      node, node_path = self._node(path, rev)
+      if node is None or (touched is not None and touched > node[0]):
+        if touched is None:
+          return
+        yield touched, path
+        count += 1
+        rev = touched - 1
+        continue
+      # the path was created in this revision, possibly by copying
+      yield node[0], path
+      count += 1
+      if node[2] is None:
+        return
+      path = node[2].rstrip('/') + path[len(node_path):]
+      rev = node[3]
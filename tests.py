@@ -28,6 +28,7 @@
 
 import anyvcs
 import datetime
+import gc
 import getpass
 import os
 import re
@@ -36,13 +37,14 @@ import subprocess
 import sys
 import tempfile
 import time
+import weakref
 if sys.hexversion < 0x02070000:
   import unittest2 as unittest
 else:
   import unittest
 import xml.etree.ElementTree as ET
 from abc import ABCMeta, abstractmethod
-from anyvcs.common import CommitLogEntry, UTCOffset, UnknownVCSType, PathDoesNotExist, BadFileType
+from anyvcs.common import CommitLogEntry, UTCOffset, UnknownVCSType, PathDoesNotExist, BadFileType, RevisionDoesNotExist
 
 keep_test_dir = False
 
@@ -821,6 +823,34 @@ class BasicTest(object):
   def test_cat_error5(self):
     self.assertRaises(BadFileType, self.repo.cat, self.main_branch, '/')
 
+  def test_cat_stream(self):
+    stream = self.repo.cat_stream(self.main_branch, '/c/d/e')
+    try:
+      self.assertIn(stream.length, (None, 6))
+      self.assertEqual('Denali'.encode(), stream.read())
+    finally:
+      stream.close()
+
+  def test_cat_range(self):
+    result = self.repo.cat(self.main_branch, '/c/d/e', offset=1, length=3)
+    self.assertEqual('ena'.encode(), result)
+    result = self.repo.cat(self.main_branch, '/c/d/e', offset=4)
+    self.assertEqual('li'.encode(), result)
+    result = self.repo.cat(self.main_branch, '/c/d/e', offset=10)
+    self.assertEqual(''.encode(), result)
+
+  def test_cat_stream_range(self):
+    stream = self.repo.cat_stream(self.main_branch, '/c/d/e', 2, 10)
+    try:
+      self.assertIn(stream.length, (None, 4))
+      self.assertEqual('nali'.encode(), stream.read())
+    finally:
+      stream.close()
+
+  def test_cat_stream_error(self):
+    self.assertRaises(PathDoesNotExist, self.repo.cat_stream, self.main_branch, '/z')
+    self.assertRaises(BadFileType, self.repo.cat_stream, self.main_branch, '/c')
+
   def test_readlink1(self):
     result = self.repo.readlink(self.main_branch, 'b')
     correct = 'a'
@@ -868,6 +898,12 @@ class BasicTest(object):
     self.assertEqual(self.rev1, result.rev)
     self.assertIsInstance(result.date, datetime.datetime)
 
+  def test_iter_log_rev(self):
+    result = list(self.repo.iter_log(revrange=self.rev1))
+    self.assertEqual(1, len(result))
+    self.assertIsInstance(result[0], CommitLogEntry)
+    self.assertEqual(self.rev1, result[0].rev)
+
   def test_in(self):
     self.assertIn(self.rev1, self.repo)
 
@@ -923,10 +959,45 @@ class BasicTest(object):
     rc = subprocess.call(['diff', '-urN', path_a, path_b])
     self.assertEqual(0, rc)
 
+  def test_iter_pdiff_rev1(self):
+    pdiff = self.repo.pdiff(self.rev1)
+    result = list(self.repo.iter_pdiff(self.rev1))
+    # Hg ends each changeset in log -p output with a blank line
+    text = b''.join(x.text for x in result)
+    self.assertTrue(pdiff.rstrip(b'\n').endswith(text.rstrip(b'\n')))
+    for path in ('a', 'b', 'c/d/e', 'c/d/f'):
+      match = [x for x in result
+               if x.path == path or x.path.endswith('/' + path)]
+      self.assertEqual(1, len(match))
+      self.assertEqual('A', match[0].status)
+      self.assertEqual(None, match[0].old_path)
+
+  def test_iter_pdiff_close(self):
+    diffs = self.repo.iter_pdiff(self.rev1)
+    self.assertTrue(next(diffs).header)
+    diffs.close()
+
+  def test_diffstat_rev1(self):
+    result = self.repo.diffstat(self.rev1)
+    self.assertEqual(result, self.repo.diffstat(self.rev1))
+    for path in ('a', 'c/d/e'):
+      match = [x for x in result
+               if x.path == path or x.path.endswith('/' + path)]
+      self.assertEqual(1, len(match))
+      self.assertEqual((1, 0, False), match[0][1:])
+
   def test_canonical_rev(self):
     result = self.repo.canonical_rev(self.working_head)
     self.assertEqual(self.rev1, result)
 
+  def test_canonical_rev_many(self):
+    revs = [self.working_head, 'nosuchrev:x', self.main_branch]
+    result = self.repo.canonical_rev_many(revs)
+    self.assertEqual(3, len(result))
+    self.assertEqual(self.rev1, result[0])
+    self.assertIsInstance(result[1], RevisionDoesNotExist)
+    self.assertEqual(self.rev1, result[2])
+
 class GitLikeBasicTest(BasicTest):
   def test_log_all(self):
     result = self.repo.log()
@@ -953,6 +1024,14 @@ class GitLikeBasicTest(BasicTest):
     self.assertIsInstance(result[0].date, datetime.datetime)
     self.assertEqual('Pisgah'.encode(), result[0].line)
 
+  def test_blame_hunks(self):
+    result = list(self.repo.blame_hunks(self.main_branch, 'a'))
+    self.assertEqual(1, len(result))
+    self.assertEqual(self.rev1, result[0].rev)
+    self.assertEqual('Test User <me@example.com>', result[0].author)
+    self.assertIsInstance(result[0].date, datetime.datetime)
+    self.assertEqual((1, 1), (result[0].start_line, result[0].line_count))
+
 class GitBasicTest(GitTest, GitLikeBasicTest):
   def test_branches(self):
     result = self.repo.branches()
@@ -969,6 +1048,227 @@ class GitBasicTest(GitTest, GitLikeBasicTest):
     correct = ['master']
     self.assertEqual(normalize_heads(correct), normalize_heads(result))
 
+  def test_cat_restart(self):
+    self.repo.use_object_store = False
+    try:
+      self.assertEqual('Pisgah'.encode(), self.repo.cat(self.main_branch, 'a'))
+      p = self.repo._cat_file._proc
+      p.kill()
+      p.wait()
+      self.assertEqual('Denali'.encode(),
+                       self.repo.cat(self.main_branch, 'c/d/e'))
+    finally:
+      self.repo.use_object_store = True
+
+  def test_cat_file_missing(self):
+    cat_file = self.repo._cat_file
+    branch = self.main_branch.encode()
+    self.assertEqual(None, cat_file.get(branch + b':no such file'))
+    self.assertEqual(None, cat_file.get(branch + b':no such'))
+    self.assertEqual(None, cat_file.get(b'no-such-rev'))
+    self.assertEqual(b'Pisgah', cat_file.get(branch + b':a')[3])
+
+  def test_command_iter_keepends(self):
+    cmd = ['printf', 'a\\r\\nb\\nc']
+    self.assertEqual([b'a\r', b'b', b'c'], list(self.repo._command_iter(cmd)))
+    self.assertEqual([b'a\r\n', b'b\n', b'c'],
+                     list(self.repo._command_iter(cmd, keepends=True)))
+
+  def test_close(self):
+    self.assertEqual('Pisgah'.encode(), self.repo.cat(self.main_branch, 'a'))
+    self.repo.close()
+    self.assertEqual(None, self.repo._cat_file._proc)
+    self.assertEqual('a', self.repo.readlink(self.main_branch, 'b'))
+
+  def test_refs_update(self):
+    self.assertEqual(['master'], self.repo.branches())
+    check_call(['git', 'branch', 'refs-test', 'master'], cwd=self.main_path)
+    try:
+      self.assertEqual(['master', 'refs-test'], self.repo.branches())
+      check_call(['git', 'pack-refs', '--all'], cwd=self.main_path)
+      self.assertEqual(['master', 'refs-test'], self.repo.branches())
+      self.assertEqual(self.rev1, self.repo.canonical_rev('refs-test'))
+      cmd = ['git', '-c', 'user.name=Test User',
+             '-c', 'user.email=me@example.com', 'commit-tree',
+             '-p', self.rev1, '-m', 'refs test', self.rev1 + '^{tree}']
+      rev2 = check_output(cmd, cwd=self.main_path).decode().strip()
+      check_call(['git', 'update-ref', 'refs/heads/refs-test', rev2],
+                 cwd=self.main_path)
+      self.assertEqual(rev2, self.repo.canonical_rev('refs-test'))
+    finally:
+      check_call(['git', 'branch', '-D', 'refs-test'], cwd=self.main_path)
+    self.assertEqual(['master'], self.repo.branches())
+    self.assertFalse(self.repo.empty())
+
+  def test_blame_hunks_order(self):
+    self.check_call(['git', 'checkout', '-q', '-b', 'blame-test'])
+    try:
+      with open(os.path.join(self.working_path, 'h'), 'w') as f:
+        f.write(''.join('%d\n' % i for i in range(10)))
+      self.check_call(['git', 'add', 'h'])
+      self.check_call(['git', 'commit', '-q', '-m', 'blame 1'])
+      rev1 = self.getAbsoluteRev()
+      with open(os.path.join(self.working_path, 'h'), 'w') as f:
+        f.write(''.join('%d\n' % (i * (i in (3, 4, 7)) * 10 or i)
+                        for i in range(10)))
+      self.check_call(['git', 'commit', '-q', '-a', '-m', 'blame 2'])
+      rev2 = self.getAbsoluteRev()
+      self.check_call(['git', 'push', '-q', 'origin', 'blame-test'])
+      result = list(self.repo.blame_hunks('blame-test', 'h'))
+      correct = [(rev1, 1, 3), (rev2, 4, 2), (rev1, 6, 2), (rev2, 8, 1),
+                 (rev1, 9, 2)]
+      self.assertEqual(correct,
+                       [(x.rev, x.start_line, x.line_count) for x in result])
+      self.assertTrue(result[0].date is result[2].date)
+      lines = self.repo.blame('blame-test', 'h')
+      self.assertEqual([x.rev for x in lines],
+                       [x.rev for x in result for i in range(x.line_count)])
+    finally:
+      self.check_call(['git', 'checkout', '-q', 'master'])
+      check_call(['git', 'branch', '-D', 'blame-test'], cwd=self.main_path)
+
+  def test_blame_crlf(self):
+    self.check_call(['git', 'checkout', '-q', '-b', 'blame-crlf'])
+    try:
+      with open(os.path.join(self.working_path, 'crlf'), 'wb') as f:
+        f.write(b'one\r\ntwo\r\n')
+      self.check_call(['git', 'add', 'crlf'])
+      self.check_call(['git', 'commit', '-q', '-m', 'crlf'])
+      self.check_call(['git', 'push', '-q', 'origin', 'blame-crlf'])
+      result = self.repo.blame('blame-crlf', 'crlf')
+      self.assertEqual([b'one', b'two'], [x.line for x in result])
+      result = list(self.repo.blame_hunks('blame-crlf', 'crlf'))
+      self.assertEqual([(1, 2)], [(x.start_line, x.line_count) for x in result])
+    finally:
+      self.check_call(['git', 'checkout', '-q', 'master'])
+      check_call(['git', 'branch', '-D', 'blame-crlf'], cwd=self.main_path)
+
+  def test_blame_cache(self):
+    correct = list(self.repo.blame_hunks(self.rev1, 'a'))
+    tree = check_output(['git', 'rev-parse', 'master^{tree}'],
+                        cwd=self.main_path).decode().strip()
+    commit = check_output(['git', '-c', 'user.name=Test User',
+                           '-c', 'user.email=me@example.com', 'commit-tree',
+                           '-p', 'master', '-m', 'blame', tree],
+                          cwd=self.main_path).decode().strip()
+    def fail(rev, path):
+      raise AssertionError('blame cache miss')
+    self.repo._blame_hunks = fail
+    try:
+      self.assertEqual(correct, list(self.repo.blame_hunks(self.rev1, 'a')))
+      self.assertEqual(correct, list(self.repo.blame_hunks(commit, 'a')))
+      result = self.repo.blame(commit, 'a')
+      self.assertEqual(self.rev1, result[0].rev)
+      self.assertEqual('Pisgah'.encode(), result[0].line)
+    finally:
+      del self.repo._blame_hunks
+
+  def test_len_cache(self):
+    count = len(self.repo)
+    self.assertEqual(count, self.repo._load_len_cache()[1])
+    tree = check_output(['git', 'rev-parse', 'master^{tree}'],
+                        cwd=self.main_path).decode().strip()
+    commit = check_output(['git', '-c', 'user.name=Test User',
+                           '-c', 'user.email=me@example.com', 'commit-tree',
+                           '-p', 'master', '-m', 'len', tree],
+                          cwd=self.main_path).decode().strip()
+    check_call(['git', 'branch', 'len-test', commit], cwd=self.main_path)
+    try:
+      self.assertEqual(count + 1, len(self.repo))
+      self.assertEqual(sorted([commit, self.rev1]),
+                       sorted(self.repo._load_len_cache()[2]))
+    finally:
+      check_call(['git', 'branch', '-D', 'len-test'], cwd=self.main_path)
+    self.assertEqual(count, len(self.repo))
+
+  def check_object_store(self, repo):
+    report = ('size', 'target', 'executable')
+    result = repo.ls(self.rev1, '/', recursive=True, recursive_dirs=True,
+                     report=report)
+    repo.use_object_store = False
+    correct = repo.ls(self.rev1, '/', recursive=True, recursive_dirs=True,
+                      report=report)
+    repo.use_object_store = True
+    self.assertEqual(normalize_ls(correct), normalize_ls(result))
+    self.assertEqual('Denali'.encode(), repo.cat(self.rev1, 'c/d/e'))
+    with repo.cat_stream(self.rev1, 'c/d/e') as stream:
+      self.assertEqual(6, stream.length)
+      self.assertEqual('Den'.encode(), stream.read(3))
+      self.assertEqual('ali'.encode(), stream.read())
+    with repo.cat_stream(self.rev1, 'c/d/e', 1, 2) as stream:
+      self.assertEqual(2, stream.length)
+      self.assertEqual('en'.encode(), stream.read())
+    self.assertEqual('e', repo.readlink(self.rev1, 'c/d/f'))
+    self.assertRaises(PathDoesNotExist, repo.cat, self.rev1, 'c/x')
+    self.assertRaises(BadFileType, repo.cat, self.rev1, 'c/d')
+
+  def test_object_store_loose(self):
+    self.check_object_store(self.repo)
+
+  def test_object_store_packed(self):
+    check_call(['git', 'gc', '--quiet'], cwd=self.main_path)
+    with anyvcs.open(self.main_path, 'git') as repo:
+      self.check_object_store(repo)
+      self.assertTrue(repo._objects._packs)
+
+  def test_object_store_repack(self):
+    check_call(['git', 'gc', '--quiet'], cwd=self.main_path)
+    with anyvcs.open(self.main_path, 'git') as repo:
+      self.check_object_store(repo)
+      store = repo._objects
+      # a second pack holding one object, which repack -a makes redundant
+      tree = check_output(['git', 'rev-parse', 'master^{tree}'],
+                          cwd=self.main_path).strip()
+      p = subprocess.Popen(['git', 'pack-objects', '-q', 'objects/pack/pack'],
+                           cwd=self.main_path, stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+      name = p.communicate(tree + b'\n')[0].decode().strip()
+      self.assertEqual(0, p.returncode)
+      self.assertTrue(store._refresh_packs())
+      extra = [x for x in store._packs if name in x.path]
+      self.assertEqual(1, len(extra))
+      check_call(['git', 'repack', '-a', '-d', '-q'], cwd=self.main_path)
+      self.assertTrue(store._refresh_packs())
+      self.assertFalse(extra[0] in store._packs)
+      # nothing else keeps the removed pack mapped
+      ref = weakref.ref(extra.pop())
+      gc.collect()
+      self.assertEqual(None, ref())
+      self.check_object_store(repo)
+
+  def test_resolve_single_command(self):
+    repo = anyvcs.open(self.main_path, 'git')
+    repo.use_object_store = False
+    commands = []
+    command = repo._command
+    def record(cmd, *args, **kwargs):
+      commands.append(cmd)
+      return command(cmd, *args, **kwargs)
+    repo._command = record
+    try:
+      self.assertEqual('Pisgah'.encode(), repo.cat(self.rev1, 'a'))
+      self.assertEqual(1, len(commands))
+      del commands[:]
+      result = repo.ls(self.rev1, 'c/d')
+      self.assertEqual(['e', 'f'], sorted(x.name for x in result))
+      self.assertEqual(1, len(commands))
+    finally:
+      repo.close()
+
+  def test_tree_cache(self):
+    with anyvcs.open(self.main_path, 'git') as repo:
+      repo.tree_cache_on_disk = True
+      correct = repo.ls(self.rev1, '/', recursive=True)
+      tree = repo._objects.peel_tree(self.rev1)
+      self.assertIsNotNone(repo._trees.get(tree))
+    with anyvcs.open(self.main_path, 'git') as repo:
+      repo.tree_cache_on_disk = True
+      def tree(objid):
+        raise AssertionError('tree read from the object store')
+      repo._objects.tree = tree
+      result = repo.ls(self.rev1, '/', recursive=True)
+      self.assertEqual(normalize_ls(correct), normalize_ls(result))
+
 class HgBasicTest(HgTest, GitLikeBasicTest):
   def test_branches(self):
     result = self.repo.branches()
@@ -990,12 +1290,39 @@ class HgBasicTest(HgTest, GitLikeBasicTest):
     correct = ['default', 'tip']
     self.assertEqual(normalize_heads(correct), normalize_heads(result))
 
+  def test_ls_sizes(self):
+    repo = anyvcs.open(self.main_path, 'hg')
+    def cat(rev, path):
+      raise AssertionError('hg files did not report ' + path)
+    repo._cat = cat
+    rev = repo.canonical_rev(self.main_branch)
+    result = repo._ls_sizes(rev, '', [('a', 'node a'), ('c/d/e', 'node e')],
+                            True)
+    self.assertEqual({'a': 6, 'c/d/e': 6}, result)
+    commands = []
+    command_iter = repo._command_iter
+    def record(cmd, *args, **kwargs):
+      commands.append(cmd)
+      return command_iter(cmd, *args, **kwargs)
+    repo._command_iter = record
+    result = repo._ls_sizes(rev, 'c/d', [('c/d/e', 'node e2')], False)
+    self.assertEqual({'c/d/e': 6}, result)
+    self.assertEqual('rootfilesin:c/d', commands[-1][-1])
+    result = repo._ls_sizes(rev, 'a', [('a', 'node a2')], False)
+    self.assertEqual({'a': 6}, result)
+    self.assertEqual('path:a', commands[-1][-1])
+
 class SvnBasicTest(SvnTest, BasicTest):
   def test_branches(self):
     result = self.repo.branches()
     correct = ['HEAD']
     self.assertEqual(normalize_heads(correct), normalize_heads(result))
 
+  def test_diff_symlink(self):
+    args = self.repo._maprev(0) + self.repo._maprev(self.rev1) + (None,)
+    for diff in (self.repo._diff_export(*args), self.repo.diff(0, self.rev1)):
+      self.assertTrue(b'\n+link a' in diff)
+
   def test_tags(self):
     result = self.repo.tags()
     correct = []
@@ -1037,6 +1364,70 @@ class SvnBasicTest(SvnTest, BasicTest):
     self.assertIsInstance(result[0].date, datetime.datetime)
     self.assertEqual('Pisgah'.encode(), result[0].line)
 
+  def test_blame_hunks(self):
+    result = list(self.repo.blame_hunks(self.main_branch, 'a'))
+    self.assertEqual(1, len(result))
+    self.assertEqual(self.rev1, result[0].rev)
+    self.assertEqual(getpass.getuser(), result[0].author)
+    self.assertIsInstance(result[0].date, datetime.datetime)
+    self.assertEqual((1, 1), (result[0].start_line, result[0].line_count))
+
+  def test_youngest(self):
+    path = os.path.join(self.dir, 'youngest')
+    repo = anyvcs.create(path, 'svn')
+    def command(cmd, *args, **kwargs):
+      raise AssertionError('db/current was not read')
+    repo._command = command
+    self.assertEqual(0, repo.youngest())
+    self.assertEqual(0, repo._youngest_v[1])
+    check_call(['svn', 'mkdir', '-m', 'youngest', 'file://' + path + '/d'])
+    self.assertEqual(1, repo.youngest())
+    self.assertEqual(1, repo._youngest_v[1])
+
+  def test_pdiff_rewrite(self):
+    for rev in range(self.repo.youngest() + 1):
+      correct = b''
+      if rev:
+        # what pdiff did before it streamed
+        output = check_output(['svnlook', 'diff', '.', '-r', str(rev)],
+                              cwd=self.main_path)
+        for line in output.splitlines(True):
+          if line.startswith(b'--- '):
+            line = b'--- a/' + line[4:]
+          if line.startswith(b'+++ '):
+            line = b'+++ b/' + line[4:]
+          correct += line
+      self.assertEqual(correct, self.repo.pdiff(rev))
+
+  def test_bulk_proplist(self):
+    rev = self.repo.youngest()
+    result = self.repo._bulk_proplist(rev, '/', 'infinity')
+    for path in ('/a', '/b', '/c/d/e', '/c/d/f'):
+      correct = self.repo._proplist(str(rev), path)
+      self.assertEqual(sorted(correct), sorted(result.get(path, ())))
+
+  def test_bulk_sizes(self):
+    rev = self.repo.youngest()
+    result = self.repo._bulk_sizes(rev, '/', 'infinity')
+    for path in ('/a', '/c/d/e'):
+      correct = len(self.repo._cat(str(rev), path))
+      self.assertEqual(correct, result[path])
+
+  def test_ls_without_svn(self):
+    import anyvcs.svn
+    report = ['executable', 'target', 'size']
+    correct = self.repo.ls(self.main_branch, '/', recursive=True, report=report)
+    svn = anyvcs.svn.SVN
+    anyvcs.svn.SVN = os.path.join(self.dir, 'no-svn')
+    try:
+      repo = anyvcs.open(self.main_path, 'svn')
+      self.assertEqual(None, repo._bulk_proplist(repo.youngest(), '/', 'infinity'))
+      self.assertEqual(None, repo._bulk_sizes(repo.youngest(), '/', 'infinity'))
+      result = repo.ls(self.main_branch, '/', recursive=True, report=report)
+    finally:
+      anyvcs.svn.SVN = svn
+    self.assertEqual(normalize_ls(correct), normalize_ls(result))
+
 ### TEST CASE: UnrelatedBranchTest ###
 
 class UnrelatedBranchTest(object):
@@ -1229,12 +1620,28 @@ class BranchTestStep3(object):
     result = self.repo.cat(branch1, '/b')
     self.assertEqual('step 3'.encode(), result)
 
+  def test_iter_log_close(self):
+    correct = self.repo.log(limit=2)
+    result = self.repo.iter_log()
+    self.assertEqual(correct[0].rev, next(result).rev)
+    self.assertEqual(correct[1].rev, next(result).rev)
+    result.close()
+    self.assertRaises(StopIteration, next, result)
+
 class GitLikeBranchTestStep3(BranchTestStep3):
   def test_branches(self):
     result = self.repo.branches()
     correct = list(map(self.encode_branch, [self.main_branch, 'branch1']))
     self.assertEqual(sorted(correct), sorted(result))
 
+  def test_ls_report_commit(self):
+    result = self.repo.ls(self.encode_branch('branch1'), '/', report=('commit',))
+    correct = [
+      {'path':'a', 'name':'a', 'type':'f', 'commit':self.rev[2]},
+      {'path':'b', 'name':'b', 'type':'f', 'commit':self.rev[4]},
+    ]
+    self.assertEqual(normalize_ls(correct), normalize_ls(result))
+
   def test_log_main(self):
     result = self.revrev[self.repo.log(revrange=self.main_branch).rev]
     correct = 2
@@ -1426,6 +1833,27 @@ class BranchTestStep7(object):
     rc = subprocess.call(['diff', '-urN', path_a, path_b])
     self.assertEqual(0, rc)
 
+  def test_diffstat_main_branch1a(self):
+    branch1a = self.encode_branch('branch1a')
+    diff = self.repo.diff(self.main_branch, branch1a)
+    result = self.repo.diffstat(self.main_branch, branch1a)
+    added = sum(x.added for x in result)
+    removed = sum(x.removed for x in result)
+    lines = diff.splitlines()
+    self.assertEqual(len([x for x in lines if x.startswith(b'+')]) -
+                     len([x for x in lines if x.startswith(b'+++ ')]), added)
+    self.assertEqual(len([x for x in lines if x.startswith(b'-')]) -
+                     len([x for x in lines if x.startswith(b'--- ')]), removed)
+
+  def test_iter_diff_main_branch1a(self):
+    branch1a = self.encode_branch('branch1a')
+    diff = self.repo.diff(self.main_branch, branch1a)
+    result = list(self.repo.iter_diff(self.main_branch, branch1a))
+    self.assertEqual(diff, b''.join(x.text for x in result))
+    for x in result:
+      self.assertIn(x.status, ('A', 'D', 'M', 'R', 'C'))
+      self.assertTrue(x.path)
+
   def test_changed_rev2(self):
     branch_prefix = self.branch_prefix(self.main_branch)
     result = self.repo.changed(self.rev[2])
@@ -1438,6 +1866,15 @@ class BranchTestStep7(object):
     correct = [branch_prefix+'b']
     self.assertEqual(correct, [x.path for x in result])
 
+  def test_changed_many(self):
+    revs = [self.rev[k] for k in sorted(self.rev) if self.rev[k] not in (None, '')]
+    result = list(self.repo.changed_many(revs))
+    self.assertEqual(revs, [rev for rev, changes in result])
+    for rev, changes in result:
+      correct = self.repo.changed(rev)
+      self.assertEqual([(x.path, x.status, x.copy) for x in correct],
+                       [(x.path, x.status, x.copy) for x in changes])
+
 class GitLikeBranchTestStep7(BranchTestStep7):
   def test_branches(self):
     result = self.repo.branches()
@@ -1514,7 +1951,50 @@ class GitLikeBranchTestStep7(BranchTestStep7):
     correct = [7]
     self.assertEqual(correct, result)
 
-class GitBranchTestStep7(GitTest, GitLikeBranchTestStep7): pass
+class GitBranchTestStep7(GitTest, GitLikeBranchTestStep7):
+  def test_is_ancestor(self):
+    branch1 = self.encode_branch('branch1')
+    self.assertTrue(self.repo.is_ancestor(self.rev[5], branch1))
+    self.assertTrue(self.repo.is_ancestor(branch1, branch1))
+    self.assertFalse(self.repo.is_ancestor(branch1, self.main_branch))
+
+  def test_ancestor_commit_graph(self):
+    check_call(['git', 'commit-graph', 'write', '--reachable'],
+               cwd=self.main_path)
+    branch1a = self.encode_branch('branch1a')
+    branch2 = self.encode_branch('branch2')
+    with anyvcs.open(self.main_path, 'git') as repo:
+      self.assertEqual(self.rev[5], repo.ancestor(branch1a, branch2))
+      self.assertEqual(len(self.repo), len(repo))
+      self.assertTrue(repo._graph._layers)
+
+  def test_commit_graph_rewrite(self):
+    check_call(['git', 'commit-graph', 'write', '--reachable'],
+               cwd=self.main_path)
+    branch1 = self.encode_branch('branch1')
+    with anyvcs.open(self.main_path, 'git') as repo:
+      graph = repo._acquire_graph()
+      self.assertTrue(graph._layers)
+      os.unlink(os.path.join(repo._git_dir, 'objects', 'info', 'commit-graph'))
+      self.assertTrue(repo.is_ancestor(self.rev[5], branch1))
+      self.assertFalse(graph is repo._graph)
+      # still in use here, so only closed once released
+      self.assertTrue(graph._layers)
+      graph.release()
+      self.assertEqual([], graph._layers)
+
+  def test_commit_graph_unknown_parent(self):
+    with anyvcs.open(self.main_path, 'git') as repo:
+      graph = repo._graph
+      known = repo.canonical_rev(self.rev[5])
+      self.assertTrue(repo.is_ancestor(known, self.encode_branch('branch1')))
+      size = len(graph)
+      commits = [('1' * 40, [known]), ('2' * 40, ['3' * 40])]
+      self.assertRaises(KeyError, graph.add, commits)
+      self.assertEqual(size + 1, len(graph))
+      self.assertTrue(graph.lookup('1' * 40) is not None)
+      self.assertTrue(graph.lookup('2' * 40) is None)
+
 class HgBranchTestStep7(HgTest, GitLikeBranchTestStep7): pass
 class SvnBranchTestStep7(SvnTest, BranchTestStep7):
   def test_branches(self):
@@ -1528,6 +2008,88 @@ class SvnBranchTestStep7(SvnTest, BranchTestStep7):
     correct = 5
     self.assertEqual(correct, result)
 
+  def test_history_index(self):
+    youngest = self.repo.youngest()
+    for branch in [self.main_branch, 'branch1', 'branch1a', 'branch2']:
+      path = '/' + self.encode_branch(branch)
+      correct = list(self.repo._svnlook_history(youngest, path))
+      result = self.repo._history(youngest, path)
+      self.assertEqual(correct, result)
+    # unknown paths below an existing directory still go to svnlook
+    path = '/' + self.encode_branch('nonexistent')
+    self.assertRaises(subprocess.CalledProcessError,
+                      self.repo._history, youngest, path)
+
+  def test_history_without_svn(self):
+    import anyvcs.svn
+    youngest = self.repo.youngest()
+    path = '/' + self.encode_branch('branch1a')
+    correct = self.repo._history(youngest, path)
+    svn = anyvcs.svn.SVN
+    anyvcs.svn.SVN = os.path.join(self.dir, 'no-svn')
+    try:
+      repo = anyvcs.open(self.main_path, 'svn')
+      repo._history_index_v = anyvcs.svn.HistoryIndex(
+        os.path.join(self.dir, 'no-svn-history-index'))
+      result = repo._history(youngest, path)
+    finally:
+      anyvcs.svn.SVN = svn
+    self.assertEqual(correct, result)
+
+  def test_mergeinfo_cache(self):
+    from anyvcs.svn import parse_mergeinfo
+    youngest = self.repo.youngest()
+    path = '/' + self.encode_branch('branch1')
+    correct = parse_mergeinfo(self.repo._propget('svn:mergeinfo', str(youngest), path))
+    for i in range(2):
+      result = self.repo._mergeinfo_ranges(youngest, path)
+      self.assertEqual(correct, result)
+
+  def test_diff_summarize(self):
+    def lines(diff):
+      # the timestamps are those of the temporary files; symlinks are
+      # compared as "link TARGET" by both
+      return [x.split(b'\t')[0] if x.startswith((b'--- ', b'+++ ')) else x
+              for x in diff.splitlines()]
+    branch1a = self.encode_branch('branch1a')
+    for rev_a, rev_b, path in ((self.main_branch, branch1a, None),
+                               (branch1a, self.main_branch, None),
+                               (self.main_branch, branch1a, '/b')):
+      args = self.repo._maprev(rev_a) + self.repo._maprev(rev_b) + (path,)
+      self.assertTrue(self.repo._diff_changes(*args) is not None)
+      correct = self.repo._diff_export(*args)
+      result = self.repo.diff(rev_a, rev_b, path)
+      self.assertEqual(lines(correct), lines(result))
+
+  def test_changed_many_without_svn(self):
+    import anyvcs.svn
+    revs = list(range(1, 11))
+    correct = list(self.repo.changed_many(revs))
+    svn = anyvcs.svn.SVN
+    anyvcs.svn.SVN = os.path.join(self.dir, 'no-svn')
+    try:
+      result = list(self.repo.changed_many(revs))
+    finally:
+      anyvcs.svn.SVN = svn
+    self.assertEqual([(rev, [(x.path, x.status, x.copy) for x in changes])
+                      for rev, changes in correct],
+                     [(rev, [(x.path, x.status, x.copy) for x in changes])
+                      for rev, changes in result])
+
+  def test_log_batches(self):
+    def fields(entry):
+      return (entry.rev, entry.parents, entry.date, entry.date.tzname(),
+              entry.author, entry.message)
+    repo = anyvcs.open(self.main_path, 'svn')
+    repo._commit_cache_v = {}
+    repo.log_batch_size = 3
+    result = [fields(x) for x in repo.log()]
+    repo = anyvcs.open(self.main_path, 'svn')
+    repo._commit_cache_v = {}
+    correct = [fields(repo.log(revrange=x[0])) for x in result]
+    self.assertEqual(list(range(10, -1, -1)), [x[0] for x in result])
+    self.assertEqual(correct, result)
+
   def test_log_branch1(self):
     branch1 = self.encode_branch('branch1')
     result = self.repo.log(revrange=branch1).rev